@@ -12,7 +12,8 @@ from django.http import JsonResponse
 from mtaani_app.views import (
     ProductViewSet, CategoryViewSet, OrderViewSet,
     CustomerViewSet, PaymentViewSet,
-    production_list, cache_metrics, mpesa_callback
+    production_list, cache_metrics, inventory_metrics, mpesa_metrics, mpesa_callback,
+    sales_analytics, category_analytics, product_analytics,
 )
 
 # ------------------------
@@ -67,7 +68,12 @@ def root(request):
             "payments": reverse("payment-list"),
             "productions": "/productions/",
             "cache_metrics": "/cache-metrics/",
+            "inventory_metrics": "/inventory-metrics/",
+            "mpesa_metrics": "/mpesa-metrics/",
             "mpesa_callback": "/mpesa/callback/",
+            "sales_analytics": "/api/analytics/sales/",
+            "category_analytics": "/api/analytics/categories/",
+            "product_analytics": "/api/analytics/products/",
             "schema_json": "/api/schema.json",
             "schema_yaml": "/api/schema.yaml",
             "swagger_ui": "/api/schema/",
@@ -80,10 +86,15 @@ urlpatterns = [
     path('admin/', admin.site.urls),
 
     # API routes
+    path('api/analytics/sales/', sales_analytics, name='sales-analytics'),
+    path('api/analytics/categories/', category_analytics, name='category-analytics'),
+    path('api/analytics/products/', product_analytics, name='product-analytics'),
     path('api/', include(router.urls)),
     path('api-token-auth/', obtain_auth_token),
     path('productions/', production_list),
     path('cache-metrics/', cache_metrics),
+    path('inventory-metrics/', inventory_metrics),
+    path('mpesa-metrics/', mpesa_metrics),
     path('mpesa/callback/', mpesa_callback),
 
     # Swagger / OpenAPI
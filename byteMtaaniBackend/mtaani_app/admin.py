@@ -1,5 +1,40 @@
+import uuid
+from functools import reduce
+from operator import or_
+
 from django.contrib import admin
-from .models import User, Category, Product, Order, OrderItem, Payment
+from django.db.models import Q
+from . import search
+from .models import User, Category, Product, Order, OrderItem, Payment, OutboundEmail, TaskOutbox
+from .pagination import EstimatedCountPaginator
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+	"""Changelist settings for tables that grow to millions of rows.
+
+	Counts come from the planner's estimate past ADMIN_COUNT_ESTIMATE_THRESHOLD
+	rows (see pagination.EstimatedCountPaginator) and the second COUNT(*) of
+	the unfiltered table ("N results (M total)") is skipped. Subclasses list
+	the relations they display in `list_select_related`, use raw id widgets
+	for foreign keys to large tables and search with exact lookups, which
+	the unique indexes answer (icontains can't use a B-tree index).
+	A search term that is a UUID is matched against `uuid_search_fields`
+	(Django casts other `__exact` UUID lookups to text, missing the index).
+	"""
+
+	paginator = EstimatedCountPaginator
+	show_full_result_count = False
+	uuid_search_fields = ()
+
+	def get_search_results(self, request, queryset, search_term):
+		if self.uuid_search_fields:
+			try:
+				value = uuid.UUID(search_term.strip())
+			except ValueError:
+				pass
+			else:
+				return queryset.filter(reduce(or_, (Q(**{name: value}) for name in self.uuid_search_fields))), False
+		return super().get_search_results(request, queryset, search_term)
 
 
 @admin.register(User)
@@ -16,23 +51,75 @@ class CategoryAdmin(admin.ModelAdmin):
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-	list_display = ('product_name', 'url_key', 'price', 'stock', 'in_stock', 'category')
+	list_display = ('product_name', 'url_key', 'price', 'stock', 'in_stock', 'is_hot_sku', 'category')
+	list_select_related = ('category',)
 	search_fields = ('product_name', 'url_key')
-	list_filter = ('in_stock', 'category')
+	list_filter = ('in_stock', 'is_hot_sku', 'category')
+
+	def get_search_results(self, request, queryset, search_term):
+		# the full-text index (search.py) instead of icontains scans; also
+		# answers the product autocomplete of order items
+		term = search_term.strip()
+		if not term:
+			return queryset, False
+		exact = queryset.filter(url_key=term)
+		if exact.exists():
+			return exact, False
+		return search.search_products(queryset, term), False
 
 
 class OrderItemInline(admin.TabularInline):
 	model = OrderItem
 	extra = 0
+	autocomplete_fields = ('product',)
+
+	def get_queryset(self, request):
+		return super().get_queryset(request).select_related('product')
 
 
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(LargeTableAdmin):
 	list_display = ('id', 'user', 'status', 'total_amount', 'created_at')
+	list_select_related = ('user',)
+	list_filter = ('status',)
+	search_fields = ('user__email__exact',)
+	uuid_search_fields = ('id',)
+	# matches the (created_at, id) index
+	ordering = ('-created_at', '-id')
+	raw_id_fields = ('user',)
 	inlines = (OrderItemInline,)
 
 
+@admin.register(OrderItem)
+class OrderItemAdmin(LargeTableAdmin):
+	list_display = ('order', 'product', 'quantity', 'price')
+	list_select_related = ('order', 'product')
+	search_fields = ('product__url_key__exact',)
+	uuid_search_fields = ('order_id',)
+	raw_id_fields = ('order',)
+	autocomplete_fields = ('product',)
+
+
 @admin.register(Payment)
-class PaymentAdmin(admin.ModelAdmin):
+class PaymentAdmin(LargeTableAdmin):
 	list_display = ('transaction_id', 'user', 'order', 'amount', 'status')
-	search_fields = ('transaction_id',)
+	list_select_related = ('user', 'order')
+	list_filter = ('status', 'method')
+	search_fields = ('transaction_id__exact', 'checkout_request_id__exact', 'mpesa_receipt_number__exact')
+	uuid_search_fields = ('id', 'order_id')
+	# matches the (created_at, id) index
+	ordering = ('-created_at', '-id')
+	raw_id_fields = ('user', 'order')
+
+
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+	list_display = ('kind', 'status', 'recipient', 'attempts', 'created_at', 'sent_at')
+	list_filter = ('status', 'kind')
+	raw_id_fields = ('order', 'payment')
+
+
+@admin.register(TaskOutbox)
+class TaskOutboxAdmin(admin.ModelAdmin):
+	list_display = ('task', 'eta', 'attempts', 'created_at')
+	search_fields = ('task',)
@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class MtaaniAppConfig(AppConfig):
@@ -11,3 +12,7 @@ class MtaaniAppConfig(AppConfig):
             from . import signals  # noqa: F401
         except Exception:
             pass
+
+        # GIN index of the product search vectors (PostgreSQL)
+        from .search import ensure_search_index
+        post_migrate.connect(ensure_search_index, sender=self)
@@ -0,0 +1,116 @@
+"""Stampede-safe cache reads.
+
+`get_or_compute()` wraps a cache key whose value is expensive to rebuild:
+
+- Values are stored with a soft expiry inside a longer hard TTL, so after the
+  soft expiry the old value can still be served while it is rebuilt
+  (stale-while-revalidate).
+- Only one worker rebuilds a key at a time (single flight); the lock is a
+  `cache.add()`, i.e. a Redis ``SET NX EX`` with the django_redis backend.
+  Others serve the stale value or, when nothing is cached at all, wait
+  briefly for the winner's result.
+- Before the soft expiry a request may refresh early with a probability that
+  grows as expiry approaches and with how long the value took to compute
+  ("XFetch", probabilistic early expiration), so a hot key is usually
+  rebuilt before it ever goes stale.
+"""
+
+import logging
+import math
+import random
+import time
+import uuid
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+LOCK_SUFFIX = ':lock'
+
+
+def _acquire(lock_key, lock_timeout):
+    token = uuid.uuid4().hex
+    try:
+        if cache.add(lock_key, token, lock_timeout):
+            return token
+    except Exception:
+        logger.exception('Cache lock %s unavailable', lock_key)
+    return None
+
+
+def _release(lock_key, token):
+    try:
+        # don't delete a lock that expired and was taken by someone else
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
+    except Exception:
+        logger.exception('Failed to release cache lock %s', lock_key)
+
+
+def _compute_and_store(key, compute, timeout, stale_timeout):
+    started = time.monotonic()
+    value = compute()
+    delta = time.monotonic() - started
+    try:
+        cache.set(key, (value, time.time() + timeout, delta), timeout + stale_timeout)
+    except Exception:
+        logger.exception('Failed to store recomputed value for %s', key)
+    return value
+
+
+def _should_refresh(expires_at, delta, beta):
+    # -log(u) for u in (0, 1] is an exponential sample: usually small, so
+    # early refreshes only become likely within a few `delta`s of expiry
+    return time.time() - delta * beta * math.log(1.0 - random.random()) >= expires_at
+
+
+def get_or_compute(key, compute, timeout, stale_timeout=300, beta=1.0, lock_timeout=30, wait_timeout=2.0):
+    """Return the cached value of `key`, calling `compute()` to (re)build it.
+
+    `timeout` is the soft lifetime of a value; it stays servable as stale for
+    another `stale_timeout` seconds. `beta` scales early refreshes (0
+    disables them). A request that finds nothing cached and loses the
+    rebuild race waits up to `wait_timeout` seconds before computing the
+    value itself. Cache errors degrade to calling `compute()` directly.
+    """
+    try:
+        entry = cache.get(key)
+    except Exception:
+        logger.exception('Cache read failed for %s; computing without cache', key)
+        return compute()
+
+    lock_key = key + LOCK_SUFFIX
+    if entry is not None:
+        value, expires_at, delta = entry
+        if not _should_refresh(expires_at, delta, beta):
+            return value
+        token = _acquire(lock_key, lock_timeout)
+        if token is None:
+            # another worker is rebuilding; keep serving what we have
+            return value
+        try:
+            return _compute_and_store(key, compute, timeout, stale_timeout)
+        except Exception:
+            logger.exception('Recomputing %s failed; serving stale value', key)
+            return value
+        finally:
+            _release(lock_key, token)
+
+    token = _acquire(lock_key, lock_timeout)
+    if token is not None:
+        try:
+            return _compute_and_store(key, compute, timeout, stale_timeout)
+        finally:
+            _release(lock_key, token)
+
+    deadline = time.monotonic() + wait_timeout
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        try:
+            entry = cache.get(key)
+        except Exception:
+            break
+        if entry is not None:
+            return entry[0]
+    logger.warning('Timed out waiting for %s to be rebuilt; computing it here', key)
+    return compute()
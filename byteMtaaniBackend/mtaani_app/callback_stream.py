@@ -0,0 +1,214 @@
+"""Durable queue of M-Pesa callbacks on a Redis stream.
+
+Safaricom resends callbacks it doesn't get a quick answer to. With
+MPESA_CALLBACK_QUEUE enabled, `mpesa_callback` only validates the payload
+and `enqueue()` appends its ``stkCallback`` to the ``payments:callbacks``
+stream, so acknowledging a callback costs one Redis round trip whatever the
+database is doing.
+
+Consumers of the ``payments`` group drain the stream with `drain()`: each
+batch of up to MPESA_CALLBACK_DRAIN_BATCH_SIZE entries is resolved to its
+payments in one query and settled with `payments.apply_query_results()` in
+one transaction, then the entries are acknowledged and deleted. It runs from
+the `drain_mpesa_callbacks` beat task and from the `drain_mpesa_callbacks`
+management command, which keeps a consumer blocked on the stream; any number
+of them can run side by side. Entries read by a consumer that died before
+acknowledging them are claimed by another one after MPESA_CALLBACK_CLAIM_IDLE
+seconds.
+
+Back-pressure: handled entries are deleted, so the stream length is the
+backlog. Once it reaches MPESA_CALLBACK_MAX_BACKLOG, `enqueue()` raises
+`CallbackBacklogFull` and the endpoint answers 503 so Safaricom retries
+later. When the cache backend isn't django_redis, or Redis fails,
+`enqueue()` returns False and the callback is processed inline.
+"""
+
+import json
+import logging
+import math
+import os
+import socket
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis.exceptions import ResponseError
+
+from . import metrics, payments
+
+logger = logging.getLogger(__name__)
+
+STREAM_KEY = 'payments:callbacks'
+GROUP = 'payments'
+
+QUEUED_METRIC = 'mpesa.callbacks.queued'
+REJECTED_METRIC = 'mpesa.callbacks.rejected'
+APPLIED_METRIC = 'mpesa.callbacks.applied'
+UNKNOWN_METRIC = 'mpesa.callbacks.unknown'
+INVALID_METRIC = 'mpesa.callbacks.invalid'
+
+# KEYS[1] stream; ARGV[1] max backlog, ARGV[2] payload
+# Returns the new entry id, or false when the backlog is full.
+ENQUEUE_SCRIPT = """
+if redis.call('XLEN', KEYS[1]) >= tonumber(ARGV[1]) then
+  return false
+end
+return redis.call('XADD', KEYS[1], '*', 'payload', ARGV[2])
+"""
+
+_scripts = {}
+
+
+class CallbackBacklogFull(Exception):
+    """Raised by `enqueue()` when MPESA_CALLBACK_MAX_BACKLOG callbacks are waiting."""
+
+    def __init__(self, backlog):
+        self.backlog = backlog
+        # roughly the time the beat task takes to work through a batch
+        self.retry_after = max(1, math.ceil(settings.MPESA_CALLBACK_DRAIN_INTERVAL))
+        super().__init__(f'{backlog} callbacks are waiting to be processed')
+
+
+def get_connection():
+    """Return the raw Redis client, or None when the cache backend isn't django_redis."""
+    try:
+        return get_redis_connection('default')
+    except NotImplementedError:
+        return None
+
+
+def _script(conn, source):
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = conn.register_script(source)
+    return script
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def enqueue(stk):
+    """Append the `stkCallback` dict `stk` to the stream.
+
+    Returns False when the stream is unavailable (the caller processes the
+    callback itself); raises `CallbackBacklogFull` under back-pressure.
+    """
+    conn = get_connection()
+    if conn is None:
+        return False
+    limit = settings.MPESA_CALLBACK_MAX_BACKLOG
+    try:
+        entry_id = _script(conn, ENQUEUE_SCRIPT)(keys=[STREAM_KEY], args=[limit, json.dumps(stk)], client=conn)
+    except Exception:
+        logger.exception('Failed to queue the M-Pesa callback of %s', stk.get('CheckoutRequestID'))
+        return False
+    if entry_id is None:
+        metrics.incr(REJECTED_METRIC)
+        raise CallbackBacklogFull(limit)
+    metrics.incr(QUEUED_METRIC)
+    return True
+
+
+def consumer_name():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def _ensure_group(conn):
+    try:
+        conn.xgroup_create(STREAM_KEY, GROUP, id='0', mkstream=True)
+    except ResponseError as exc:
+        if 'BUSYGROUP' not in str(exc):
+            raise
+
+
+def _apply(conn, entries, totals):
+    """Settle the payments of a batch of stream entries, then acknowledge them."""
+    callbacks = {}
+    for entry_id, fields in entries:
+        try:
+            stk = json.loads(_decode(fields[b'payload']))
+            callbacks[entry_id] = stk, stk['CheckoutRequestID']
+        except (KeyError, TypeError, ValueError):
+            logger.error('Dropping malformed M-Pesa callback entry %s', _decode(entry_id))
+            totals['invalid'] += 1
+
+    payment_ids = payments.find_payment_ids(checkout_id for _, checkout_id in callbacks.values())
+    results = {}
+    for stk, checkout_id in callbacks.values():
+        pk = payment_ids.get(checkout_id)
+        if pk is None:
+            logger.warning('No payment for M-Pesa callback %s', checkout_id)
+            totals['unknown'] += 1
+            continue
+        results[pk] = stk
+
+    # a failure here leaves the entries pending; they are claimed again later
+    updated = payments.apply_query_results(results)
+
+    ids = [entry_id for entry_id, _ in entries]
+    pipe = conn.pipeline()
+    pipe.xack(STREAM_KEY, GROUP, *ids)
+    pipe.xdel(STREAM_KEY, *ids)
+    pipe.execute()
+
+    totals['read'] += len(entries)
+    totals['applied'] += len(updated)
+
+
+def drain(consumer=None, batch_size=None, max_batches=None, block_ms=None):
+    """Apply queued callbacks in batches as consumer `consumer`.
+
+    Stops when the stream is empty or after `max_batches` batches. With
+    `block_ms`, waits that long for new entries before giving up. Returns
+    counts: read, applied (payments updated), unknown (no such payment),
+    invalid; `skipped` is True without Redis.
+    """
+    conn = get_connection()
+    if conn is None:
+        return {'skipped': True}
+    consumer = consumer or consumer_name()
+    batch_size = batch_size or settings.MPESA_CALLBACK_DRAIN_BATCH_SIZE
+    totals = {'skipped': False, 'read': 0, 'applied': 0, 'unknown': 0, 'invalid': 0}
+
+    _ensure_group(conn)
+    # entries of consumers that died before acknowledging them
+    _, claimed, *_ = conn.xautoclaim(
+        STREAM_KEY, GROUP, consumer, settings.MPESA_CALLBACK_CLAIM_IDLE * 1000, start_id='0-0', count=batch_size,
+    )
+    if claimed:
+        _apply(conn, claimed, totals)
+
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        response = conn.xreadgroup(GROUP, consumer, {STREAM_KEY: '>'}, count=batch_size, block=block_ms)
+        entries = response[0][1] if response else []
+        if not entries:
+            break
+        _apply(conn, entries, totals)
+        batches += 1
+
+    for name, count in ((APPLIED_METRIC, totals['applied']), (UNKNOWN_METRIC, totals['unknown']),
+                        (INVALID_METRIC, totals['invalid'])):
+        if count:
+            metrics.incr(name, count)
+    return totals
+
+
+def get_metrics():
+    """Return the callback counters and the current backlog (None without Redis)."""
+    counters = metrics.get_counters([QUEUED_METRIC, REJECTED_METRIC, APPLIED_METRIC, UNKNOWN_METRIC, INVALID_METRIC])
+    backlog = None
+    conn = get_connection()
+    if conn is not None:
+        try:
+            backlog = conn.xlen(STREAM_KEY)
+        except Exception:
+            logger.exception('Failed to read the M-Pesa callback backlog')
+    return {
+        'backlog': backlog,
+        'queued': counters[QUEUED_METRIC],
+        'rejected': counters[REJECTED_METRIC],
+        'applied': counters[APPLIED_METRIC],
+        'unknown': counters[UNKNOWN_METRIC],
+        'invalid': counters[INVALID_METRIC],
+    }
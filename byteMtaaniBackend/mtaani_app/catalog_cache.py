@@ -0,0 +1,201 @@
+"""Cache of ready-to-send product JSON for the public catalog.
+
+Each product is cached as its own JSON fragment (the exact bytes
+`ProductSerializer` + `JSONRenderer` would produce) and the catalog listing
+is cached as an ordered list of product ids. A listing response is assembled
+by joining fragments, so a warm request never touches the database or DRF
+field serialization, and a product change only costs re-rendering that one
+fragment.
+
+Keys are versioned:
+
+- ``SCHEMA_VERSION`` is part of every key; bump it whenever the
+  `ProductSerializer` output changes so old fragments are never served.
+- ``catalog:version`` is a counter that is part of the index keys; bumping
+  it retires the current indexes (products added or removed) without
+  touching the fragments.
+
+Besides the full index there is one index per category, so a listing
+filtered by category is assembled the same way.
+
+Product changes are applied granularly (see `product_saved`): a change that
+only touches stock drops the cached fragment (the next read renders it),
+other field changes re-render just that fragment, a category move evicts
+the two affected category indexes, and only creations and deletions bump
+the index version. Stock changes made with bulk UPDATEs (order
+reservations) are applied with `refresh_stock`. Fragments are never
+patched in place: a read-modify-write could overwrite a concurrent
+re-render with the stale fields it read.
+
+Indexes are read through `cache_helpers.get_or_compute`, so an expired or
+retired index is rebuilt by a single worker while the others serve the stale
+copy (or wait for the new one) instead of all querying the database.
+
+Cache errors are logged and the data is built from the database instead.
+"""
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.renderers import JSONRenderer
+
+from .cache_helpers import get_or_compute
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+VERSION_KEY = 'catalog:version'
+INDEX_KEY = 'catalog:s{schema}:v{version}:index'
+CATEGORY_INDEX_KEY = 'catalog:s{schema}:v{version}:category:{category}'
+PRODUCT_KEY = 'catalog:s{schema}:product:{pk}'
+
+# model attributes whose changes only need the cached fragment dropped
+STOCK_FIELDS = frozenset({'stock', 'in_stock', 'updated_at'})
+
+_renderer = JSONRenderer()
+
+
+def _timeout():
+    return getattr(settings, 'CATALOG_CACHE_TIMEOUT', 3600)
+
+
+def product_key(pk):
+    return PRODUCT_KEY.format(schema=SCHEMA_VERSION, pk=pk)
+
+
+def render_product(product):
+    """Return the JSON bytes of `product` exactly as the API serializes it."""
+    from .serializers import ProductSerializer
+
+    return _renderer.render(ProductSerializer(product).data)
+
+
+def _cache_call(method, *args):
+    try:
+        return getattr(cache, method)(*args)
+    except Exception:
+        logger.exception('Catalog cache %s failed; continuing without cache', method)
+        return None
+
+
+def _fresh_version():
+    # a counter that was evicted must not restart at a value whose index
+    # may still be cached, so (re)start from the clock
+    return time.time_ns()
+
+
+def get_version():
+    version = _cache_call('get', VERSION_KEY)
+    if version is None:
+        # first use (or the counter was evicted): start a fresh index
+        _cache_call('add', VERSION_KEY, _fresh_version(), None)
+        version = _cache_call('get', VERSION_KEY) or _fresh_version()
+    return version
+
+
+def bump_version():
+    """Retire the current catalog index so the next read rebuilds it."""
+    if _cache_call('add', VERSION_KEY, _fresh_version(), None):
+        return
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        # evicted between add() and incr()
+        _cache_call('set', VERSION_KEY, _fresh_version(), None)
+    except Exception:
+        logger.exception('Catalog cache incr failed; continuing without cache')
+
+
+def _index_key(category=None, version=None):
+    version = version or get_version()
+    if category is None:
+        return INDEX_KEY.format(schema=SCHEMA_VERSION, version=version)
+    return CATEGORY_INDEX_KEY.format(schema=SCHEMA_VERSION, version=version, category=category)
+
+
+def _load_index(category=None):
+    qs = Product.objects.order_by('created_at', 'pk')
+    if category is not None:
+        qs = qs.filter(category_id=category)
+    return [str(pk) for pk in qs.values_list('pk', flat=True)]
+
+
+def get_index(category=None):
+    """Return the ordered list of product ids (as strings) in the catalog or one category."""
+    return get_or_compute(
+        _index_key(category),
+        lambda: _load_index(category),
+        timeout=_timeout(),
+        stale_timeout=getattr(settings, 'CATALOG_CACHE_STALE_TIMEOUT', 300),
+    )
+
+
+def get_fragments(ids):
+    """Return a dict of product id -> JSON fragment, rendering cache misses from the database."""
+    keys = {product_key(pk): pk for pk in ids}
+    cached = _cache_call('get_many', list(keys)) or {}
+    fragments = {keys[key]: value for key, value in cached.items()}
+
+    missing = [pk for pk in ids if pk not in fragments]
+    if missing:
+        rendered = {}
+        for product in Product.objects.filter(pk__in=missing):
+            pk = str(product.pk)
+            fragments[pk] = rendered[product_key(pk)] = render_product(product)
+        if rendered:
+            _cache_call('set_many', rendered, _timeout())
+    return fragments
+
+
+def assemble(ids):
+    """Return the JSON array bytes for the products `ids`, in that order."""
+    fragments = get_fragments(ids)
+    return b'[' + b','.join(fragments[pk] for pk in ids if pk in fragments) + b']'
+
+
+def get_catalog_json(category=None):
+    """Return the catalog listing (optionally for one category id) as JSON bytes."""
+    return assemble(get_index(category))
+
+
+def product_saved(product, created, changed=None, old_category=None):
+    """Update the cache after `product` was saved.
+
+    `changed` is the set of model attributes the save changed, or None when
+    unknown (everything is then treated as changed). `old_category` is the
+    category id the product had before the save, when known.
+    """
+    pk = str(product.pk)
+    if created:
+        _cache_call('set', product_key(pk), render_product(product), _timeout())
+        bump_version()
+        return
+
+    if changed is not None and changed <= STOCK_FIELDS:
+        _cache_call('delete', product_key(pk))
+        return
+
+    _cache_call('set', product_key(pk), render_product(product), _timeout())
+    if changed is None:
+        # can't tell where the product was listed before
+        bump_version()
+    elif 'category_id' in changed:
+        _cache_call('delete_many', [_index_key(old_category), _index_key(product.category_id)])
+
+
+def product_deleted(pk):
+    """Drop the fragment of the deleted product `pk` and retire the indexes."""
+    _cache_call('delete', product_key(pk))
+    bump_version()
+
+
+def refresh_stock(pks):
+    """Drop the cached fragments of `pks` after their stock changed.
+
+    Used after bulk UPDATEs that bypass `Product.save()` and its signals.
+    """
+    if pks:
+        _cache_call('delete_many', [product_key(pk) for pk in pks])
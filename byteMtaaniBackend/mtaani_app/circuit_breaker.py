@@ -0,0 +1,128 @@
+"""Circuit breaker whose state is shared across processes through the Django cache.
+
+With the Redis cache backend every gunicorn and Celery process sees the same
+breaker, so once an upstream is known to be failing no worker spends its
+request budget waiting for it. With the local-memory fallback the state is
+per process.
+
+States:
+
+- closed: calls go through; calls and failures are counted in fixed windows
+  of `window` seconds. When a window has at least `min_calls` calls and the
+  failure ratio reaches `failure_ratio`, the breaker opens.
+- open: `allow()` raises `CircuitOpenError` for `reset_timeout` seconds.
+- half-open: after that, one caller at a time is let through as a probe.
+  Success closes the breaker; failure opens it again.
+
+Cache errors never block calls: the breaker then behaves as closed.
+"""
+
+import logging
+import time
+
+from django.core.cache import cache
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+OPEN_KEY = 'breaker:{name}:opened_at'
+PROBE_KEY = 'breaker:{name}:probe'
+COUNT_KEY = 'breaker:{name}:{window}:{kind}'
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose breaker is open."""
+
+    def __init__(self, name, retry_after):
+        self.name = name
+        self.retry_after = max(1, int(retry_after))
+        super().__init__(f'{name} is unavailable (circuit open); retry in {self.retry_after}s')
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_ratio=0.5, min_calls=10, window=30, reset_timeout=30):
+        self.name = name
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+
+    def _key(self, template, **kwargs):
+        return template.format(name=self.name, **kwargs)
+
+    def _count_key(self, kind):
+        return self._key(COUNT_KEY, window=int(time.time() // self.window), kind=kind)
+
+    def _incr(self, kind):
+        key = self._count_key(kind)
+        cache.add(key, 0, self.window * 2)
+        return cache.incr(key)
+
+    def state(self):
+        """Return 'closed', 'open' or 'half-open'."""
+        try:
+            opened_at = cache.get(self._key(OPEN_KEY))
+        except Exception:
+            return 'closed'
+        if opened_at is None:
+            return 'closed'
+        return 'open' if time.time() < opened_at + self.reset_timeout else 'half-open'
+
+    def allow(self):
+        """Raise `CircuitOpenError` unless a call may be made now.
+
+        Returns True when the call is the half-open probe; pass that on to
+        `record_success()` / `record_failure()`.
+        """
+        try:
+            opened_at = cache.get(self._key(OPEN_KEY))
+            if opened_at is None:
+                return False
+            retry_after = opened_at + self.reset_timeout - time.time()
+            if retry_after > 0:
+                raise CircuitOpenError(self.name, retry_after)
+            # half-open: a single probe; everyone else keeps failing fast
+            if not cache.add(self._key(PROBE_KEY), 1, self.reset_timeout):
+                raise CircuitOpenError(self.name, self.reset_timeout)
+            return True
+        except CircuitOpenError:
+            metrics.incr(f'breaker.{self.name}.rejected')
+            raise
+        except Exception:
+            logger.exception('Circuit breaker %s unavailable; allowing the call', self.name)
+            return False
+
+    def record_success(self, probe=False):
+        try:
+            if probe:
+                self.reset()
+                logger.info('Circuit %s closed', self.name)
+                return
+            self._incr('calls')
+        except Exception:
+            logger.exception('Failed to record success on circuit breaker %s', self.name)
+
+    def record_failure(self, probe=False):
+        try:
+            if probe:
+                self._open()
+                return
+            calls = self._incr('calls')
+            failures = self._incr('failures')
+            if calls >= self.min_calls and failures / calls >= self.failure_ratio and self.state() == 'closed':
+                self._open()
+        except Exception:
+            logger.exception('Failed to record failure on circuit breaker %s', self.name)
+
+    def _open(self):
+        cache.set(self._key(OPEN_KEY), time.time(), None)
+        cache.delete(self._key(PROBE_KEY))
+        metrics.incr(f'breaker.{self.name}.opened')
+        logger.warning('Circuit %s opened for %ss', self.name, self.reset_timeout)
+
+    def reset(self):
+        """Close the breaker and start counting afresh."""
+        cache.delete_many([
+            self._key(OPEN_KEY), self._key(PROBE_KEY), self._count_key('calls'), self._count_key('failures'),
+        ])
@@ -0,0 +1,145 @@
+"""Transaction-safe, deferred dispatch of Celery tasks.
+
+Calling `task.delay()` inside a request ties the response time to the
+broker, loses the message when the broker is unreachable, and can run the
+task before the transaction that created its data has committed.
+`dispatch(task, args, kwargs, countdown=...)` instead:
+
+1. inserts a `TaskOutbox` row in the current transaction, so the task
+   exists exactly when the data it works on does;
+2. on commit (`transaction.on_commit`), adds it to an in-process buffer;
+3. publishes the buffer in one batch over a single broker connection when
+   the request has finished (`request_finished`, after the response has
+   been handed to the server), when a Celery task ends, when the buffer
+   reaches DISPATCH_BATCH_SIZE, or at exit; published rows are deleted.
+
+Nothing talks to the broker before the response is produced. Rows that
+couldn't be published (broker down, process killed) are published by
+`relay()`, run every DISPATCH_RELAY_INTERVAL seconds by the
+`relay_task_outbox` beat task, once they are DISPATCH_RELAY_MIN_AGE seconds
+old. A relay racing a slow flush can publish a task twice, so dispatched
+tasks must tolerate redelivery (they already have to with acks_late or
+broker redelivery).
+"""
+
+import atexit
+import logging
+import os
+import threading
+from datetime import timedelta
+
+from celery import current_app
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import TaskOutbox
+
+logger = logging.getLogger(__name__)
+
+_buffer = []
+_buffer_pid = os.getpid()
+_lock = threading.Lock()
+
+
+def dispatch(task, args=(), kwargs=None, countdown=None):
+    """Queue `task` (a task or its name) to be sent once the current transaction commits.
+
+    `args` and `kwargs` must be JSON-serializable. Returns the outbox row.
+    """
+    name = task if isinstance(task, str) else task.name
+    eta = timezone.now() + timedelta(seconds=countdown) if countdown else None
+    entry = TaskOutbox.objects.create(task=name, args=list(args), kwargs=kwargs or {}, eta=eta)
+    transaction.on_commit(lambda: _buffered(entry))
+    return entry
+
+
+def _buffered(entry):
+    global _buffer_pid
+    with _lock:
+        if _buffer_pid != os.getpid():
+            # forked: the parent's buffered entries are the parent's to send
+            _buffer.clear()
+            _buffer_pid = os.getpid()
+        _buffer.append(entry)
+        full = len(_buffer) >= settings.DISPATCH_BATCH_SIZE
+    if full:
+        flush()
+
+
+def _publish(entries):
+    """Publish `entries` over one producer; returns (sent pks, failed pks, error)."""
+    sent = []
+    try:
+        with current_app.producer_or_acquire() as producer:
+            for entry in entries:
+                options = {'eta': entry.eta, 'producer': producer, 'retry': False}
+                task = current_app.tasks.get(entry.task)
+                if task is not None:
+                    task.apply_async(entry.args, entry.kwargs, **options)
+                else:
+                    current_app.send_task(entry.task, entry.args, entry.kwargs, **options)
+                sent.append(entry.pk)
+    except Exception as exc:
+        # the broker is unreachable; the rest waits for the relay
+        return sent, [entry.pk for entry in entries[len(sent):]], exc
+    return sent, [], None
+
+
+def _record(sent, failed, error):
+    if sent:
+        TaskOutbox.objects.filter(pk__in=sent).delete()
+    if failed:
+        TaskOutbox.objects.filter(pk__in=failed).update(attempts=F('attempts') + 1, last_error=str(error)[:1000])
+
+
+def flush():
+    """Publish the tasks buffered in this process. Returns how many were sent."""
+    with _lock:
+        if not _buffer or _buffer_pid != os.getpid():
+            return 0
+        entries = list(_buffer)
+        _buffer.clear()
+    sent, failed, error = _publish(entries)
+    if failed:
+        logger.warning('Could not publish %s tasks, left for the relay: %s', len(failed), error)
+    try:
+        _record(sent, failed, error)
+    except Exception:
+        # published rows still in the outbox are sent again by the relay
+        logger.exception('Failed to update the task outbox')
+    return len(sent)
+
+
+def relay(batch_size=None, min_age=None):
+    """Publish outbox rows older than `min_age` seconds that no process has sent.
+
+    Returns counts of tasks sent and still failing.
+    """
+    batch_size = batch_size or settings.DISPATCH_BATCH_SIZE
+    min_age = settings.DISPATCH_RELAY_MIN_AGE if min_age is None else min_age
+    totals = {'sent': 0, 'failed': 0}
+    while True:
+        cutoff = timezone.now() - timedelta(seconds=min_age)
+        with transaction.atomic():
+            # concurrent relays take different rows
+            entries = list(
+                TaskOutbox.objects.select_for_update(skip_locked=True)
+                .filter(created_at__lte=cutoff).order_by('created_at')[:batch_size]
+            )
+            if not entries:
+                break
+            sent, failed, error = _publish(entries)
+            _record(sent, failed, error)
+        totals['sent'] += len(sent)
+        totals['failed'] += len(failed)
+        if failed:
+            logger.warning('Task outbox relay stopped, broker unavailable: %s', error)
+            break
+        if len(entries) < batch_size:
+            break
+    return totals
+
+
+atexit.register(flush)
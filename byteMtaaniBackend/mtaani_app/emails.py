@@ -0,0 +1,251 @@
+"""Outbox for transactional email.
+
+Confirmation emails used to be one Celery task each, every task opening its
+own SMTP connection (and the booking one reloading its order). Now callers
+only insert `OutboundEmail` rows with `queue_payment_confirmations()`,
+`queue_booking_confirmation()` or `queue_email()`, and a flush is scheduled
+EMAIL_OUTBOX_FLUSH_DELAY seconds out so that messages queued in the
+meantime go out together.
+
+`flush_outbox()` (the `flush_email_outbox` task, also on the beat schedule
+every EMAIL_OUTBOX_FLUSH_INTERVAL seconds to pick up retries) runs one at a
+time across workers. It takes the due messages in batches of
+EMAIL_OUTBOX_BATCH_SIZE together with their payments, orders and users,
+renders them and sends them over a single SMTP connection per batch.
+Every message's outcome is stored on its row: `sent`, or after an error a
+retry with exponential backoff, and `failed` once EMAIL_OUTBOX_MAX_ATTEMPTS
+attempts have failed. At most EMAIL_RATE_LIMIT messages are sent per
+minute (0 disables the limit); the rest wait for the next flush.
+
+The flush lock is extended before each message, and SMTP calls time out
+well within it, so a long batch keeps the lock. Should the lock still be
+lost (e.g. a worker paused longer than FLUSH_LOCK_TIMEOUT), the flush stops
+before sending anything else, since another flush may already be sending
+the same rows.
+"""
+
+import logging
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
+from django.utils import timezone
+
+from .dispatch import dispatch
+from .models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+FLUSH_LOCK_KEY = 'emails:outbox:lock'
+FLUSH_SCHEDULED_KEY = 'emails:outbox:scheduled'
+SENT_KEY = 'emails:sent:{minute}'
+FLUSH_LOCK_TIMEOUT = 300
+# per SMTP operation, unless EMAIL_TIMEOUT is set; far below the lock timeout
+SMTP_TIMEOUT = 30
+RETRY_BASE_DELAY = 60
+RETRY_MAX_DELAY = 3600
+
+
+def schedule_flush():
+    """Queue one `flush_email_outbox` run for all messages queued in the next few seconds."""
+    from .tasks import flush_email_outbox
+
+    delay = settings.EMAIL_OUTBOX_FLUSH_DELAY
+    try:
+        if cache.add(FLUSH_SCHEDULED_KEY, 1, max(1, delay)):
+            dispatch(flush_email_outbox, countdown=delay)
+    except Exception:
+        # the beat task sends them
+        logger.exception('Failed to schedule an email outbox flush')
+
+
+def _queue(rows):
+    rows = OutboundEmail.objects.bulk_create(rows)
+    if rows:
+        schedule_flush()
+    return rows
+
+
+def queue_payment_confirmations(payments):
+    """Queue the confirmation email of each of `payments`."""
+    return _queue([
+        OutboundEmail(kind='payment_confirmation', payment_id=payment.pk, order_id=payment.order_id)
+        for payment in payments
+    ])
+
+
+def queue_booking_confirmation(order):
+    """Queue the booking confirmation email of `order`."""
+    return _queue([OutboundEmail(kind='booking_confirmation', order_id=order.pk)])
+
+
+def queue_email(recipient, subject, body):
+    """Queue a message whose content is already known."""
+    return _queue([OutboundEmail(kind='raw', recipient=recipient, subject=subject, body=body)])
+
+
+def _render(email):
+    """Return `(recipient, subject, body)` of an outbox row."""
+    if email.kind == 'payment_confirmation':
+        payment = email.payment
+        return (
+            payment.user.email,
+            f"Payment received for order {payment.order_id}",
+            f"Your payment for order {payment.order_id} was successful.",
+        )
+    if email.kind == 'booking_confirmation':
+        order = email.order
+        return (
+            order.user.email,
+            f"Booking confirmation — Order {order.id}",
+            f"Hello {order.user},\n\nYour booking (order id {order.id}) for KES {order.total_amount} "
+            f"has been received.\n\nThanks.",
+        )
+    return email.recipient, email.subject, email.body
+
+
+def _sent_key(now):
+    return SENT_KEY.format(minute=int(now.timestamp() // 60))
+
+
+def _quota(now, batch_size):
+    """Messages that may still be sent this minute, capped at `batch_size`."""
+    limit = settings.EMAIL_RATE_LIMIT
+    if not limit:
+        return batch_size
+    try:
+        sent = int(cache.get(_sent_key(now)) or 0)
+    except Exception:
+        logger.exception('Email rate limit unavailable')
+        sent = 0
+    return max(0, min(batch_size, limit - sent))
+
+
+def _count_sent(now, count):
+    if not count or not settings.EMAIL_RATE_LIMIT:
+        return
+    try:
+        key = _sent_key(now)
+        cache.add(key, 0, 120)
+        cache.incr(key, count)
+    except Exception:
+        logger.exception('Failed to count sent emails')
+
+
+def _failed(email, error, now):
+    email.attempts += 1
+    email.last_error = str(error)[:1000]
+    if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+        email.status = 'failed'
+        logger.error('Giving up on email %s after %s attempts: %s', email.pk, email.attempts, error)
+    else:
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (email.attempts - 1))
+        email.next_attempt_at = now + timedelta(seconds=delay)
+
+
+def _extend_lock(token):
+    """Extend the flush lock held with `token`; False when it was lost."""
+    if cache.get(FLUSH_LOCK_KEY) != token:
+        return False
+    cache.touch(FLUSH_LOCK_KEY, FLUSH_LOCK_TIMEOUT)
+    return True
+
+
+def _send_batch(emails, totals, token):
+    """Send a batch over one connection.
+
+    Returns False when the server can't be reached or the flush lock was
+    lost; messages not attempted because of the latter are left untouched.
+    """
+    now = timezone.now()
+    connection = get_connection(fail_silently=False, timeout=settings.EMAIL_TIMEOUT or SMTP_TIMEOUT)
+    messages = []
+    for email in emails:
+        try:
+            recipient, subject, body = _render(email)
+        except Exception as exc:
+            # e.g. the order was deleted; rendering won't succeed later either
+            email.attempts += 1
+            email.status, email.last_error = 'failed', f'render: {exc}'
+            continue
+        if not recipient:
+            email.attempts += 1
+            email.status, email.last_error = 'failed', 'no recipient'
+            continue
+        messages.append((email, EmailMessage(
+            subject, body, settings.DEFAULT_FROM_EMAIL, [recipient], connection=connection,
+        )))
+
+    try:
+        connection.open()
+    except Exception as exc:
+        logger.warning('Email server unavailable: %s', exc)
+        proceed = False
+        for email, _ in messages:
+            _failed(email, exc, now)
+    else:
+        proceed = True
+        try:
+            for position, (email, message) in enumerate(messages):
+                if not _extend_lock(token):
+                    logger.warning(
+                        'Email outbox lock lost; leaving %s messages to the next flush', len(messages) - position,
+                    )
+                    untouched = {id(item) for item, _ in messages[position:]}
+                    emails = [item for item in emails if id(item) not in untouched]
+                    proceed = False
+                    break
+                try:
+                    message.send()
+                except Exception as exc:
+                    logger.warning('Sending email %s failed: %s', email.pk, exc)
+                    _failed(email, exc, now)
+                else:
+                    email.attempts += 1
+                    email.status, email.sent_at, email.last_error = 'sent', timezone.now(), ''
+        finally:
+            connection.close()
+
+    OutboundEmail.objects.bulk_update(emails, ['status', 'attempts', 'last_error', 'next_attempt_at', 'sent_at'])
+    sent = sum(1 for email in emails if email.status == 'sent')
+    _count_sent(now, sent)
+    totals['sent'] += sent
+    totals['failed'] += sum(1 for email in emails if email.status == 'failed')
+    totals['retrying'] += sum(1 for email in emails if email.status == 'pending')
+    return proceed
+
+
+def flush_outbox(batch_size=None):
+    """Send the due outbox messages.
+
+    Returns counts of messages sent, failed (given up) and retrying, and
+    whether the run stopped at the rate limit; `skipped` is True when another
+    flush holds the lock.
+    """
+    batch_size = batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE
+    token = uuid.uuid4().hex
+    if not cache.add(FLUSH_LOCK_KEY, token, FLUSH_LOCK_TIMEOUT):
+        return {'skipped': True}
+    try:
+        totals = {'skipped': False, 'sent': 0, 'failed': 0, 'retrying': 0, 'rate_limited': False}
+        while True:
+            now = timezone.now()
+            limit = _quota(now, batch_size)
+            if not limit:
+                totals['rate_limited'] = True
+                break
+            emails = list(
+                OutboundEmail.objects.filter(status='pending', next_attempt_at__lte=now)
+                .select_related('payment__user', 'order__user')
+                .order_by('next_attempt_at')[:limit]
+            )
+            # stop early while the email server is down rather than
+            # spending an attempt of every pending message
+            if not emails or not _send_batch(emails, totals, token) or len(emails) < limit:
+                break
+        return totals
+    finally:
+        if cache.get(FLUSH_LOCK_KEY) == token:
+            cache.delete(FLUSH_LOCK_KEY)
@@ -0,0 +1,188 @@
+"""Product facets: counts per category, stock state and price range.
+
+`product_facets(queryset, params)` returns the facets of a product list
+(``?facets=1`` on the product endpoint). Browsing the catalog, optionally
+by `category` and/or `in_stock`, is answered from `ProductFacetCount`, one
+row per (category, price bucket, in stock) cell, so the cost depends on
+the number of categories, not of products. Other filters (search, price
+bounds, stock bounds) need the matching products, and are counted with one
+GROUP BY over the filtered queryset instead of a COUNT per facet.
+
+The cells are maintained in the transaction that changes the products:
+
+- `product_saved()` / `product_deleted()` from the product signals move a
+  product between cells when its category, price or stock state changes;
+- `stock_changed()` after the bulk stock UPDATEs of inventory.py, which
+  don't fire signals, moves the products whose stock crossed zero.
+
+Other bulk writes (queryset.update(), bulk_create) aren't tracked; the
+`rebuild_product_facets` beat task recounts everything every
+FACET_REBUILD_INTERVAL seconds (also `manage.py rebuild_product_facets`).
+Price buckets are the ranges between FACET_PRICE_BUCKETS lower bounds, the
+last one open-ended.
+"""
+
+from bisect import bisect_right
+from collections import Counter
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, F, IntegerField, Value, When
+
+from .models import Product, ProductFacetCount
+
+# filters the cells can answer
+CELL_FILTERS = frozenset({'category', 'in_stock'})
+CELL_FIELDS = ('category_id', 'price', 'in_stock')
+
+
+def price_bucket(price):
+    # unsaved instances may still carry the price as given (str, int)
+    return max(0, bisect_right(settings.FACET_PRICE_BUCKETS, Decimal(price)) - 1)
+
+
+def price_bucket_expression():
+    """SQL computing `price_bucket()` of a product."""
+    bounds = settings.FACET_PRICE_BUCKETS
+    return Case(
+        *(When(price__lt=bound, then=Value(bucket)) for bucket, bound in enumerate(bounds[1:])),
+        default=Value(len(bounds) - 1), output_field=IntegerField(),
+    )
+
+
+def _cell(category_id, price, in_stock):
+    return category_id, price_bucket(price), bool(in_stock)
+
+
+def _apply(deltas):
+    """Add `deltas` ({cell: change}) to the stored counts."""
+    for (category_id, bucket, in_stock), change in sorted(deltas.items(), key=str):
+        if not change:
+            continue
+        cell = ProductFacetCount.objects.filter(category_id=category_id, price_bucket=bucket, in_stock=in_stock)
+        if cell.update(count=F('count') + change) or change < 0:
+            continue
+        try:
+            with transaction.atomic():
+                ProductFacetCount.objects.create(
+                    category_id=category_id, price_bucket=bucket, in_stock=in_stock, count=change,
+                )
+        except IntegrityError:
+            # created concurrently
+            cell.update(count=F('count') + change)
+
+
+def product_saved(product, created, loaded=None, update_fields=None):
+    """Move `product` to its new cell after a save.
+
+    `loaded` holds the values the instance was loaded with (None when
+    unknown, e.g. an instance built by hand and saved over an existing row,
+    in which case a recount is queued).
+    """
+    if created:
+        _apply(Counter({_cell(*(getattr(product, name) for name in CELL_FIELDS)): 1}))
+        return
+    if loaded is None:
+        from .dispatch import dispatch
+        from .tasks import rebuild_product_facets
+
+        dispatch(rebuild_product_facets)
+        return
+    saved = None if update_fields is None else {product._meta.get_field(name).attname for name in update_fields}
+    old, new = [], []
+    for name in CELL_FIELDS:
+        value = getattr(product, name) if name not in loaded else loaded[name]
+        old.append(value)
+        # fields left out of update_fields kept their stored value
+        new.append(getattr(product, name) if saved is None or name in saved else value)
+    old, new = _cell(*old), _cell(*new)
+    if old != new:
+        _apply(Counter({old: -1, new: 1}))
+
+
+def product_deleted(product):
+    loaded = getattr(product, '_loaded_values', None) or {}
+    values = (loaded[name] if name in loaded else getattr(product, name) for name in CELL_FIELDS)
+    _apply(Counter({_cell(*values): -1}))
+
+
+def stock_changed(deltas):
+    """Update the cells after stock UPDATEs that subtracted `deltas` (product id -> units)."""
+    if not deltas:
+        return
+    deltas = {str(pid): qty for pid, qty in deltas.items()}
+    changes = Counter()
+    rows = Product.objects.filter(pk__in=list(deltas)).values_list('pk', 'category_id', 'price', 'stock')
+    for pk, category_id, price, stock in rows:
+        was_in_stock, in_stock = stock + deltas[str(pk)] > 0, stock > 0
+        if was_in_stock != in_stock:
+            changes[_cell(category_id, price, was_in_stock)] -= 1
+            changes[_cell(category_id, price, in_stock)] += 1
+    _apply(changes)
+
+
+def rebuild():
+    """Recount every cell from the products; returns the number of cells."""
+    rows = (
+        Product.objects.order_by()
+        .annotate(price_bucket=price_bucket_expression())
+        .values('category_id', 'price_bucket', 'in_stock')
+        .annotate(count=Count('pk'))
+    )
+    cells = [ProductFacetCount(**row) for row in rows]
+    with transaction.atomic():
+        ProductFacetCount.objects.all().delete()
+        ProductFacetCount.objects.bulk_create(cells, batch_size=1000)
+    return len(cells)
+
+
+def _cell_filters(params):
+    """Return the product filters `params` applies if the cells can answer them, else None."""
+    from .filters import ProductFilter
+
+    filterset = ProductFilter(params, queryset=Product.objects.none())
+    if not filterset.is_valid():
+        return None
+    active = {name: value for name, value in filterset.form.cleaned_data.items() if value not in (None, '')}
+    return active if active.keys() <= CELL_FILTERS else None
+
+
+def _summarize(rows):
+    """Build the facets from `(category id, category name, price bucket, in stock, count)` rows."""
+    bounds = settings.FACET_PRICE_BUCKETS
+    categories, stock, prices = {}, Counter(), Counter()
+    for category_id, name, bucket, in_stock, count in rows:
+        entry = categories.setdefault(category_id, {'id': str(category_id), 'name': name, 'count': 0})
+        entry['count'] += count
+        stock['in_stock' if in_stock else 'out_of_stock'] += count
+        prices[bucket] += count
+    return {
+        'total': sum(stock.values()),
+        'categories': sorted(categories.values(), key=lambda entry: (-entry['count'], entry['name'])),
+        'stock': {'in_stock': stock['in_stock'], 'out_of_stock': stock['out_of_stock']},
+        'price': [
+            {'min': str(bound), 'max': str(bounds[bucket + 1]) if bucket + 1 < len(bounds) else None, 'count': prices[bucket]}
+            for bucket, bound in enumerate(bounds)
+        ],
+    }
+
+
+def product_facets(queryset, params):
+    """Facets of the products of `queryset`, the product list filtered by `params`."""
+    filters = _cell_filters(params)
+    if filters is not None:
+        cells = ProductFacetCount.objects.filter(count__gt=0)
+        if 'category' in filters:
+            cells = cells.filter(category_id=filters['category'])
+        if 'in_stock' in filters:
+            cells = cells.filter(in_stock=filters['in_stock'])
+        rows = cells.values_list('category_id', 'category__Category_name', 'price_bucket', 'in_stock', 'count')
+    else:
+        rows = (
+            queryset.order_by()
+            .annotate(price_bucket=price_bucket_expression())
+            .values_list('category_id', 'category__Category_name', 'price_bucket', 'in_stock')
+            .annotate(count=Count('pk'))
+        )
+    return _summarize(rows)
@@ -0,0 +1,135 @@
+"""Read-only fast path for list endpoints.
+
+`row_mapper(serializer_class)` compiles a serializer's readable fields once
+into the `.values()` columns they read and one converter per field, so a
+list can be built from plain rows without instantiating models or going
+through DRF's per-field `get_attribute()` machinery. The output is the same
+as `serializer_class(queryset, many=True).data` (as plain dicts).
+
+Only flat serializers can be compiled: plain model fields, renamed fields
+(`source='product_name'`) and primary-key relations. Nested serializers,
+method fields and dotted sources raise `ImproperlyConfigured`.
+
+Common field types get a cheap converter; any other field type falls back
+to its own `to_representation()`, so correctness never depends on the table
+below being complete.
+"""
+
+import datetime
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+
+_mappers = {}
+
+
+def _identity(value):
+    return value
+
+
+def _decimal_converter(field):
+    coerce_to_string = getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+    if not coerce_to_string or field.localize or field.normalize_output or field.decimal_places is None:
+        return field.to_representation
+    exponent = -field.decimal_places
+
+    def convert(value):
+        # database values already carry the column's scale; anything else
+        # goes through DRF's quantize
+        if value.as_tuple().exponent == exponent:
+            return f'{value:f}'
+        return field.to_representation(value)
+
+    return convert
+
+
+def _datetime_converter(field, field_timezone):
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    if (
+        field_timezone is None or output_format is None or output_format.lower() != ISO_8601
+        or hasattr(field, 'timezone')
+    ):
+        return field.to_representation
+
+    def convert(value):
+        if not isinstance(value, datetime.datetime) or not timezone.is_aware(value):
+            return field.to_representation(value)
+        value = value.astimezone(field_timezone).isoformat()
+        if value.endswith('+00:00'):
+            value = value[:-6] + 'Z'
+        return value
+
+    return convert
+
+
+def _converter(field, field_timezone):
+    if isinstance(field, serializers.PrimaryKeyRelatedField):
+        # .values() already returns the related pk
+        return _identity if field.pk_field is None else field.pk_field.to_representation
+    if isinstance(field, serializers.UUIDField) and field.uuid_format == 'hex_verbose':
+        return str
+    if isinstance(field, serializers.BooleanField):
+        return bool
+    if isinstance(field, serializers.IntegerField):
+        return int
+    if isinstance(field, serializers.CharField):
+        return str
+    if isinstance(field, serializers.DecimalField):
+        return _decimal_converter(field)
+    if isinstance(field, serializers.DateTimeField):
+        return _datetime_converter(field, field_timezone)
+    return field.to_representation
+
+
+class RowMapper:
+    """Turn `.values(*columns)` rows into a serializer's output."""
+
+    def __init__(self, serializer_class):
+        self.fields = []
+        for name, field in serializer_class().fields.items():
+            if field.write_only:
+                continue
+            if (
+                isinstance(field, (serializers.BaseSerializer, serializers.SerializerMethodField,
+                                   serializers.ManyRelatedField, serializers.HyperlinkedRelatedField))
+                or field.source == '*' or '.' in field.source
+            ):
+                raise ImproperlyConfigured(
+                    f'{serializer_class.__name__}.{name} cannot be read from .values() rows'
+                )
+            self.fields.append((name, field))
+        self.columns = tuple(dict.fromkeys(field.source for _, field in self.fields))
+        self._specs = {}
+
+    def _spec(self):
+        # datetimes are rendered in the active timezone, which can change per
+        # request; converters are built once per timezone rather than looking
+        # it up for every value
+        field_timezone = timezone.get_current_timezone() if settings.USE_TZ else None
+        spec = self._specs.get(field_timezone)
+        if spec is None:
+            spec = self._specs[field_timezone] = [
+                (name, field.source, _converter(field, field_timezone)) for name, field in self.fields
+            ]
+        return spec
+
+    def map_rows(self, rows):
+        spec = self._spec()
+        return [
+            {
+                name: None if (value := row[source]) is None else convert(value)
+                for name, source, convert in spec
+            }
+            for row in rows
+        ]
+
+
+def row_mapper(serializer_class):
+    """Return the (cached) `RowMapper` compiled for `serializer_class`."""
+    mapper = _mappers.get(serializer_class)
+    if mapper is None:
+        mapper = _mappers[serializer_class] = RowMapper(serializer_class)
+    return mapper
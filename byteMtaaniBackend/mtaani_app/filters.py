@@ -1,6 +1,7 @@
 import django_filters
 from django.contrib.auth import get_user_model
-from mtaani_app.models import Product, Order
+from mtaani_app.models import Product, Order, Payment
+from mtaani_app.search import search_products
 
 User = get_user_model()
 
@@ -21,7 +22,11 @@ class CustomerFilter(django_filters.FilterSet):
 
 
 class ProductFilter(django_filters.FilterSet):
-    name = django_filters.CharFilter(field_name='name', lookup_expr='icontains')
+    # full-text, best matches first (see mtaani_app/search.py)
+    search = django_filters.CharFilter(method='filter_search')
+    name = django_filters.CharFilter(method='filter_name')
+    category = django_filters.UUIDFilter(field_name='category_id')
+    in_stock = django_filters.BooleanFilter(field_name='in_stock')
     price__gte = django_filters.NumberFilter(field_name='price', lookup_expr='gte')
     price__lte = django_filters.NumberFilter(field_name='price', lookup_expr='lte')
     stock__gte = django_filters.NumberFilter(field_name='stock', lookup_expr='gte')
@@ -29,7 +34,13 @@ class ProductFilter(django_filters.FilterSet):
 
     class Meta:
         model = Product
-        fields = ['name', 'price__gte', 'price__lte', 'stock__gte', 'stock__lte']
+        fields = ['search', 'name', 'category', 'in_stock', 'price__gte', 'price__lte', 'stock__gte', 'stock__lte']
+
+    def filter_search(self, queryset, name, value):
+        return search_products(queryset, value)
+
+    def filter_name(self, queryset, name, value):
+        return search_products(queryset, value, name_only=True)
 
 
 class OrderFilter(django_filters.FilterSet):
@@ -48,4 +59,22 @@ class OrderFilter(django_filters.FilterSet):
         return queryset.filter(user__username__icontains=value)
 
     def filter_product_name(self, queryset, name, value):
-        return queryset.filter(items__product__name__icontains=value).distinct()
+        return queryset.filter(items__product__product_name__icontains=value).distinct()
+
+
+class PaymentFilter(django_filters.FilterSet):
+    amount__gte = django_filters.NumberFilter(field_name='amount', lookup_expr='gte')
+    amount__lte = django_filters.NumberFilter(field_name='amount', lookup_expr='lte')
+    created_at__gte = django_filters.IsoDateTimeFilter(field_name='created_at', lookup_expr='gte')
+    created_at__lte = django_filters.IsoDateTimeFilter(field_name='created_at', lookup_expr='lte')
+    paid_at__gte = django_filters.IsoDateTimeFilter(field_name='paid_at', lookup_expr='gte')
+    paid_at__lte = django_filters.IsoDateTimeFilter(field_name='paid_at', lookup_expr='lte')
+    status = django_filters.ChoiceFilter(choices=Payment.STATUS_CHOICES)
+    method = django_filters.ChoiceFilter(choices=Payment.METHOD_CHOICES)
+
+    class Meta:
+        model = Payment
+        fields = [
+            'amount__gte', 'amount__lte', 'created_at__gte', 'created_at__lte', 'paid_at__gte', 'paid_at__lte',
+            'status', 'method',
+        ]
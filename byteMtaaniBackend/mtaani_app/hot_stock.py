@@ -0,0 +1,296 @@
+"""Redis-backed stock counters for flash-sale ("hot") SKUs.
+
+Products flagged with `Product.is_hot_sku` can have their available stock
+held in Redis so checkouts reserve them with an atomic Lua decrement instead
+of queueing on the product row lock. The database is updated write-behind:
+
+- ``inventory:hot:stock:<id>`` holds the units still available.
+- ``inventory:hot:pending`` is a hash of id -> units reserved in Redis that
+  have not been written to `Product.stock` yet.
+- ``inventory:hot:skus`` is the set of ids that currently have a counter.
+
+`reconcile()` (run by the `reconcile_hot_stock` Celery beat task) moves the
+pending units to the database in batches and compares each counter with the
+database afterwards; any difference (a restock made in the admin, a lost
+write) is logged, counted and corrected on the counter with INCRBY so that
+reservations made in the meantime are kept. `rebuild_counters()` (the
+`rebuild_hot_stock` management command) recreates the counters from the
+database and must be run after changing which products are flagged.
+
+Everything here is disabled unless `INVENTORY_HOT_SKUS_ENABLED` is set and
+the default cache is django_redis; when Redis errors out during a
+reservation the cart falls back to the database path.
+"""
+
+import logging
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+from django_redis import get_redis_connection
+
+from . import metrics
+from .inventory import (
+    HOT_DRIFT_METRIC, HOT_FLUSHED_METRIC, InsufficientStock, aggregate_quantities, apply_stock_deltas, reject,
+)
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+STOCK_KEY = 'inventory:hot:stock:{}'
+PENDING_KEY = 'inventory:hot:pending'
+REGISTRY_KEY = 'inventory:hot:skus'
+
+# KEYS[1] pending hash, KEYS[2..n+1] stock counters
+# ARGV[1..n] quantities, ARGV[n+1..2n] product ids
+# Products without a counter are left alone. Returns {0, i} when product i
+# can't cover its quantity (nothing is reserved), otherwise {1, i, j, ...}
+# listing the products that were reserved.
+RESERVE_SCRIPT = """
+local n = #KEYS - 1
+local hot = {}
+for i = 1, n do
+  local available = redis.call('GET', KEYS[i + 1])
+  if available then
+    if tonumber(available) < tonumber(ARGV[i]) then
+      return {0, i}
+    end
+    hot[#hot + 1] = i
+  end
+end
+for _, i in ipairs(hot) do
+  redis.call('DECRBY', KEYS[i + 1], ARGV[i])
+  redis.call('HINCRBY', KEYS[1], ARGV[n + i], ARGV[i])
+end
+return {1, unpack(hot)}
+"""
+
+# Same key/argument layout as RESERVE_SCRIPT; gives the units back.
+RELEASE_SCRIPT = """
+local n = #KEYS - 1
+for i = 1, n do
+  if redis.call('EXISTS', KEYS[i + 1]) == 1 then
+    redis.call('INCRBY', KEYS[i + 1], ARGV[i])
+  end
+  redis.call('HINCRBY', KEYS[1], ARGV[n + i], -tonumber(ARGV[i]))
+end
+return n
+"""
+
+# KEYS[1] pending hash, KEYS[2..n+1] stock counters, ARGV[1..n] product ids
+# Takes the pending units of each product and snapshots its counter in one
+# atomic step. Returns {pending_1, counter_1, pending_2, counter_2, ...} with
+# '' for a missing counter.
+FLUSH_SCRIPT = """
+local out = {}
+for i = 1, #ARGV do
+  local pending = redis.call('HGET', KEYS[1], ARGV[i]) or '0'
+  redis.call('HDEL', KEYS[1], ARGV[i])
+  out[#out + 1] = pending
+  out[#out + 1] = redis.call('GET', KEYS[i + 1]) or ''
+end
+return out
+"""
+
+# KEYS[1] pending hash, KEYS[2] registry, KEYS[3..n+2] stock counters
+# ARGV[1..n] product ids, ARGV[n+1..2n] database stock
+# Sets each counter to database stock minus units still pending write-back.
+REBUILD_SCRIPT = """
+local n = #ARGV / 2
+for i = 1, n do
+  local pending = tonumber(redis.call('HGET', KEYS[1], ARGV[i]) or '0')
+  redis.call('SET', KEYS[i + 2], tonumber(ARGV[n + i]) - pending)
+  redis.call('SADD', KEYS[2], ARGV[i])
+end
+return n
+"""
+
+_scripts = {}
+
+
+def _script(conn, source):
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = conn.register_script(source)
+    return script
+
+
+def get_connection():
+    """Return the raw Redis client, or None when hot-SKU counters are disabled."""
+    if not getattr(settings, 'INVENTORY_HOT_SKUS_ENABLED', False):
+        return None
+    try:
+        return get_redis_connection('default')
+    except NotImplementedError:
+        # cache backend is not django_redis
+        return None
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _reserve(conn, wanted):
+    pids = list(wanted)
+    keys = [PENDING_KEY] + [STOCK_KEY.format(pid) for pid in pids]
+    args = [wanted[pid] for pid in pids] + [str(pid) for pid in pids]
+    result = _script(conn, RESERVE_SCRIPT)(keys=keys, args=args, client=conn)
+    if int(result[0]) == 0:
+        raise reject(pids[int(result[1]) - 1])
+    return {pids[int(i) - 1]: wanted[pids[int(i) - 1]] for i in result[1:]}
+
+
+def _release(conn, reserved):
+    pids = list(reserved)
+    keys = [PENDING_KEY] + [STOCK_KEY.format(pid) for pid in pids]
+    args = [reserved[pid] for pid in pids] + [str(pid) for pid in pids]
+    _script(conn, RELEASE_SCRIPT)(keys=keys, args=args, client=conn)
+
+
+@contextmanager
+def hot_reservation(items):
+    """Reserve the cart's hot SKUs in Redis for the duration of the block.
+
+    Yields the set of product ids that were reserved in Redis; the caller
+    reserves the remaining products in the database (see
+    `inventory.reserve_stock(skip=...)`). Raises `InsufficientStock` on entry
+    when a hot SKU can't cover its quantity. If the block raises (including
+    a failed commit of a transaction opened inside it) the units are given
+    back.
+    """
+    conn = get_connection()
+    wanted = aggregate_quantities(items)
+    reserved = {}
+    if conn is not None and wanted:
+        try:
+            reserved = _reserve(conn, wanted)
+        except InsufficientStock:
+            raise
+        except Exception:
+            logger.exception('Hot-SKU reservation failed; falling back to database reservation')
+            reserved = {}
+
+    try:
+        yield set(reserved)
+    except BaseException:
+        if reserved:
+            try:
+                _release(conn, reserved)
+            except Exception:
+                # the counters now under-report by these units; the next
+                # reconcile() detects and corrects the drift
+                logger.exception('Failed to release hot-SKU reservation %s', reserved)
+        raise
+
+
+def _chunks(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _reconcile_chunk(conn, pids):
+    keys = [PENDING_KEY] + [STOCK_KEY.format(pid) for pid in pids]
+    flat = _script(conn, FLUSH_SCRIPT)(keys=keys, args=pids, client=conn)
+
+    deltas = {}
+    counters = {}
+    for pid, pending, counter in zip(pids, flat[0::2], flat[1::2]):
+        if int(pending):
+            deltas[pid] = int(pending)
+        counter = _decode(counter)
+        if counter != '':
+            counters[pid] = int(counter)
+
+    try:
+        with transaction.atomic():
+            apply_stock_deltas(deltas)
+            db_stock = dict(Product.objects.filter(pk__in=pids).values_list('pk', 'stock'))
+    except Exception:
+        # put the taken units back so the next run writes them
+        pipe = conn.pipeline()
+        for pid, delta in deltas.items():
+            pipe.hincrby(PENDING_KEY, pid, delta)
+        pipe.execute()
+        raise
+
+    db_stock = {str(pk): stock for pk, stock in db_stock.items()}
+    flushed = sum(deltas.values())
+    if flushed:
+        metrics.incr(HOT_FLUSHED_METRIC, flushed)
+
+    pipe = conn.pipeline()
+    drifted = 0
+    for pid, counter in counters.items():
+        if pid not in db_stock:
+            # product was deleted
+            pipe.delete(STOCK_KEY.format(pid))
+            pipe.srem(REGISTRY_KEY, pid)
+            continue
+        # every unit reserved up to the snapshot is now in the database, so
+        # the snapshot must equal the database value
+        drift = db_stock[pid] - counter
+        if drift:
+            drifted += 1
+            logger.warning('Hot-SKU counter for product %s drifted by %s units; correcting', pid, drift)
+            pipe.incrby(STOCK_KEY.format(pid), drift)
+    pipe.execute()
+    if drifted:
+        metrics.incr(HOT_DRIFT_METRIC, drifted)
+    return flushed, drifted
+
+
+def reconcile(batch_size=None):
+    """Write pending hot-SKU reservations back to `Product` and correct drift.
+
+    Returns a summary dict; does nothing when hot-SKU counters are disabled.
+    """
+    conn = get_connection()
+    if conn is None:
+        return {'enabled': False}
+    batch_size = batch_size or getattr(settings, 'INVENTORY_HOT_SYNC_BATCH_SIZE', 500)
+
+    pids = {_decode(p) for p in conn.smembers(REGISTRY_KEY)}
+    pids.update(_decode(p) for p in conn.hkeys(PENDING_KEY))
+    flushed = drifted = 0
+    for chunk in _chunks(sorted(pids), batch_size):
+        chunk_flushed, chunk_drifted = _reconcile_chunk(conn, chunk)
+        flushed += chunk_flushed
+        drifted += chunk_drifted
+    return {'enabled': True, 'products': len(pids), 'flushed_units': flushed, 'drift_corrections': drifted}
+
+
+def rebuild_counters(batch_size=None):
+    """Recreate the counters of every flagged product from the database.
+
+    Pending units are written back first. Counters of products that are no
+    longer flagged are removed. Returns a summary dict.
+    """
+    conn = get_connection()
+    if conn is None:
+        return {'enabled': False}
+    batch_size = batch_size or getattr(settings, 'INVENTORY_HOT_SYNC_BATCH_SIZE', 500)
+
+    reconcile(batch_size)
+
+    flagged = [
+        (str(pk), stock)
+        for pk, stock in Product.objects.filter(is_hot_sku=True).order_by('pk').values_list('pk', 'stock')
+    ]
+    for chunk in _chunks(flagged, batch_size):
+        pids = [pid for pid, _ in chunk]
+        keys = [PENDING_KEY, REGISTRY_KEY] + [STOCK_KEY.format(pid) for pid in pids]
+        _script(conn, REBUILD_SCRIPT)(keys=keys, args=pids + [stock for _, stock in chunk], client=conn)
+
+    registered = {_decode(p) for p in conn.smembers(REGISTRY_KEY)}
+    stale = sorted(registered - {pid for pid, _ in flagged})
+    for chunk in _chunks(stale, batch_size):
+        # remove the counters first so no new reservation lands on them,
+        # then write back whatever they had pending
+        pipe = conn.pipeline()
+        for pid in chunk:
+            pipe.delete(STOCK_KEY.format(pid))
+            pipe.srem(REGISTRY_KEY, pid)
+        pipe.execute()
+        _reconcile_chunk(conn, chunk)
+
+    return {'enabled': True, 'counters': len(flagged), 'removed': len(stale)}
@@ -0,0 +1,253 @@
+"""Stock reservation helpers used by order creation.
+
+Reserving a cart used to cost one locking SELECT, one full `Product.save()`
+and one `OrderItem` INSERT per line. The helpers here lock every product of
+the cart with a single query (always in primary-key order so two carts that
+share products can't deadlock each other) and apply all decrements with one
+conditional UPDATE.
+
+Two reservation modes are available, selected by the
+`INVENTORY_RESERVATION_MODE` setting:
+
+- ``locking`` (default): `SELECT ... FOR UPDATE` the cart, validate, update.
+- ``optimistic``: skip the locking read and rely on the conditional
+  `UPDATE ... WHERE stock >= qty` alone, retrying lock conflicts a bounded
+  number of times. Retries and rejections are recorded in `metrics` so hot
+  SKUs show up in `/inventory-metrics/`.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import OperationalError, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.http import Http404
+from django.utils import timezone
+
+from . import catalog_cache, facets, metrics
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+RETRIES_METRIC = 'inventory.retries'
+REJECTED_METRIC = 'inventory.rejected'
+CONTENTION_RANKING = 'inventory.contention'
+HOT_DRIFT_METRIC = 'inventory.hot.drift'
+HOT_FLUSHED_METRIC = 'inventory.hot.flushed_units'
+
+
+class _PartialUpdate(Exception):
+    """Internal: the cart-wide UPDATE didn't cover every product."""
+
+
+class InsufficientStock(Exception):
+    """Raised when a product can't cover the quantity requested for it."""
+
+    def __init__(self, product_id):
+        self.product_id = product_id
+        super().__init__(f"Product {product_id} out of stock or insufficient quantity")
+
+
+def aggregate_quantities(items):
+    """Return an ordered mapping of product id -> total requested quantity.
+
+    A cart may list the same product on several lines; stock has to be checked
+    against the sum, not line by line.
+    """
+    wanted = OrderedDict()
+    for item in items:
+        pid = item.get('product_id')
+        qty = item.get('quantity', 1)
+        wanted[pid] = wanted.get(pid, 0) + qty
+    return wanted
+
+
+def _decrement_statement(wanted, guarded=True):
+    """Build the (filter, update kwargs) pair that decrements every product at once.
+
+    With `guarded` the WHERE clause repeats the `stock >= qty` guard per
+    product so the statement only touches rows that can still cover their
+    quantity; the caller compares the affected row count with the number of
+    products. Negative quantities add stock back.
+    """
+    guard = Q()
+    stock_whens = []
+    in_stock_whens = []
+    for pid, qty in wanted.items():
+        guard |= Q(pk=pid, stock__gte=qty) if guarded else Q(pk=pid)
+        stock_whens.append(When(pk=pid, then=F('stock') - qty))
+        in_stock_whens.append(When(pk=pid, stock__gt=qty, then=Value(True)))
+
+    # `in_stock` is listed before `stock`: MySQL evaluates SET assignments left
+    # to right, so this keeps it reading the pre-decrement value like Postgres
+    # and SQLite do.
+    updates = {
+        'in_stock': Case(*in_stock_whens, default=Value(False)),
+        'stock': Case(*stock_whens, default=F('stock')),
+        'updated_at': timezone.now(),
+    }
+    return guard, updates
+
+
+def apply_stock_deltas(deltas):
+    """Subtract `deltas` (product id -> units) from stock in one unguarded UPDATE.
+
+    Used to write back reservations that were already validated elsewhere
+    (see `hot_stock`). Returns the number of rows updated.
+    """
+    if not deltas:
+        return 0
+    guard, updates = _decrement_statement(deltas, guarded=False)
+    updated = Product.objects.filter(guard).update(**updates)
+    facets.stock_changed(deltas)
+    transaction.on_commit(lambda: catalog_cache.refresh_stock(list(deltas)))
+    return updated
+
+
+def reject(pid):
+    """Record a rejected reservation for `pid` and return the exception to raise."""
+    metrics.incr(REJECTED_METRIC)
+    metrics.incr_ranked(CONTENTION_RANKING, pid)
+    return InsufficientStock(pid)
+
+
+def reserve_stock(items, skip=()):
+    """Decrement stock for every line of a cart.
+
+    Must be called inside `transaction.atomic()`. Returns a list of
+    `(product, quantity)` tuples in cart order, where `product` carries the
+    product's price and post-reservation stock. Raises `Http404` for unknown
+    products and `InsufficientStock` when a product can't cover its quantity;
+    the surrounding transaction must then be rolled back (raising out of the
+    atomic block does that).
+
+    Products whose ids are in `skip` were already reserved elsewhere (the
+    Redis hot-SKU counters); they are only read, never locked or decremented.
+    """
+    wanted = aggregate_quantities(items)
+    if not wanted:
+        return []
+
+    cold = OrderedDict((pid, qty) for pid, qty in wanted.items() if pid not in skip)
+    products = {}
+    if cold:
+        mode = getattr(settings, 'INVENTORY_RESERVATION_MODE', 'locking')
+        if mode == 'optimistic':
+            products.update(_reserve_optimistically(cold))
+        else:
+            products.update(_reserve_with_locks(cold))
+        # bulk UPDATEs skip Product.save() signals; patch cached stock and facets ourselves
+        facets.stock_changed(cold)
+        transaction.on_commit(lambda: catalog_cache.refresh_stock(list(cold)))
+    if len(cold) != len(wanted):
+        products.update(Product.objects.only('id', 'price', 'stock', 'in_stock').in_bulk(
+            [pid for pid in wanted if pid in skip]
+        ))
+        if len(products) != len(wanted):
+            raise Http404('No Product matches the given query.')
+
+    return [(products[item.get('product_id')], item.get('quantity', 1)) for item in items]
+
+
+def _reserve_with_locks(wanted):
+    """Lock the cart's rows, validate every quantity, then decrement in one UPDATE."""
+    products = {
+        p.pk: p
+        for p in Product.objects.select_for_update().filter(pk__in=list(wanted)).order_by('pk')
+    }
+    for pid, qty in wanted.items():
+        product = products.get(pid)
+        if product is None:
+            raise Http404('No Product matches the given query.')
+        if product.stock < qty:
+            raise reject(product.pk)
+
+    guard, updates = _decrement_statement(wanted)
+    try:
+        with transaction.atomic():
+            if Product.objects.filter(guard).update(**updates) != len(wanted):
+                raise _PartialUpdate()
+    except _PartialUpdate:
+        # rows are locked, so this only happens if stock was changed outside
+        # of this transaction's view; refuse rather than oversell, naming the
+        # product that can't cover its quantity now
+        stock = {
+            str(pk): value
+            for pk, value in Product.objects.filter(pk__in=list(wanted)).values_list('pk', 'stock')
+        }
+        short = [pid for pid, qty in wanted.items() if stock.get(str(pid), 0) < qty]
+        raise reject(short[0] if short else next(iter(wanted)))
+
+    for pid, qty in wanted.items():
+        product = products[pid]
+        product.stock -= qty
+        product.in_stock = product.stock > 0
+    return products
+
+
+def _reserve_optimistically(wanted):
+    """Decrement without a locking read.
+
+    The whole cart is first attempted as one conditional UPDATE inside a
+    savepoint. If any product can't be covered the savepoint is rolled back
+    and products are decremented one at a time (in primary-key order, so
+    concurrent carts take row locks in the same order) to find out which one
+    failed, retrying lock conflicts up to `INVENTORY_OPTIMISTIC_MAX_RETRIES`.
+    """
+    guard, updates = _decrement_statement(wanted)
+    try:
+        with transaction.atomic():
+            if Product.objects.filter(guard).update(**updates) != len(wanted):
+                raise _PartialUpdate()
+    except (_PartialUpdate, OperationalError):
+        for pid in sorted(wanted, key=str):
+            _decrement_one(pid, wanted[pid])
+
+    products = Product.objects.only('id', 'price', 'stock', 'in_stock').in_bulk(list(wanted))
+    if len(products) != len(wanted):
+        raise Http404('No Product matches the given query.')
+    return products
+
+
+def _decrement_one(pid, qty):
+    max_retries = getattr(settings, 'INVENTORY_OPTIMISTIC_MAX_RETRIES', 3)
+    guard, updates = _decrement_statement({pid: qty})
+    attempt = 0
+    while True:
+        try:
+            with transaction.atomic():
+                if Product.objects.filter(guard).update(**updates):
+                    return
+        except OperationalError:
+            # lock wait timeout / deadlock victim / serialization failure
+            logger.warning('Conflict decrementing stock of product %s (attempt %s)', pid, attempt + 1)
+        else:
+            current = Product.objects.filter(pk=pid).values_list('stock', flat=True).first()
+            if current is None:
+                raise Http404('No Product matches the given query.')
+            if current < qty:
+                raise reject(pid)
+            # enough stock now: a concurrent writer changed the row between
+            # our statement and the re-read, so the attempt is worth repeating
+
+        attempt += 1
+        if attempt > max_retries:
+            raise reject(pid)
+        metrics.incr(RETRIES_METRIC)
+        metrics.incr_ranked(CONTENTION_RANKING, pid)
+        time.sleep(0.005 * attempt)
+
+
+def get_inventory_metrics():
+    """Return reservation retry/rejection counters and the most contended products."""
+    data = metrics.get_counters([RETRIES_METRIC, REJECTED_METRIC, HOT_DRIFT_METRIC, HOT_FLUSHED_METRIC])
+    return {
+        'mode': getattr(settings, 'INVENTORY_RESERVATION_MODE', 'locking'),
+        'retries': data[RETRIES_METRIC],
+        'rejected': data[REJECTED_METRIC],
+        'hot_sku_drift_corrections': data[HOT_DRIFT_METRIC],
+        'hot_sku_flushed_units': data[HOT_FLUSHED_METRIC],
+        'hot_products': metrics.top_ranked(CONTENTION_RANKING),
+    }
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from mtaani_app.models import Payment
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill checkout_request_id and mpesa_receipt_number of payments created before those columns existed, "
+        "from the legacy transaction_id."
+    )
+
+    def handle(self, *args, **options):
+        legacy = Payment.objects.filter(method='mpesa', transaction_id__isnull=False)
+        # STK CheckoutRequestIDs all start with ws_CO_; anything else stored by
+        # the old callback handler on a successful payment is a receipt number
+        checkouts = legacy.filter(
+            checkout_request_id__isnull=True, transaction_id__startswith='ws_CO_',
+        ).update(checkout_request_id=F('transaction_id'))
+        receipts = legacy.filter(
+            status='successful', mpesa_receipt_number__isnull=True,
+        ).exclude(transaction_id__startswith='ws_CO_').update(mpesa_receipt_number=F('transaction_id'))
+        self.stdout.write(self.style.SUCCESS(
+            f"Backfilled {checkouts} checkout request ids and {receipts} receipt numbers."
+        ))
@@ -0,0 +1,35 @@
+from argparse import ArgumentTypeError
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from mtaani_app.rollups import rebuild, record_pending
+
+
+def _date(value):
+    parsed = parse_date(value)
+    if parsed is None:
+        raise ArgumentTypeError(f'dates are YYYY-MM-DD, got {value!r}')
+    return parsed
+
+
+class Command(BaseCommand):
+    help = (
+        "Add the successful payments not yet counted to the hourly/daily sales rollups "
+        "(all of them after the first migration), or recount a range of days with --rebuild."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Recount the rollups from the payments.')
+        parser.add_argument('--since', type=_date, help='First day to recount (YYYY-MM-DD, with --rebuild).')
+        parser.add_argument('--until', type=_date, help='Day after the last one to recount (with --rebuild).')
+        parser.add_argument('--batch-size', type=int, default=None, help='Payments per transaction.')
+
+    def handle(self, *args, **options):
+        if (options['since'] or options['until']) and not options['rebuild']:
+            raise CommandError('--since and --until select the days to --rebuild.')
+        if options['rebuild']:
+            count = rebuild(options['since'], options['until'], options['batch_size'])
+        else:
+            count = record_pending(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rolled up {count} payments."))
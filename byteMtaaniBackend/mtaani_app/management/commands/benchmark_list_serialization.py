@@ -0,0 +1,93 @@
+import time
+import uuid
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from mtaani_app.fast_serializers import row_mapper
+from mtaani_app.models import Category, Product
+from mtaani_app.renderers import FastJSONRenderer
+from mtaani_app.serializers import CategorySerializer, ProductSerializer
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare ModelSerializer + JSONRenderer with the .values() row mapper + FastJSONRenderer "
+        "on the product and category lists, and check both produce the same bytes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows', type=int, default=0,
+            help='Create this many synthetic products (and rows/100 categories) for the run; rolled back afterwards.',
+        )
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per path; the best time is reported.')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                if options['rows']:
+                    self._create_rows(options['rows'])
+                self._benchmark(Product, ProductSerializer, options['repeat'])
+                self._benchmark(Category, CategorySerializer, options['repeat'])
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def _create_rows(self, count):
+        categories = Category.objects.bulk_create(
+            Category(Category_name=f'Benchmark {n} {uuid.uuid4().hex[:8]}', url_key=f'benchmark-{uuid.uuid4().hex}')
+            for n in range(max(1, count // 100))
+        )
+        Product.objects.bulk_create(
+            (
+                Product(
+                    product_name=f'Benchmark product {n}',
+                    description='Synthetic row created by benchmark_list_serialization',
+                    price=Decimal(n % 5000) + Decimal('0.99'),
+                    stock=n % 50,
+                    in_stock=bool(n % 50),
+                    category=categories[n % len(categories)],
+                )
+                for n in range(count)
+            ),
+            batch_size=1000,
+        )
+
+    def _time(self, func, repeat):
+        best, result = None, None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
+
+    def _benchmark(self, model, serializer_class, repeat):
+        queryset = model.objects.order_by('created_at', 'pk')
+        mapper = row_mapper(serializer_class)
+        renderer, fast_renderer = JSONRenderer(), FastJSONRenderer()
+
+        def serializer_path():
+            return renderer.render(serializer_class(serializer_class.setup_eager_loading(queryset), many=True).data)
+
+        def fast_path():
+            return fast_renderer.render(mapper.map_rows(queryset.values(*mapper.columns)))
+
+        rows = queryset.count()
+        slow, expected = self._time(serializer_path, repeat)
+        fast, actual = self._time(fast_path, repeat)
+        if actual != expected:
+            raise CommandError(f'{model.__name__}: fast path output differs from the serializer output')
+
+        self.stdout.write(
+            f'{model.__name__} ({rows} rows, {len(expected)} bytes): '
+            f'serializer {slow * 1000:.1f} ms, fast path {fast * 1000:.1f} ms, '
+            f'{slow / fast if fast else float("inf"):.1f}x'
+        )
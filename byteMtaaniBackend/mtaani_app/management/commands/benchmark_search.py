@@ -0,0 +1,112 @@
+import time
+import uuid
+from decimal import Decimal
+from functools import reduce
+from operator import and_
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from mtaani_app import search
+from mtaani_app.models import Category, Product
+
+BRANDS = ['samsung', 'tecno', 'infinix', 'nokia', 'oppo', 'xiaomi', 'itel', 'huawei', 'apple', 'realme']
+ITEMS = ['phone', 'charger', 'case', 'earphones', 'tablet', 'speaker', 'cable', 'watch', 'powerbank', 'screen']
+COLOURS = ['black', 'white', 'blue', 'red', 'green', 'gold', 'silver']
+DEFAULT_QUERIES = ['samsung', 'sam pho', 'black charger', 'infinix tablet blue', 'nothingmatches']
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare product search (tsvector on PostgreSQL, the in-process index elsewhere) "
+        "with an icontains (LIKE) scan over name, category and description."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows', type=int, default=0,
+            help='Create this many synthetic products (and rows/1000 categories) for the run; rolled back afterwards.',
+        )
+        parser.add_argument('--query', action='append', dest='queries', help='Search text (repeatable).')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per query; the best time is reported.')
+        parser.add_argument('--limit', type=int, default=50, help='Results fetched per query (one page).')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                if options['rows']:
+                    self._create_rows(options['rows'])
+                self._benchmark(options['queries'] or DEFAULT_QUERIES, options['repeat'], options['limit'])
+                raise _Rollback
+        except _Rollback:
+            pass
+        if options['rows'] and not search.uses_postgres():
+            # drop this process's index of the rolled back rows
+            search.bump_version()
+
+    def _create_rows(self, count):
+        categories = Category.objects.bulk_create(
+            Category(Category_name=f'{ITEMS[n % len(ITEMS)]} {n} {uuid.uuid4().hex[:8]}', url_key=f'benchmark-{uuid.uuid4().hex}')
+            for n in range(max(1, count // 1000))
+        )
+        Product.objects.bulk_create(
+            (
+                Product(
+                    product_name=f'{BRANDS[n % 10]} {ITEMS[n // 10 % 10]} {n}',
+                    description=f'{COLOURS[n % 7]} {ITEMS[n // 100 % 10]}, synthetic row created by benchmark_search',
+                    price=Decimal(n % 5000) + Decimal('0.99'),
+                    stock=n % 50,
+                    in_stock=bool(n % 50),
+                    category=categories[n % len(categories)],
+                )
+                for n in range(count)
+            ),
+            batch_size=1000,
+        )
+
+    def _time(self, func, repeat):
+        best, result = None, None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
+
+    def _like(self, text):
+        return Product.objects.filter(reduce(and_, (
+            Q(product_name__icontains=term) | Q(category__Category_name__icontains=term) | Q(description__icontains=term)
+            for term in search.tokenize(text)
+        ))).order_by('-created_at', '-pk')
+
+    def _benchmark(self, queries, repeat, limit):
+        rows = Product.objects.count()
+        started = time.perf_counter()
+        if search.uses_postgres():
+            search.rebuild_index()
+            backend = 'tsvector'
+            self.stdout.write(f'Indexed {rows} products in {(time.perf_counter() - started) * 1000:.1f} ms')
+        else:
+            search.bump_version()
+            search.get_index()
+            backend = 'in-process index'
+            self.stdout.write(f'Built the in-process index of {rows} products in {(time.perf_counter() - started) * 1000:.1f} ms')
+
+        for text in queries:
+            if not search.tokenize(text):
+                continue
+            like, like_pks = self._time(lambda: list(self._like(text).values_list('pk', flat=True)[:limit]), repeat)
+            found, found_pks = self._time(
+                lambda: list(search.search_products(Product.objects.all(), text).values_list('pk', flat=True)[:limit]),
+                repeat,
+            )
+            self.stdout.write(
+                f'{text!r}: LIKE {like * 1000:.1f} ms ({len(like_pks)} rows), '
+                f'{backend} {found * 1000:.1f} ms ({len(found_pks)} rows), '
+                f'{like / found if found else float("inf"):.1f}x'
+            )
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mtaani_app import dispatch
+from mtaani_app.callback_stream import consumer_name, drain
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply the M-Pesa callbacks queued on the Redis stream. Runs until interrupted, blocked on the "
+        "stream between batches; start several for more throughput."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.MPESA_CALLBACK_DRAIN_BATCH_SIZE)
+        parser.add_argument('--block', type=int, default=5000, help='Milliseconds to wait for new callbacks.')
+        parser.add_argument('--once', action='store_true', help='Drain what is queued now and exit.')
+
+    def handle(self, *args, **options):
+        consumer = consumer_name()
+        try:
+            while True:
+                totals = drain(
+                    consumer, batch_size=options['batch_size'],
+                    block_ms=None if options['once'] else options['block'],
+                )
+                # publish the tasks the batch dispatched (confirmation emails)
+                dispatch.flush()
+                if totals['skipped']:
+                    raise CommandError('Callback queue needs the django_redis cache backend (set REDIS_URL).')
+                if totals['read']:
+                    self.stdout.write(
+                        f"{totals['read']} callbacks: {totals['applied']} applied, "
+                        f"{totals['unknown']} unknown, {totals['invalid']} invalid"
+                    )
+                if options['once']:
+                    return
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mtaani_app.exports import EXPORTS, FORMATS, ExportFilterError, filtered, stream
+
+
+class Command(BaseCommand):
+    help = "Stream orders or payments to a CSV/NDJSON file, selected with the API list filters."
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(EXPORTS))
+        parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+        parser.add_argument('--output', '-o', default='-', help="Destination file ('-' for standard output).")
+        parser.add_argument(
+            '--filter', action='append', default=[], metavar='NAME=VALUE',
+            help='OrderFilter/PaymentFilter parameter, e.g. order_date__gte=2024-05-01T00:00:00Z (repeatable).',
+        )
+        parser.add_argument('--chunk-size', type=int, default=None, help='Rows per database round trip.')
+
+    def handle(self, *args, **options):
+        params = {}
+        for item in options['filter']:
+            name, sep, value = item.partition('=')
+            if not sep:
+                raise CommandError(f'Filters are NAME=VALUE, got {item!r}.')
+            params[name] = value
+        try:
+            queryset = filtered(options['kind'], params)
+        except ExportFilterError as exc:
+            raise CommandError(f'Invalid filters: {dict(exc.errors)}')
+
+        chunks = stream(options['kind'], queryset, options['format'], options['chunk_size'])
+        if options['output'] == '-':
+            for chunk in chunks:
+                self.stdout.write(chunk.decode(), ending='')
+            return
+        with open(options['output'], 'wb') as output:
+            for chunk in chunks:
+                output.write(chunk)
+        self.stderr.write(self.style.SUCCESS(f"Exported {options['kind']} to {options['output']}."))
@@ -0,0 +1,37 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mtaani_app.product_import import FORMATS, ImportFileError, guess_format, import_products
+
+
+class Command(BaseCommand):
+    help = "Insert or update products from a CSV or JSON (array or one object per line) file, keyed on url_key."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, or '-' for standard input.")
+        parser.add_argument('--format', choices=FORMATS, help='File format (default: from the file extension).')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Rows per upsert statement and transaction.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or guess_format(path)
+        try:
+            if path == '-':
+                result = import_products(sys.stdin.buffer, format, options['chunk_size'])
+            else:
+                with open(path, 'rb') as stream:
+                    result = import_products(stream, format, options['chunk_size'])
+        except (OSError, ImportFileError) as exc:
+            raise CommandError(str(exc))
+
+        for error in result['errors']:
+            self.stderr.write(f"Row {error['row']}: {error['error']}")
+        if result['skipped'] > len(result['errors']):
+            self.stderr.write(f"... and {result['skipped'] - len(result['errors'])} more invalid rows")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {result['rows']} rows in {result['seconds']:.1f}s ({result['rows_per_second']} rows/s): "
+            f"{result['created']} created, {result['updated']} updated, {result['skipped']} skipped."
+        ))
+        if result['hot_stock_kept']:
+            self.stdout.write(f"Stock of {result['hot_stock_kept']} hot SKUs was left to their Redis counters.")
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mtaani_app.task_results import purge_task_results
+
+
+class Command(BaseCommand):
+    help = "Delete Celery task and group results stored in the database (django_celery_results)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than', type=int, default=settings.CELERY_RESULT_PURGE_AGE,
+            help='Only results finished more than this many seconds ago (0 deletes all).',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows deleted per statement.')
+
+    def handle(self, *args, **options):
+        counts = purge_task_results(options['older_than'], batch_size=options['batch_size'])
+        if counts is None:
+            raise CommandError('django_celery_results is not installed.')
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {counts['tasks']} task results and {counts['groups']} group results."
+        ))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mtaani_app.hot_stock import rebuild_counters
+
+
+class Command(BaseCommand):
+    help = "Rebuild the Redis stock counters of hot (flash-sale) SKUs from the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Products per Redis/database batch.')
+
+    def handle(self, *args, **options):
+        result = rebuild_counters(batch_size=options['batch_size'])
+        if not result['enabled']:
+            raise CommandError(
+                'Hot-SKU counters are disabled: set INVENTORY_HOT_SKUS_ENABLED and configure the Redis cache.'
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {result['counters']} hot-SKU counters, removed {result['removed']} stale counters."
+        ))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from mtaani_app.models import Order
+from mtaani_app.read_models import rebuild_summaries
+
+
+class Command(BaseCommand):
+    help = "Recreate the denormalized order summaries from orders, items, products and payments."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Orders per batch.')
+        parser.add_argument('--since', help='Only orders created on/after this ISO date.')
+
+    def handle(self, *args, **options):
+        queryset = Order.objects.all()
+        if options['since']:
+            queryset = queryset.filter(created_at__gte=options['since'])
+        count = rebuild_summaries(queryset, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {count} order summaries."))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from mtaani_app.facets import rebuild
+
+
+class Command(BaseCommand):
+    help = "Recount the product facet cells (category x price bucket x stock state) from the products."
+
+    def handle(self, *args, **options):
+        count = rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {count} facet cells."))
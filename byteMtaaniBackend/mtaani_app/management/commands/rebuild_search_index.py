@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from mtaani_app.search import ensure_search_index, rebuild_index, uses_postgres
+
+
+class Command(BaseCommand):
+    help = "Recompute the product search vectors (PostgreSQL) or mark the in-process search indexes stale."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Products per UPDATE.')
+
+    def handle(self, *args, **options):
+        ensure_search_index()
+        count = rebuild_index(batch_size=options['batch_size'])
+        if uses_postgres():
+            self.stdout.write(self.style.SUCCESS(f"Indexed {count} products."))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Search indexes of {count} products will be rebuilt on next use."))
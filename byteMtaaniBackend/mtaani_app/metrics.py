@@ -0,0 +1,73 @@
+"""Small counters shared across workers through the configured Django cache.
+
+With the Redis cache backend the counters are global to every gunicorn and
+Celery process; with the local-memory fallback they are per process, which is
+still useful in development. Failures to record a metric are logged and never
+propagate to the caller.
+"""
+
+import logging
+
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'metrics'
+
+
+def _key(name):
+    return f'{PREFIX}:{name}'
+
+
+def incr(name, amount=1):
+    """Increment counter `name` by `amount`."""
+    key = _key(name)
+    try:
+        # add() is a no-op when the key exists, so concurrent first increments
+        # don't reset each other
+        cache.add(key, 0, None)
+        cache.incr(key, amount)
+    except Exception:
+        logger.exception('Failed to increment metric %s', name)
+
+
+def get_counters(names):
+    """Return a dict of counter name -> current value (0 when never incremented)."""
+    try:
+        values = cache.get_many([_key(n) for n in names])
+    except Exception:
+        logger.exception('Failed to read metrics %s', names)
+        values = {}
+    return {n: int(values.get(_key(n)) or 0) for n in names}
+
+
+def incr_ranked(name, member, amount=1):
+    """Increment `member`'s score in the ranking `name` (a Redis sorted set).
+
+    Rankings need Redis; without it the call is silently skipped.
+    """
+    try:
+        conn = get_redis_connection('default')
+        conn.zincrby(_key(name), amount, str(member))
+    except NotImplementedError:
+        # cache backend is not django_redis
+        pass
+    except Exception:
+        logger.exception('Failed to update ranked metric %s', name)
+
+
+def top_ranked(name, limit=10):
+    """Return the `limit` highest scoring members of ranking `name`."""
+    try:
+        conn = get_redis_connection('default')
+        rows = conn.zrevrange(_key(name), 0, limit - 1, withscores=True)
+    except NotImplementedError:
+        return []
+    except Exception:
+        logger.exception('Failed to read ranked metric %s', name)
+        return []
+    return [
+        {'member': member.decode() if isinstance(member, bytes) else member, 'score': int(score)}
+        for member, score in rows
+    ]
@@ -1,5 +1,6 @@
 import uuid
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager
 
 
@@ -53,10 +54,44 @@ class Category(models.Model):
     def __str__(self):
         return self.Category_name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # lets the search index tell a rename from other saves
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
 
 # ============================
 # Products
 # ============================
+class SearchVectorField(models.Field):
+    """A tsvector column on PostgreSQL; elsewhere an unused text column (see mtaani_app/search.py).
+
+    Declared here rather than taken from django.contrib.postgres, which needs
+    psycopg installed even when the database isn't PostgreSQL.
+    """
+
+    def db_type(self, connection):
+        return 'tsvector' if connection.vendor == 'postgresql' else 'text'
+
+
+@SearchVectorField.register_lookup
+class SearchMatches(models.Lookup):
+    """`search_vector__matches=SearchQuery(...)`: the tsvector @@ tsquery operator (PostgreSQL only).
+
+    The plain field's `exact` lookup would compile to `tsvector = tsquery`,
+    which PostgreSQL rejects.
+    """
+
+    lookup_name = 'matches'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} @@ {rhs}', (*lhs_params, *rhs_params)
+
+
 class Product(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     product_name = models.CharField(max_length=255, db_index=True)
@@ -67,9 +102,13 @@ class Product(models.Model):
     # Track numeric stock and keep boolean `in_stock` in sync for compatibility
     stock = models.IntegerField(default=0, db_index=True)
     in_stock = models.BooleanField(default=True)
+    # flash-sale SKUs whose stock is reserved through Redis counters (see hot_stock.py)
+    is_hot_sku = models.BooleanField(default=False, db_index=True)
     image_url = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # weighted name/category/description document, maintained by mtaani_app/search.py
+    search_vector = SearchVectorField(null=True, editable=False)
 
     class Meta:
         indexes = [
@@ -77,11 +116,20 @@ class Product(models.Model):
             models.Index(fields=["category"]),
             models.Index(fields=["price"]),
             models.Index(fields=["stock"]),
+            # keyset pagination order (see pagination.KeysetPagination)
+            models.Index(fields=["-created_at", "-id"]),
         ]
 
     def __str__(self):
         return self.product_name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember loaded values so signal handlers can tell which fields a save changed
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
     def save(self, *args, **kwargs):
         # keep in_stock flag consistent with numeric stock
         try:
@@ -91,6 +139,31 @@ class Product(models.Model):
         super().save(*args, **kwargs)
 
 
+# ============================
+# Product Facets (read model)
+# ============================
+class ProductFacetCount(models.Model):
+    """Number of products per (category, price bucket, in stock) cell.
+
+    Lets `facets.product_facets()` count categories, stock and price ranges
+    from a table whose size doesn't depend on the catalog's. Kept current by
+    `facets.py`; rebuilt with `manage.py rebuild_product_facets`.
+    """
+
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name="facet_counts")
+    price_bucket = models.PositiveSmallIntegerField()
+    in_stock = models.BooleanField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["category", "price_bucket", "in_stock"], name="unique_product_facet_cell"),
+        ]
+
+    def __str__(self):
+        return f"{self.category_id} / {self.price_bucket} / {self.in_stock}: {self.count}"
+
+
 # ============================
 # Orders
 # ============================
@@ -110,6 +183,12 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # keyset pagination order (see pagination.KeysetPagination)
+            models.Index(fields=["-created_at", "-id"]),
+        ]
+
     def __str__(self):
         return f"Order {self.id}"
 
@@ -151,14 +230,179 @@ class Payment(models.Model):
     amount = models.DecimalField(max_digits=12, decimal_places=2)
     method = models.CharField(max_length=20, choices=METHOD_CHOICES)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, db_index=True)
-    transaction_id = models.CharField(max_length=255, db_index=True, unique=True)
+    # legacy reference kept for API clients: the CheckoutRequestID once the
+    # STK push was accepted (older rows may hold the M-Pesa receipt instead)
+    transaction_id = models.CharField(max_length=255, db_index=True, unique=True, null=True, blank=True)
+    # callbacks and status queries look payments up by this (exact match,
+    # unique index); NULL while an asynchronous push is still queued
+    checkout_request_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    mpesa_receipt_number = models.CharField(max_length=64, unique=True, null=True, blank=True)
     paid_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+    # set once a successful payment is counted in the sales rollups (see rollups.py)
+    rolled_up_at = models.DateTimeField(null=True, blank=True, editable=False)
 
     class Meta:
         indexes = [
             models.Index(fields=["transaction_id"]),
             models.Index(fields=["status"]),
+            # successful payments not yet rolled up
+            models.Index(fields=["status", "rolled_up_at"]),
+            # keyset pagination order (see pagination.KeysetPagination)
+            models.Index(fields=["-created_at", "-id"]),
         ]
 
     def __str__(self):
         return f"Payment {self.transaction_id}"
+
+
+# ============================
+# Order Summaries (read model)
+# ============================
+class OrderSummary(models.Model):
+    """Denormalized, list-ready copy of an order.
+
+    Written in the same transaction as the order and kept in step with
+    order/payment status changes by `read_models.py`, so order history and
+    back-office lists are served from one indexed table instead of joining
+    orders, items, products, users and payments.
+    """
+
+    order = models.OneToOneField(Order, on_delete=models.CASCADE, primary_key=True, related_name="summary")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="order_summaries")
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    payment_status = models.CharField(max_length=20, choices=Payment.STATUS_CHOICES, blank=True)
+    total_amount = models.DecimalField(max_digits=12, decimal_places=2)
+    item_count = models.PositiveIntegerField(default=0)
+    # {"user": {...}, "items": [{"product_id", "product_name", "quantity", "price"}, ...]}
+    data = models.JSONField(default=dict)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "-created_at"]),
+            # keyset pagination order (see pagination.KeysetPagination)
+            models.Index(fields=["-created_at", "-order"]),
+        ]
+
+    def __str__(self):
+        return f"Summary of order {self.order_id}"
+
+
+# ============================
+# Sales Rollups (read model)
+# ============================
+ROLLUP_PERIOD_CHOICES = [
+    ("hour", "Hour"),
+    ("day", "Day"),
+]
+
+
+class SalesRollup(models.Model):
+    """Successful payments per hour or day (local time), maintained by `rollups.py`."""
+
+    period = models.CharField(max_length=4, choices=ROLLUP_PERIOD_CHOICES)
+    start = models.DateTimeField()
+    orders = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["period", "start"], name="unique_sales_rollup"),
+        ]
+
+    def __str__(self):
+        return f"{self.period} {self.start:%Y-%m-%d %H:%M}: {self.revenue}"
+
+
+class ProductSalesRollup(models.Model):
+    """Units and item revenue of a product per hour or day; `category` is the product's at sale time."""
+
+    period = models.CharField(max_length=4, choices=ROLLUP_PERIOD_CHOICES)
+    start = models.DateTimeField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="sales_rollups")
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, related_name="sales_rollups")
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["period", "start", "product"], name="unique_product_sales_rollup"),
+        ]
+        indexes = [
+            models.Index(fields=["period", "start", "category"]),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} {self.period} {self.start:%Y-%m-%d %H:%M}: {self.units}"
+
+
+# ============================
+# Outbound Email (outbox)
+# ============================
+class OutboundEmail(models.Model):
+    """A transactional email queued for `emails.flush_outbox()`.
+
+    Confirmations are rendered when sent, from the payment or order they
+    point to; `raw` messages carry their own recipient, subject and body.
+    The row keeps the outcome of each attempt.
+    """
+
+    KIND_CHOICES = [
+        ("payment_confirmation", "Payment confirmation"),
+        ("booking_confirmation", "Booking confirmation"),
+        ("raw", "Raw"),
+    ]
+
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("sent", "Sent"),
+        ("failed", "Failed"),
+    ]
+
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="emails", null=True, blank=True)
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name="emails", null=True, blank=True)
+    recipient = models.EmailField(blank=True)
+    subject = models.CharField(max_length=255, blank=True)
+    body = models.TextField(blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # flush_outbox() picks the due pending messages
+            models.Index(fields=["status", "next_attempt_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} ({self.status})"
+
+
+# ============================
+# Task Outbox
+# ============================
+class TaskOutbox(models.Model):
+    """A Celery task dispatched with `dispatch.dispatch()` not yet handed to the broker.
+
+    Written in the dispatching transaction and deleted once published; rows
+    left behind (broker down, process gone) are published by
+    `dispatch.relay()`.
+    """
+
+    task = models.CharField(max_length=200)
+    args = models.JSONField(default=list)
+    kwargs = models.JSONField(default=dict)
+    eta = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.task} ({self.pk})"
@@ -5,12 +5,40 @@ This module implements the minimal interactions needed by the app:
 - initiate an STK push (mobile payment prompt)
 - query the STK push status
 
+`MpesaClient` does the work; the module-level functions use one client per
+process (`get_client()`). The client:
+- caches the OAuth token in the Django cache (Redis in production), so all
+  workers share one token until shortly before it expires; one worker
+  refreshes it under a lock while the others wait for the result
+- keeps a `requests.Session` with a keep-alive connection pool, so steady
+  state calls reuse open TLS connections
+- goes through a circuit breaker shared by all workers (see
+  `circuit_breaker`): when most recent calls failed, calls raise
+  `CircuitOpenError` immediately instead of waiting for their timeouts
+- bounds every call by an overall deadline (`MpesaDeadlineExceeded`)
+- retries only STK status queries, with jittered exponential backoff; an
+  STK push is never retried, it would prompt the customer twice
+- records call counts, latency, errors and retries through `metrics`
+  (see `get_mpesa_metrics()`)
+
 Configuration is via environment variables (set these in your `.env`):
 - `MPESA_CONSUMER_KEY`, `MPESA_CONSUMER_SECRET`
 - `MPESA_SHORTCODE` (BusinessShortCode / Lipa Na Mpesa shortcode)
 - `MPESA_PASSKEY` (for STK push)
 - `MPESA_ENV` (optional; `sandbox` or `production`, default `sandbox`)
 - `MPESA_CALLBACK_URL` (callback URL for STK push)
+- `MPESA_BASE_URL` (optional; overrides the API host picked by `MPESA_ENV`,
+  e.g. to point at a local stub in tests)
+- `MPESA_TOKEN_TTL` (optional; seconds a token is reused, default 3300; keep
+  it below the 3599s lifetime Safaricom grants)
+- `MPESA_POOL_MAXSIZE` (optional; keep-alive connections per host)
+- `MPESA_CALL_DEADLINE`, `MPESA_CONNECT_TIMEOUT` (optional; seconds a whole
+  call, and one connection attempt, may take)
+- `MPESA_QUERY_RETRIES`, `MPESA_RETRY_BASE_DELAY`, `MPESA_RETRY_MAX_DELAY`
+  (optional; status query retries and their backoff)
+- `MPESA_BREAKER_FAILURE_RATIO`, `MPESA_BREAKER_MIN_CALLS`,
+  `MPESA_BREAKER_WINDOW`, `MPESA_BREAKER_RESET_TIMEOUT` (optional; when the
+  breaker opens and how long it stays open)
 
 Note: You must register for the Safaricom developer sandbox and use the credentials
 from there for testing. This code is a light wrapper and reports responses
@@ -20,7 +48,19 @@ from Safaricom unchanged so you can inspect raw payloads.
 import os
 import time
 import base64
+import hashlib
+import logging
+import random
+
 import requests
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+from .cache_helpers import get_or_compute
+from .circuit_breaker import CircuitBreaker, CircuitOpenError
+
+logger = logging.getLogger(__name__)
 
 MPESA_ENV = os.getenv("MPESA_ENV", "sandbox")
 MPESA_CONSUMER_KEY = os.getenv("MPESA_CONSUMER_KEY")
@@ -28,23 +68,30 @@ MPESA_CONSUMER_SECRET = os.getenv("MPESA_CONSUMER_SECRET")
 MPESA_SHORTCODE = os.getenv("MPESA_SHORTCODE")
 MPESA_PASSKEY = os.getenv("MPESA_PASSKEY")
 MPESA_CALLBACK_URL = os.getenv("MPESA_CALLBACK_URL", "")
+MPESA_BASE_URL = os.getenv("MPESA_BASE_URL", "")
+MPESA_TOKEN_TTL = int(os.getenv("MPESA_TOKEN_TTL", "3300"))
+MPESA_POOL_MAXSIZE = int(os.getenv("MPESA_POOL_MAXSIZE", "10"))
+MPESA_CALL_DEADLINE = float(os.getenv("MPESA_CALL_DEADLINE", "10"))
+MPESA_CONNECT_TIMEOUT = float(os.getenv("MPESA_CONNECT_TIMEOUT", "3.05"))
+MPESA_QUERY_RETRIES = int(os.getenv("MPESA_QUERY_RETRIES", "2"))
+MPESA_RETRY_BASE_DELAY = float(os.getenv("MPESA_RETRY_BASE_DELAY", "0.25"))
+MPESA_RETRY_MAX_DELAY = float(os.getenv("MPESA_RETRY_MAX_DELAY", "2"))
+MPESA_BREAKER_FAILURE_RATIO = float(os.getenv("MPESA_BREAKER_FAILURE_RATIO", "0.5"))
+MPESA_BREAKER_MIN_CALLS = int(os.getenv("MPESA_BREAKER_MIN_CALLS", "10"))
+MPESA_BREAKER_WINDOW = int(os.getenv("MPESA_BREAKER_WINDOW", "30"))
+MPESA_BREAKER_RESET_TIMEOUT = int(os.getenv("MPESA_BREAKER_RESET_TIMEOUT", "30"))
+
+TOKEN_KEY = "mpesa:token:{fingerprint}"
+OPERATIONS = ("token", "stk_push", "stk_query")
+RETRIES_METRIC = "mpesa.retries"
 
 
 def _base_url():
+    if MPESA_BASE_URL:
+        return MPESA_BASE_URL.rstrip("/")
     return "https://sandbox.safaricom.co.ke" if MPESA_ENV == "sandbox" else "https://api.safaricom.co.ke"
 
 
-def get_oauth_token():
-    """Return OAuth access token string from Safaricom OAuth service."""
-    if not (MPESA_CONSUMER_KEY and MPESA_CONSUMER_SECRET):
-        raise RuntimeError("Mpesa credentials not configured (MPESA_CONSUMER_KEY/SECRET)")
-    url = f"{_base_url()}/oauth/v1/generate?grant_type=client_credentials"
-    r = requests.get(url, auth=(MPESA_CONSUMER_KEY, MPESA_CONSUMER_SECRET), timeout=10)
-    r.raise_for_status()
-    data = r.json()
-    return data.get("access_token")
-
-
 def _timestamp():
     return time.strftime("%Y%m%d%H%M%S")
 
@@ -56,45 +103,279 @@ def _password(timestamp: str):
     return base64.b64encode(raw).decode()
 
 
-def initiate_stk_push(amount: float, phone_number: str, account_reference: str, transaction_desc: str = "Payment", callback_url: str = None):
+def parse_result_code(resp):
+    """Return the transaction ResultCode of an STK query/callback payload as an int.
+
+    Returns None when the payload carries no result yet (e.g. a query that
+    was only accepted: `ResponseCode` 0 without `ResultCode`).
+    """
+    if not isinstance(resp, dict):
+        return None
+    result_code = resp.get("ResultCode")
+    if result_code is None:
+        # nested patterns
+        for k in ("result", "Result", "stkCallback"):
+            sub = resp.get(k)
+            if isinstance(sub, dict) and sub.get("ResultCode") is not None:
+                result_code = sub["ResultCode"]
+                break
+    try:
+        return int(result_code) if result_code is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def extract_receipt(resp):
+    """Return the MpesaReceiptNumber found in a payload's callback metadata, if any."""
+    if not isinstance(resp, dict):
+        return None
+    meta = resp.get("CallbackMetadata") or resp.get("callbackMetadata") or resp.get("Result") or {}
+    items = (meta.get("Item") or meta.get("Items") or []) if isinstance(meta, dict) else []
+    if not isinstance(items, list):
+        return None
+    for it in items:
+        if isinstance(it, dict) and it.get("Name") in ("MpesaReceiptNumber", "ReceiptNumber"):
+            return it.get("Value")
+    return None
+
+
+class MpesaDeadlineExceeded(requests.Timeout):
+    """The call's overall deadline passed before Safaricom answered."""
+
+
+def _upstream_failed(exc=None, response=None):
+    """Whether an outcome says Safaricom itself is unhealthy.
+
+    Connection errors, timeouts, 429 and 5xx count. Daraja also reports some
+    application errors (e.g. "The transaction is being processed" from the
+    STK query) as 5xx with an `errorCode` body; those are answers, not
+    outages.
+    """
+    if exc is not None and not isinstance(exc, requests.HTTPError):
+        return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+    response = response if response is not None else getattr(exc, "response", None)
+    if response is None:
+        return False
+    if response.status_code == 429:
+        return True
+    if response.status_code < 500:
+        return False
+    try:
+        return "errorCode" not in response.json()
+    except ValueError:
+        return True
+
+
+class MpesaClient:
+    """Safaricom Daraja client with a shared token cache, pooled connections and a circuit breaker.
+
+    Every call has an overall `deadline` (seconds, default
+    MPESA_CALL_DEADLINE) covering the token fetch, each HTTP attempt and any
+    backoff; each attempt's timeout is trimmed to what is left of it.
+    """
+
+    def __init__(self, token_timeout=10, request_timeout=15, pool_maxsize=None, breaker=None):
+        self.token_timeout = token_timeout
+        self.request_timeout = request_timeout
+        self.breaker = breaker or default_breaker
+        self.session = requests.Session()
+        # no transport-level retries: only status queries are retried, by query_stk_status()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_maxsize or MPESA_POOL_MAXSIZE, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _token_key(self):
+        # tokens are per API host and consumer key
+        raw = f"{_base_url()}|{MPESA_CONSUMER_KEY}".encode()
+        return TOKEN_KEY.format(fingerprint=hashlib.sha1(raw).hexdigest()[:16])
+
+    def _deadline(self, deadline):
+        return time.monotonic() + (MPESA_CALL_DEADLINE if deadline is None else deadline)
+
+    def _send(self, operation, method, url, deadline, timeout, **kwargs):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise MpesaDeadlineExceeded(f"Mpesa {operation} deadline exceeded")
+        probe = self.breaker.allow()
+
+        started = time.monotonic()
+        try:
+            r = self.session.request(
+                method, url, timeout=(min(MPESA_CONNECT_TIMEOUT, remaining), min(timeout, remaining)), **kwargs
+            )
+        except requests.RequestException as exc:
+            metrics.incr(f"mpesa.{operation}.errors")
+            if _upstream_failed(exc):
+                self.breaker.record_failure(probe)
+            else:
+                self.breaker.record_success(probe)
+            raise
+        finally:
+            metrics.incr(f"mpesa.{operation}.calls")
+            metrics.incr(f"mpesa.{operation}.latency_ms", int((time.monotonic() - started) * 1000))
+
+        if _upstream_failed(response=r):
+            self.breaker.record_failure(probe)
+        else:
+            self.breaker.record_success(probe)
+        try:
+            r.raise_for_status()
+        except requests.HTTPError:
+            metrics.incr(f"mpesa.{operation}.errors")
+            raise
+        return r
+
+    def fetch_token(self, deadline=None):
+        """Request a new OAuth access token from Safaricom (bypassing the cache)."""
+        if not (MPESA_CONSUMER_KEY and MPESA_CONSUMER_SECRET):
+            raise RuntimeError("Mpesa credentials not configured (MPESA_CONSUMER_KEY/SECRET)")
+        url = f"{_base_url()}/oauth/v1/generate?grant_type=client_credentials"
+        r = self._send(
+            "token", "GET", url, deadline or self._deadline(None), self.token_timeout,
+            auth=(MPESA_CONSUMER_KEY, MPESA_CONSUMER_SECRET),
+        )
+        token = r.json().get("access_token")
+        if not token:
+            raise RuntimeError("Mpesa OAuth response did not include an access_token")
+        return token
+
+    def get_token(self, deadline=None):
+        """Return the shared OAuth token, fetching it when it is missing or about to expire."""
+        return get_or_compute(
+            self._token_key(), lambda: self.fetch_token(deadline), timeout=MPESA_TOKEN_TTL, stale_timeout=0,
+        )
+
+    def _post(self, operation, path, payload, deadline):
+        url = f"{_base_url()}{path}"
+        for attempt in (1, 2):
+            headers = {"Authorization": f"Bearer {self.get_token(deadline)}", "Content-Type": "application/json"}
+            try:
+                return self._send(operation, "POST", url, deadline, self.request_timeout, json=payload, headers=headers).json()
+            except requests.HTTPError as exc:
+                # a token revoked before its TTL: drop it and retry once with a
+                # fresh one (Safaricom rejected the call, so nothing was sent)
+                if attempt == 2 or exc.response is None or exc.response.status_code != 401:
+                    raise
+                logger.warning("Mpesa rejected the cached token; refreshing it")
+                metrics.incr(RETRIES_METRIC)
+                self.invalidate_token()
+
+    def invalidate_token(self):
+        """Forget the shared token so the next call fetches a new one."""
+        try:
+            cache.delete(self._token_key())
+        except Exception:
+            logger.exception("Failed to drop the cached Mpesa token")
+
+    def initiate_stk_push(self, amount: float, phone_number: str, account_reference: str, transaction_desc: str = "Payment", callback_url: str = None, deadline: float = None):
+        """Initiate STK push. Returns the raw response JSON.
+
+        phone_number should be in the format 2547XXXXXXXX (no leading +)
+
+        Never retried: a repeated push would prompt the customer twice.
+        """
+        timestamp = _timestamp()
+        payload = {
+            "BusinessShortCode": MPESA_SHORTCODE,
+            "Password": _password(timestamp),
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": int(amount),
+            "PartyA": phone_number,
+            "PartyB": MPESA_SHORTCODE,
+            "PhoneNumber": phone_number,
+            "CallBackURL": callback_url or MPESA_CALLBACK_URL,
+            "AccountReference": account_reference,
+            "TransactionDesc": transaction_desc,
+        }
+        return self._post("stk_push", "/mpesa/stkpush/v1/processrequest", payload, self._deadline(deadline))
+
+    def query_stk_status(self, checkout_request_id: str, deadline: float = None):
+        """Query STK push status by `CheckoutRequestID`. Returns raw JSON.
+
+        The query is idempotent, so transient failures (connection errors,
+        timeouts, 429/5xx outages) are retried up to MPESA_QUERY_RETRIES
+        times with full-jitter exponential backoff, within the deadline.
+        """
+        deadline = self._deadline(deadline)
+        for attempt in range(MPESA_QUERY_RETRIES + 1):
+            timestamp = _timestamp()
+            payload = {
+                "BusinessShortCode": MPESA_SHORTCODE,
+                "Password": _password(timestamp),
+                "Timestamp": timestamp,
+                "CheckoutRequestID": checkout_request_id,
+            }
+            try:
+                return self._post("stk_query", "/mpesa/stkpushquery/v1/query", payload, deadline)
+            except MpesaDeadlineExceeded:
+                raise
+            except requests.RequestException as exc:
+                if attempt == MPESA_QUERY_RETRIES or not _upstream_failed(exc):
+                    raise
+                delay = random.uniform(0, min(MPESA_RETRY_MAX_DELAY, MPESA_RETRY_BASE_DELAY * 2 ** attempt))
+                if time.monotonic() + delay >= deadline:
+                    raise
+                metrics.incr(RETRIES_METRIC)
+                time.sleep(delay)
+
+
+default_breaker = CircuitBreaker(
+    "mpesa",
+    failure_ratio=MPESA_BREAKER_FAILURE_RATIO,
+    min_calls=MPESA_BREAKER_MIN_CALLS,
+    window=MPESA_BREAKER_WINDOW,
+    reset_timeout=MPESA_BREAKER_RESET_TIMEOUT,
+)
+
+_client = None
+_client_pid = None
+
+
+def get_client():
+    """Return this process's `MpesaClient` (a new one after a fork)."""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client, _client_pid = MpesaClient(), os.getpid()
+    return _client
+
+
+def get_oauth_token():
+    """Return OAuth access token string (cached and shared across workers)."""
+    return get_client().get_token()
+
+
+def initiate_stk_push(amount: float, phone_number: str, account_reference: str, transaction_desc: str = "Payment", callback_url: str = None, deadline: float = None):
     """Initiate STK push. Returns the raw response JSON.
 
     phone_number should be in the format 2547XXXXXXXX (no leading +)
     """
-    token = get_oauth_token()
-    url = f"{_base_url()}/mpesa/stkpush/v1/processrequest"
-    timestamp = _timestamp()
-    payload = {
-        "BusinessShortCode": MPESA_SHORTCODE,
-        "Password": _password(timestamp),
-        "Timestamp": timestamp,
-        "TransactionType": "CustomerPayBillOnline",
-        "Amount": int(amount),
-        "PartyA": phone_number,
-        "PartyB": MPESA_SHORTCODE,
-        "PhoneNumber": phone_number,
-        "CallBackURL": callback_url or MPESA_CALLBACK_URL,
-        "AccountReference": account_reference,
-        "TransactionDesc": transaction_desc,
-    }
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    r = requests.post(url, json=payload, headers=headers, timeout=15)
-    r.raise_for_status()
-    return r.json()
+    return get_client().initiate_stk_push(amount, phone_number, account_reference, transaction_desc, callback_url, deadline)
 
 
-def query_stk_status(checkout_request_id: str):
+def query_stk_status(checkout_request_id: str, deadline: float = None):
     """Query STK push status by `CheckoutRequestID`. Returns raw JSON."""
-    token = get_oauth_token()
-    url = f"{_base_url()}/mpesa/stkpushquery/v1/query"
-    timestamp = _timestamp()
-    payload = {
-        "BusinessShortCode": MPESA_SHORTCODE,
-        "Password": _password(timestamp),
-        "Timestamp": timestamp,
-        "CheckoutRequestID": checkout_request_id,
+    return get_client().query_stk_status(checkout_request_id, deadline)
+
+
+def get_mpesa_metrics():
+    """Return call counts, error counts, average latency, retries and breaker state of Mpesa API calls."""
+    names = [f"mpesa.{op}.{kind}" for op in OPERATIONS for kind in ("calls", "errors", "latency_ms")]
+    breaker_names = ["breaker.mpesa.opened", "breaker.mpesa.rejected"]
+    counters = metrics.get_counters(names + breaker_names + [RETRIES_METRIC])
+    result = {
+        "retries": counters[RETRIES_METRIC],
+        "breaker": {
+            "state": default_breaker.state(),
+            "opened": counters["breaker.mpesa.opened"],
+            "rejected": counters["breaker.mpesa.rejected"],
+        },
     }
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    r = requests.post(url, json=payload, headers=headers, timeout=15)
-    r.raise_for_status()
-    return r.json()
+    for op in OPERATIONS:
+        calls = counters[f"mpesa.{op}.calls"]
+        result[op] = {
+            "calls": calls,
+            "errors": counters[f"mpesa.{op}.errors"],
+            "avg_latency_ms": round(counters[f"mpesa.{op}.latency_ms"] / calls, 1) if calls else None,
+        }
+    return result
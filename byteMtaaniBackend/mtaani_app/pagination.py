@@ -0,0 +1,160 @@
+import base64
+import binascii
+import json
+import uuid
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(PageNumberPagination):
+    """Page-number pagination with opt-in keyset (cursor) pagination.
+
+    Without extra parameters this behaves exactly like the default
+    `PageNumberPagination`. Passing `?cursor=` (empty for the first page) or
+    `?pagination=keyset` switches to keyset pagination: rows are ordered
+    newest first on `(created_at, id)` and each page starts strictly after the
+    position encoded in the cursor, so deep pages cost the same as the first
+    one (no OFFSET scan, no COUNT). The response is
+    `{"next": <url or null>, "results": [...]}`.
+
+    Models paged this way need a composite index on `(created_at, id)`.
+    """
+
+    cursor_query_param = 'cursor'
+    keyset_page_size_query_param = 'page_size'
+    max_keyset_page_size = 1000
+    ordering = ('created_at', 'pk')
+
+    keyset = False
+
+    def _wants_keyset(self, request):
+        return (
+            self.cursor_query_param in request.query_params
+            or request.query_params.get('pagination') == 'keyset'
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self._wants_keyset(request)
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        page_size = self._keyset_page_size(request)
+        time_field, id_field = self.ordering
+        queryset = queryset.order_by(f'-{time_field}', f'-{id_field}')
+
+        position = self._decode_cursor(request.query_params.get(self.cursor_query_param))
+        if position is not None:
+            created_at, pk = position
+            queryset = queryset.filter(
+                Q(**{f'{time_field}__lt': created_at})
+                | Q(**{time_field: created_at, f'{id_field}__lt': pk})
+            )
+
+        rows = list(queryset[:page_size + 1])
+        self.has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        self.next_position = self._position(rows[-1]) if self.has_next else None
+        return rows
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super().get_next_link()
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self._encode_cursor(self.next_position))
+
+    def _keyset_page_size(self, request):
+        try:
+            size = int(request.query_params[self.keyset_page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_keyset_page_size))
+
+    def _position(self, row):
+        # rows are model instances, or dicts when the view pages a .values() queryset
+        time_field, id_field = self.ordering
+        if isinstance(row, dict):
+            return row[time_field], row['id' if id_field == 'pk' else id_field]
+        return getattr(row, time_field), getattr(row, id_field)
+
+    def _encode_cursor(self, position):
+        created_at, pk = position
+        raw = json.dumps([created_at.isoformat(), str(pk)]).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def _decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            created_at, pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            created_at = parse_datetime(created_at)
+            pk = uuid.UUID(pk)
+        except (AttributeError, TypeError, ValueError, binascii.Error):
+            created_at = None
+        if created_at is None:
+            raise NotFound('Invalid cursor')
+        return created_at, pk
+
+
+def estimate_count(queryset):
+    """Return the planner's row estimate for `queryset`, or None when there is none.
+
+    PostgreSQL only: an unfiltered queryset reads the table's `reltuples`
+    (kept up to date by autovacuum/ANALYZE), a filtered one the row estimate
+    of its EXPLAIN plan. Neither scans the table.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    queryset = queryset.order_by()
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute(
+                'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                [connection.ops.quote_name(queryset.model._meta.db_table)],
+            )
+            row = cursor.fetchone()
+            # -1 until the table is first analyzed
+            return int(row[0]) if row and row[0] >= 0 else None
+        sql, params = queryset.query.sql_with_params()
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Django paginator that trusts the planner's estimate for large result sets.
+
+    An exact COUNT(*) over millions of rows scans them all, on every admin
+    changelist page. When the estimate (see `estimate_count`) reaches
+    ADMIN_COUNT_ESTIMATE_THRESHOLD it is used as the count, so the total and
+    the number of pages are approximate; smaller results are counted
+    exactly.
+    """
+
+    @cached_property
+    def count(self):
+        if hasattr(self.object_list, 'query'):
+            estimate = estimate_count(self.object_list)
+            if estimate is not None and estimate >= settings.ADMIN_COUNT_ESTIMATE_THRESHOLD:
+                return estimate
+        return super().count
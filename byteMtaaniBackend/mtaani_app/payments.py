@@ -0,0 +1,195 @@
+"""Resolution of pending M-Pesa payments from STK status queries.
+
+A pending payment is settled by the Safaricom callback, or else by
+`reconcile_pending_payments()`, which the `reconcile_pending_payments` beat
+task runs every PAYMENT_RECONCILE_INTERVAL seconds: it picks the oldest
+pending payments that were pushed at least PAYMENT_RECONCILE_MIN_AGE
+seconds ago (through the `status` index), queries them on a small thread
+pool and writes the outcomes with bulk UPDATEs.
+
+`verify` answers from the stored state; it makes at most one live query per
+payment every PAYMENT_VERIFY_MIN_INTERVAL seconds, shared across workers,
+so clients polling it don't each hit Safaricom.
+
+Both paths, and the callbacks (`mpesa_callback`, or `callback_stream` when
+they are queued), go through `apply_query_results()`, which only touches
+payments that are still pending (a callback may have won the race), then
+sends `payment_status_changed` and queues the confirmation emails on
+the outbox (see emails.py).
+"""
+
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import emails
+from .models import Payment
+from .mpesa import CircuitOpenError, extract_receipt, parse_result_code, query_stk_status
+from .signals import payment_status_changed
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_LOCK_KEY = 'payments:reconcile:lock'
+VERIFY_SLOT_KEY = 'payments:verify:{pk}'
+
+
+def _outcome(resp):
+    """Return `(status, receipt)` for a query payload, or None while it is undecided."""
+    code = parse_result_code(resp)
+    if code is None:
+        return None
+    if code == 0:
+        return 'successful', extract_receipt(resp)
+    return 'failed', None
+
+
+def _send_confirmations(payments):
+    successful = [p for p in payments if p.status == 'successful']
+    if not successful:
+        return
+    try:
+        emails.queue_payment_confirmations(successful)
+    except Exception:
+        logger.exception('Failed to queue the confirmation emails of payments %s', [p.pk for p in successful])
+
+
+def query_payment_status(checkout_id):
+    """Return the STK query payload for `checkout_id`.
+
+    Daraja answers queries for transactions that are still in progress with
+    an HTTP error carrying an `errorCode`; that body is returned as is (it
+    has no ResultCode, so the payment stays undecided). Other failures raise.
+    """
+    try:
+        return query_stk_status(checkout_id)
+    except requests.HTTPError as exc:
+        try:
+            body = exc.response.json()
+        except (AttributeError, ValueError):
+            raise exc
+        if isinstance(body, dict) and 'errorCode' in body:
+            return body
+        raise
+
+
+def apply_query_results(results):
+    """Settle payments from STK query payloads.
+
+    `results` maps payment id -> raw query response (or the `stkCallback`
+    of a callback). Payments whose response has no result yet, or that are
+    no longer pending, are left alone, so applying the same result twice is
+    harmless. Returns the list of updated payments.
+    """
+    outcomes = {pk: outcome for pk, resp in results.items() if (outcome := _outcome(resp)) is not None}
+    if not outcomes:
+        return []
+
+    now = timezone.now()
+    with transaction.atomic():
+        payments = list(Payment.objects.select_for_update().filter(pk__in=list(outcomes), status='pending'))
+        for payment in payments:
+            payment.status, receipt = outcomes[payment.pk]
+            if payment.status == 'successful':
+                payment.paid_at = now
+                payment.mpesa_receipt_number = receipt or payment.mpesa_receipt_number
+        Payment.objects.bulk_update(payments, ['status', 'paid_at', 'mpesa_receipt_number'])
+
+        def notify():
+            payment_status_changed.send(sender=Payment, payments=payments)
+            _send_confirmations(payments)
+
+        transaction.on_commit(notify)
+    return payments
+
+
+def reconcile_pending_payments(min_age=None, batch_size=None, concurrency=None):
+    """Query a batch of stale pending payments and settle the decided ones.
+
+    Returns counts: checked, successful, failed, undecided (no result yet),
+    errors; `skipped` is True when another run holds the lock.
+    """
+    min_age = settings.PAYMENT_RECONCILE_MIN_AGE if min_age is None else min_age
+    batch_size = batch_size or settings.PAYMENT_RECONCILE_BATCH_SIZE
+    concurrency = concurrency or settings.PAYMENT_RECONCILE_CONCURRENCY
+
+    token = uuid.uuid4().hex
+    if not cache.add(RECONCILE_LOCK_KEY, token, settings.PAYMENT_RECONCILE_LOCK_TIMEOUT):
+        return {'skipped': True}
+    try:
+        cutoff = timezone.now() - timedelta(seconds=min_age)
+        # rows created before checkout_request_id existed only have transaction_id
+        candidates = [
+            (pk, checkout_id or legacy_id)
+            for pk, checkout_id, legacy_id in Payment.objects.filter(
+                Q(checkout_request_id__isnull=False) | Q(transaction_id__isnull=False),
+                status='pending', method='mpesa', created_at__lte=cutoff,
+            ).order_by('created_at').values_list('pk', 'checkout_request_id', 'transaction_id')[:batch_size]
+        ]
+
+        results, errors = {}, 0
+        if candidates:
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(candidates))) as pool:
+                futures = {pool.submit(query_payment_status, checkout_id): pk for pk, checkout_id in candidates}
+                for future in as_completed(futures):
+                    try:
+                        results[futures[future]] = future.result()
+                    except CircuitOpenError:
+                        errors += 1
+                    except Exception as exc:
+                        logger.info('STK query for payment %s failed: %s', futures[future], exc)
+                        errors += 1
+
+        updated = apply_query_results(results)
+        successful = sum(1 for p in updated if p.status == 'successful')
+        return {
+            'skipped': False,
+            'checked': len(candidates),
+            'successful': successful,
+            'failed': len(updated) - successful,
+            'undecided': sum(1 for resp in results.values() if _outcome(resp) is None),
+            'errors': errors,
+        }
+    finally:
+        if cache.get(RECONCILE_LOCK_KEY) == token:
+            cache.delete(RECONCILE_LOCK_KEY)
+
+
+def claim_verify_slot(payment_pk):
+    """Return True when this caller may query Safaricom live for `payment_pk` now."""
+    try:
+        return cache.add(VERIFY_SLOT_KEY.format(pk=payment_pk), 1, settings.PAYMENT_VERIFY_MIN_INTERVAL)
+    except Exception:
+        logger.exception('Verify rate limit unavailable for payment %s', payment_pk)
+        return True
+
+
+def find_payment_ids(checkout_ids):
+    """Map each of `checkout_ids` to the pk of the payment pushed with it.
+
+    Exact lookups on unique columns: one query on `checkout_request_id`,
+    then one on the legacy `transaction_id` (payments created before that
+    column existed) for the ids not found. Unknown ids are left out.
+    """
+    checkout_ids = {checkout_id for checkout_id in checkout_ids if checkout_id}
+    if not checkout_ids:
+        return {}
+    found = dict(
+        Payment.objects.filter(checkout_request_id__in=checkout_ids).values_list('checkout_request_id', 'pk')
+    )
+    missing = checkout_ids - found.keys()
+    if missing:
+        found.update(Payment.objects.filter(transaction_id__in=missing).values_list('transaction_id', 'pk'))
+    return found
+
+
+def find_by_checkout_request_id(checkout_id):
+    """Return the pk of the payment pushed as `checkout_id`, or None."""
+    return find_payment_ids([checkout_id]).get(checkout_id)
@@ -0,0 +1,232 @@
+"""Bulk product import/upsert from CSV or JSON files.
+
+Supplier catalogs used to go through the product API one POST per row,
+each row paying for a request, a `save()` and its signal handlers (cache,
+search, facets). `import_products(stream, format)` instead:
+
+- parses the file incrementally (CSV rows, a JSON array or
+  newline-delimited JSON objects), so memory use doesn't grow with it;
+- resolves categories by `url_key` from a map loaded once;
+- upserts chunks of `chunk_size` rows keyed on the product `url_key`
+  with one `bulk_create(update_conflicts=True)` each, in its own
+  transaction (no `save()`, so no per-row signals);
+- refreshes the catalog cache, search index and facet counts once at the
+  end (search vectors per chunk on PostgreSQL).
+
+Rows are objects/CSV records with `url_key`, `product_name` (or `name`),
+`price`, `category` (the category's url_key) and optionally `description`,
+`stock` and `image_url`. Invalid rows are skipped and reported with their
+row number; when a `url_key` appears twice in a chunk, the last row wins.
+The stock of existing hot SKUs (see hot_stock.py) is left alone, because
+their Redis counters are the reference.
+
+Used by `manage.py import_products` and `POST /api/products/import/`.
+"""
+
+import csv
+import io
+import json
+import logging
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_slug
+from django.db import connection, transaction
+
+from . import catalog_cache, facets, search
+from .models import Category, Product
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'json')
+MAX_ERRORS = 100
+READ_SIZE = 64 * 1024
+
+UPDATE_FIELDS = ['product_name', 'description', 'price', 'category', 'stock', 'in_stock', 'image_url', 'updated_at']
+HOT_UPDATE_FIELDS = [name for name in UPDATE_FIELDS if name not in ('stock', 'in_stock')]
+
+PRICE_QUANTUM = Decimal('0.01')
+MAX_PRICE = Decimal('10') ** 10
+# the range of Product.stock (an IntegerField)
+MAX_STOCK = 2 ** 31 - 1
+
+
+class ImportFileError(ValueError):
+    """The file can't be parsed any further."""
+
+
+def guess_format(name):
+    """Return the format of a file called `name` ('csv' unless it ends in .json/.ndjson/.jsonl)."""
+    return 'json' if str(name).lower().endswith(('.json', '.ndjson', '.jsonl')) else 'csv'
+
+
+def _text(stream):
+    if isinstance(stream, io.TextIOBase):
+        return stream
+    # uploaded files wrap the real file object
+    return io.TextIOWrapper(getattr(stream, 'file', stream), encoding='utf-8-sig', newline='')
+
+
+def _csv_rows(stream):
+    reader = csv.DictReader(_text(stream))
+    for row in reader:
+        yield reader.line_num, row
+
+
+def _json_rows(stream):
+    """Yield the objects of a JSON array or of newline-delimited JSON, one chunk of text at a time."""
+    text = _text(stream)
+    decoder = json.JSONDecoder()
+    buffer, position, eof, number = '', 0, False, 0
+    while True:
+        # separators between objects: whitespace, commas and the array brackets
+        while position < len(buffer) and buffer[position] in ' \t\r\n,[]':
+            position += 1
+        try:
+            if position >= len(buffer):
+                raise ValueError('empty buffer')
+            row, end = decoder.raw_decode(buffer, position)
+        except ValueError as exc:
+            if eof:
+                if position >= len(buffer):
+                    return
+                raise ImportFileError(f'Invalid JSON after row {number}: {exc}') from None
+            chunk = text.read(READ_SIZE)
+            buffer, position, eof = buffer[position:] + chunk, 0, not chunk
+            continue
+        number += 1
+        position = end
+        yield number, row
+
+
+def iter_rows(stream, format='csv'):
+    """Yield `(row number, dict)` pairs from a CSV or JSON file object."""
+    if format not in FORMATS:
+        raise ImportFileError(f'Unsupported format {format!r}; use one of {", ".join(FORMATS)}.')
+    return _csv_rows(stream) if format == 'csv' else _json_rows(stream)
+
+
+def _product(row, categories):
+    """Build the `Product` a row describes; raises ValueError for invalid rows."""
+    if not isinstance(row, dict):
+        raise ValueError('not an object')
+    url_key = str(row.get('url_key') or '').strip()
+    name = str(row.get('product_name') or row.get('name') or '').strip()
+    if not url_key:
+        raise ValueError('url_key is required')
+    if len(url_key) > Product._meta.get_field('url_key').max_length:
+        raise ValueError('url_key is too long')
+    try:
+        validate_slug(url_key)
+    except ValidationError:
+        raise ValueError(f'invalid url_key {url_key!r}') from None
+    if not name:
+        raise ValueError('product_name is required')
+    try:
+        price = Decimal(str(row.get('price'))).quantize(PRICE_QUANTUM)
+    except (InvalidOperation, ValueError):
+        raise ValueError(f"invalid price {row.get('price')!r}") from None
+    if price.is_nan() or not 0 <= price < MAX_PRICE:
+        raise ValueError(f'price out of range: {price}')
+    try:
+        stock = int(row.get('stock') or 0)
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid stock {row.get('stock')!r}") from None
+    if not 0 <= stock <= MAX_STOCK:
+        raise ValueError(f'stock out of range: {stock}')
+    category = str(row.get('category') or '').strip()
+    if category not in categories:
+        raise ValueError(f'unknown category {category!r}')
+    return Product(
+        url_key=url_key,
+        product_name=name[:255],
+        description=str(row.get('description') or ''),
+        price=price,
+        category_id=categories[category],
+        stock=stock,
+        in_stock=stock > 0,
+        image_url=str(row.get('image_url') or ''),
+    )
+
+
+def _upsert(products, result, stale):
+    """Insert or update one chunk ({url_key: Product}) in one transaction."""
+    unique_fields = ['url_key'] if connection.features.supports_update_conflicts_with_target else None
+    with transaction.atomic():
+        existing = {
+            url_key: (pk, hot)
+            for url_key, pk, hot in Product.objects.filter(url_key__in=list(products))
+            .values_list('url_key', 'pk', 'is_hot_sku')
+        }
+        hot_keys = {url_key for url_key, (_, is_hot) in existing.items() if is_hot}
+        hot = [product for url_key, product in products.items() if url_key in hot_keys]
+        rest = [product for url_key, product in products.items() if url_key not in hot_keys]
+        for rows, fields in ((rest, UPDATE_FIELDS), (hot, HOT_UPDATE_FIELDS)):
+            if rows:
+                Product.objects.bulk_create(
+                    rows, update_conflicts=True, unique_fields=unique_fields, update_fields=fields,
+                )
+        if search.uses_postgres():
+            search.index_products(Product.objects.filter(url_key__in=list(products)))
+    result['created'] += len(products) - len(existing)
+    result['updated'] += len(existing)
+    result['hot_stock_kept'] += len(hot)
+    stale.extend(pk for pk, _ in existing.values())
+
+
+def _refresh_caches(stale):
+    """Invalidate once what per-row saves would have invalidated row by row."""
+    for start in range(0, len(stale), 1000):
+        try:
+            cache.delete_many([catalog_cache.product_key(pk) for pk in stale[start:start + 1000]])
+        except Exception:
+            logger.exception('Failed to drop cached product fragments')
+    catalog_cache.bump_version()
+    if not search.uses_postgres():
+        search.bump_version()
+    facets.rebuild()
+
+
+def import_products(stream, format='csv', chunk_size=1000):
+    """Upsert the products of a CSV/JSON file object.
+
+    Returns counts of rows read, products created and updated, skipped
+    rows, the first MAX_ERRORS errors (`{'row': n, 'error': message}`),
+    the elapsed seconds and rows per second. Raises ImportFileError when
+    the file itself is malformed; chunks written until then are kept.
+    """
+    started = time.monotonic()
+    categories = {str(url_key): pk for url_key, pk in Category.objects.values_list('url_key', 'pk')}
+    result = {'rows': 0, 'created': 0, 'updated': 0, 'skipped': 0, 'hot_stock_kept': 0, 'errors': []}
+    chunk, stale = {}, []
+    try:
+        for number, row in iter_rows(stream, format):
+            result['rows'] += 1
+            try:
+                product = _product(row, categories)
+            except ValueError as exc:
+                result['skipped'] += 1
+                if len(result['errors']) < MAX_ERRORS:
+                    result['errors'].append({'row': number, 'error': str(exc)})
+                continue
+            chunk[product.url_key] = product
+            if len(chunk) >= chunk_size:
+                _upsert(chunk, result, stale)
+                chunk = {}
+        if chunk:
+            _upsert(chunk, result, stale)
+    except (UnicodeDecodeError, csv.Error) as exc:
+        raise ImportFileError(f"Can't read the file after row {result['rows']}: {exc}") from exc
+    finally:
+        if result['created'] or result['updated']:
+            _refresh_caches(stale)
+    elapsed = time.monotonic() - started
+    result['seconds'] = round(elapsed, 3)
+    result['rows_per_second'] = round(result['rows'] / elapsed) if elapsed else result['rows']
+    logger.info(
+        'Imported %(rows)s rows (%(created)s created, %(updated)s updated, %(skipped)s skipped) '
+        'in %(seconds)ss', result,
+    )
+    return result
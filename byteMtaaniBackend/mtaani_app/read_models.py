@@ -0,0 +1,99 @@
+"""Maintenance of the denormalized `OrderSummary` read model.
+
+Summaries are written by `OrderViewSet.create` inside the order transaction
+and patched with a single UPDATE whenever an order's status or its
+payment's status changes (see signals.py; bulk payment updates send
+`payment_status_changed`). `rebuild_summaries()` recreates
+them from the normalized tables; it backs the `rebuild_order_summaries`
+management command.
+"""
+
+from .models import Order, OrderSummary
+
+
+def _user_data(user):
+    return {'id': str(user.pk), 'username': user.username, 'email': user.email}
+
+
+def _item_data(product, quantity, price):
+    return {
+        'product_id': str(product.pk),
+        'product_name': product.product_name,
+        'quantity': quantity,
+        'price': str(price),
+    }
+
+
+def build_summary(order, items, user, payment_status=''):
+    """Return an unsaved `OrderSummary` for `order`.
+
+    `items` is an iterable of `(product, quantity, price)` tuples.
+    """
+    item_data = [_item_data(product, quantity, price) for product, quantity, price in items]
+    return OrderSummary(
+        order=order,
+        user=user,
+        status=order.status,
+        payment_status=payment_status,
+        total_amount=order.total_amount,
+        item_count=sum(item['quantity'] for item in item_data),
+        data={'user': _user_data(user), 'items': item_data},
+        created_at=order.created_at,
+    )
+
+
+def record_order(order, lines, user):
+    """Create the summary of a freshly created order; `lines` are `(product, quantity)` tuples."""
+    summary = build_summary(order, [(product, qty, product.price) for product, qty in lines], user)
+    summary.save(force_insert=True)
+    return summary
+
+
+def sync_order_status(order):
+    """Copy `order.status` to its summary (no-op when unchanged)."""
+    OrderSummary.objects.filter(order_id=order.pk).exclude(status=order.status).update(status=order.status)
+
+
+def sync_payment_status(payment):
+    """Copy `payment.status` to the summary of its order (no-op when unchanged)."""
+    OrderSummary.objects.filter(order_id=payment.order_id).exclude(
+        payment_status=payment.status
+    ).update(payment_status=payment.status)
+
+
+def sync_payment_statuses(payments):
+    """Bulk version of `sync_payment_status`: one UPDATE per distinct status."""
+    by_status = {}
+    for payment in payments:
+        by_status.setdefault(payment.status, []).append(payment.order_id)
+    for payment_status, order_ids in by_status.items():
+        OrderSummary.objects.filter(order_id__in=order_ids).exclude(
+            payment_status=payment_status
+        ).update(payment_status=payment_status)
+
+
+def rebuild_summaries(queryset=None, batch_size=500):
+    """Recreate summaries for `queryset` (default: every order) in batches; returns the count."""
+    queryset = (queryset if queryset is not None else Order.objects.all()).select_related(
+        'user', 'payment'
+    ).prefetch_related('items__product').order_by('pk')
+
+    fields = ['user', 'status', 'payment_status', 'total_amount', 'item_count', 'data', 'created_at', 'updated_at']
+    total = 0
+    batch = []
+    for order in queryset.iterator(chunk_size=batch_size):
+        payment = getattr(order, 'payment', None)
+        batch.append(build_summary(
+            order,
+            [(item.product, item.quantity, item.price) for item in order.items.all()],
+            order.user,
+            payment.status if payment else '',
+        ))
+        if len(batch) >= batch_size:
+            OrderSummary.objects.bulk_create(batch, update_conflicts=True, unique_fields=['order'], update_fields=fields)
+            total += len(batch)
+            batch = []
+    if batch:
+        OrderSummary.objects.bulk_create(batch, update_conflicts=True, unique_fields=['order'], update_fields=fields)
+        total += len(batch)
+    return total
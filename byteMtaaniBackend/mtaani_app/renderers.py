@@ -0,0 +1,107 @@
+"""JSON renderer backed by orjson, and CSV/NDJSON renderers for exports.
+
+orjson is an optional dependency: without it `FastJSONRenderer` is the
+plain DRF `JSONRenderer`. With it, output is byte-for-byte what
+`JSONRenderer` produces for API data (compact separators, unescaped
+unicode, U+2028/U+2029 escaped); types orjson doesn't handle the same way
+(datetimes, Decimal, lazy strings, querysets) are passed to DRF's own
+encoder. Indented output (``Accept: application/json; indent=4``) always
+goes through `JSONRenderer`.
+
+`CSVRenderer` and `NDJSONRenderer` let export views negotiate ``?format=csv``
+/ ``?format=ndjson`` (or the Accept header); exports stream their rows with
+`csv_lines()` / `ndjson_lines()` themselves (see exports.py), the renderers
+only render the other responses of those views (errors) in the same format.
+"""
+
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+_LINE_SEPARATOR = '\u2028'.encode()
+_PARAGRAPH_SEPARATOR = '\u2029'.encode()
+
+_encoder = JSONEncoder()
+
+
+class FastJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            ret = orjson.dumps(
+                data,
+                default=_encoder.default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS,
+            )
+        except orjson.JSONEncodeError:
+            # e.g. integers beyond 64 bits; let the stdlib encoder decide
+            return super().render(data, accepted_media_type, renderer_context)
+
+        # match JSONRenderer, which escapes these for JavaScript compatibility
+        if _LINE_SEPARATOR in ret:
+            ret = ret.replace(_LINE_SEPARATOR, b'\\u2028')
+        if _PARAGRAPH_SEPARATOR in ret:
+            ret = ret.replace(_PARAGRAPH_SEPARATOR, b'\\u2029')
+        return ret
+
+
+class _Line:
+    """File-like object whose write() returns what was written, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(header, rows):
+    """Yield the CSV lines of `rows` (value tuples) after the `header` line."""
+    writer = csv.writer(_Line())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def ndjson_lines(header, rows):
+    """Yield one JSON object per row, keyed by `header`."""
+    for row in rows:
+        yield json.dumps(dict(zip(header, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+def _records(data):
+    records = data if isinstance(data, list) else [data]
+    records = [record if isinstance(record, dict) else {'detail': record} for record in records]
+    header = list(dict.fromkeys(key for record in records for key in record))
+    return header, [[record.get(key) for key in header] for record in records]
+
+
+class CSVRenderer(BaseRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return ''.join(csv_lines(*_records(data))).encode()
+
+
+class NDJSONRenderer(BaseRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return ''.join(ndjson_lines(*_records(data))).encode()
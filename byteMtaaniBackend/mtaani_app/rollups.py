@@ -0,0 +1,236 @@
+"""Hourly and daily sales rollups.
+
+Revenue per day, category or product used to be aggregated from the raw
+orders, order items and payments on every request. `SalesRollup` (orders
+and revenue per hour/day) and `ProductSalesRollup` (orders, units and item
+revenue per product per hour/day, with the product's category at the
+time) hold the running totals instead, so the analytics queries read a few
+hundred rows whatever the size of the raw tables.
+
+A payment is counted once it is `successful`, in the hour and day (local
+time) it was paid (`paid_at`, else `created_at`):
+
+- `payments_succeeded()` runs after the commit that made payments
+  successful (the `payment_status_changed` signal of the bulk paths, the
+  Payment post_save of the others);
+- `record_payments()` claims the payments by setting `rolled_up_at`
+  (rows locked with SKIP LOCKED, so concurrent runs take different ones)
+  and adds their totals in the same transaction, so each payment is
+  counted exactly once, one row update per touched bucket and batch;
+- the `rollup_sales` beat task counts, every SALES_ROLLUP_INTERVAL
+  seconds, whatever the signal handlers missed (crash, error).
+
+`rebuild()` (`manage.py backfill_sales_rollups --rebuild`) recounts a range
+of days from scratch. Payments that stop being successful later (refunds)
+aren't subtracted; rebuild the affected days.
+"""
+
+import logging
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import OrderItem, Payment, ProductSalesRollup, SalesRollup
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ('hour', 'day')
+
+
+def bucket(period, moment):
+    """Start of the local hour or day containing `moment`."""
+    local = timezone.localtime(moment)
+    if period == 'hour':
+        return local.replace(minute=0, second=0, microsecond=0)
+    return local.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def moment(value):
+    """Aware datetime of a date (its local midnight) or a naive/aware datetime."""
+    if not isinstance(value, datetime):
+        return timezone.make_aware(datetime.combine(value, time.min))
+    return value if timezone.is_aware(value) else timezone.make_aware(value)
+
+
+def day_start(value):
+    """Start of the local day of a date or datetime."""
+    return bucket('day', moment(value))
+
+
+def _increment(model, key, changes, defaults=None):
+    """Add `changes` ({field: amount}) to the row identified by `key`.
+
+    A missing row is created with `changes` and `defaults`.
+    """
+    rows = model.objects.filter(**key)
+    if rows.update(**{field: F(field) + amount for field, amount in changes.items()}):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**key, **changes, **(defaults or {}))
+    except IntegrityError:
+        # created concurrently
+        rows.update(**{field: F(field) + amount for field, amount in changes.items()})
+
+
+def _totals(payments):
+    """Return the rollup increments of `payments` (pk, order id, amount, paid at)."""
+    items = defaultdict(list)
+    for order_id, product_id, category_id, quantity, price in (
+        OrderItem.objects.filter(order_id__in=[order_id for _, order_id, _, _ in payments])
+        .values_list('order_id', 'product_id', 'product__category_id', 'quantity', 'price')
+    ):
+        items[order_id].append((product_id, category_id, quantity, price))
+
+    totals = defaultdict(lambda: {'orders': 0, 'revenue': Decimal(0)})
+    products = defaultdict(lambda: {'orders': 0, 'units': 0, 'revenue': Decimal(0)})
+    categories = {}
+    for _, order_id, amount, paid_at in payments:
+        lines = defaultdict(lambda: [0, Decimal(0)])
+        for product_id, category_id, quantity, price in items[order_id]:
+            lines[product_id][0] += quantity
+            lines[product_id][1] += quantity * price
+            categories[product_id] = category_id
+        for period in PERIODS:
+            start = bucket(period, paid_at)
+            totals[period, start]['orders'] += 1
+            totals[period, start]['revenue'] += amount
+            for product_id, (units, revenue) in lines.items():
+                entry = products[period, start, product_id]
+                entry['orders'] += 1
+                entry['units'] += units
+                entry['revenue'] += revenue
+    return totals, products, categories
+
+
+def record_payments(pks=None, batch_size=None):
+    """Count successful payments not yet in the rollups (only `pks`, if given).
+
+    Handles one batch; returns the number of payments counted.
+    """
+    batch_size = batch_size or settings.SALES_ROLLUP_BATCH_SIZE
+    with transaction.atomic():
+        pending = Payment.objects.select_for_update(skip_locked=True).filter(
+            status='successful', rolled_up_at__isnull=True,
+        )
+        if pks is not None:
+            pending = pending.filter(pk__in=list(pks))
+        payments = list(
+            pending.order_by()
+            .values_list('pk', 'order_id', 'amount', Coalesce('paid_at', 'created_at'))[:batch_size]
+        )
+        if not payments:
+            return 0
+        Payment.objects.filter(pk__in=[pk for pk, _, _, _ in payments]).update(rolled_up_at=timezone.now())
+
+        totals, products, categories = _totals(payments)
+        # a fixed order keeps concurrent batches from deadlocking
+        for (period, start), changes in sorted(totals.items()):
+            _increment(SalesRollup, {'period': period, 'start': start}, changes)
+        for (period, start, product_id), changes in sorted(products.items(), key=str):
+            # new rows take the category the product has now
+            _increment(
+                ProductSalesRollup, {'period': period, 'start': start, 'product_id': product_id},
+                changes, {'category_id': categories[product_id]},
+            )
+    return len(payments)
+
+
+def record_pending(batch_size=None):
+    """Count every successful payment not yet in the rollups; returns how many."""
+    batch_size = batch_size or settings.SALES_ROLLUP_BATCH_SIZE
+    total = 0
+    while True:
+        counted = record_payments(batch_size=batch_size)
+        total += counted
+        if counted < batch_size:
+            return total
+
+
+def payments_succeeded(payments):
+    """Count the successful ones of `payments` (after their transaction committed)."""
+    pks = [
+        payment.pk for payment in payments
+        if payment.status == 'successful' and getattr(payment, 'rolled_up_at', None) is None
+    ]
+    if not pks:
+        return
+    try:
+        record_payments(pks, batch_size=len(pks))
+    except Exception:
+        # the rollup_sales beat task counts them later
+        logger.exception('Failed to roll up payments %s', pks)
+
+
+def rebuild(since=None, until=None, batch_size=None):
+    """Recount the rollups of the local days in [since, until) (all when unbounded).
+
+    Returns the number of payments counted.
+    """
+    since = day_start(since) if since else None
+    until = day_start(until) if until else None
+    starts, paid = Q(), Q()
+    if since:
+        starts &= Q(start__gte=since)
+        paid &= Q(paid__gte=since)
+    if until:
+        starts &= Q(start__lt=until)
+        paid &= Q(paid__lt=until)
+    with transaction.atomic():
+        SalesRollup.objects.filter(starts).delete()
+        ProductSalesRollup.objects.filter(starts).delete()
+        (
+            Payment.objects.annotate(paid=Coalesce('paid_at', 'created_at'))
+            .filter(paid, status='successful').update(rolled_up_at=None)
+        )
+        # recount inside the same transaction so readers never see the range half empty
+        return record_pending(batch_size)
+
+
+def _money(value):
+    # SQLite sums decimals without their scale
+    return f'{value or 0:.2f}'
+
+
+def _range(period, start, end, default_days):
+    end = end or timezone.now()
+    start = start or end - timedelta(days=default_days)
+    return bucket(period, start), end
+
+
+def sales(period='day', start=None, end=None):
+    """Orders and revenue per hour/day between `start` and `end` (datetimes)."""
+    start, end = _range(period, start, end, 2 if period == 'hour' else 30)
+    return [
+        {'start': row['start'], 'orders': row['orders'], 'revenue': _money(row['revenue'])}
+        for row in SalesRollup.objects.filter(period=period, start__gte=start, start__lt=end)
+        .order_by('start').values('start', 'orders', 'revenue')
+    ]
+
+
+def top(dimension, period='day', start=None, end=None, limit=20):
+    """Totals per category or product between `start` and `end`, highest revenue first."""
+    start, end = _range(period, start, end, 2 if period == 'hour' else 30)
+    if dimension == 'category':
+        fields = {'category_id': 'id', 'category__Category_name': 'name'}
+    else:
+        fields = {'product_id': 'id', 'product__product_name': 'name'}
+    rows = (
+        ProductSalesRollup.objects.filter(period=period, start__gte=start, start__lt=end)
+        .values(*fields)
+        .annotate(total_orders=Sum('orders'), total_units=Sum('units'), total_revenue=Sum('revenue'))
+        .order_by('-total_revenue')[:limit]
+    )
+    return [
+        {
+            **{name: row[field] for field, name in fields.items()},
+            'orders': row['total_orders'], 'units': row['total_units'], 'revenue': _money(row['total_revenue']),
+        }
+        for row in rows
+    ]
@@ -0,0 +1,292 @@
+"""Full-text product search over name, category name and description.
+
+`search_products(queryset, text)` keeps the products matching every term of
+`text` as a prefix (``sam gal`` finds "Samsung Galaxy"), best matches first:
+a term found in the name counts more than one found in the category name,
+which counts more than one in the description.
+
+PostgreSQL: `Product.search_vector` holds a weighted tsvector (name A,
+category B, description C) with the ``simple`` configuration (no stemming
+or stop words, so English and Swahili names behave the same), behind a GIN
+index created after `migrate` by `ensure_search_index()`. The search is a
+``term:* & ...`` tsquery ranked with ts_rank. Vectors are kept current by
+the product and category signals (`product_saved()`, `category_saved()`);
+rows written in bulk (bulk_create, .update()) are indexed with
+`manage.py rebuild_search_index`.
+
+Other databases: the same documents are tokenized into an in-process
+`InvertedIndex` (token -> {product: weight}), built on first use and
+rebuilt when the ``search:version`` counter in the cache moves (the same
+signals bump it). Prefix terms are resolved by binary search
+over the sorted vocabulary, and at most SEARCH_FALLBACK_MAX_RESULTS best
+matches are returned. Rebuilding costs a full scan of the catalog, which
+suits development and small catalogs; use PostgreSQL for large ones
+(`manage.py benchmark_search` compares both with a LIKE scan).
+"""
+
+import heapq
+import logging
+import re
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Case, F, FloatField, OuterRef, Subquery, Value, When
+
+from .models import Category, Product
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'search:version'
+INDEX_NAME = 'mtaani_product_search_gin'
+CONFIG = 'simple'
+MAX_TERMS = 8
+
+# fields a product's search document is built from
+SEARCH_FIELDS = frozenset({'product_name', 'description', 'category_id'})
+
+# term weights of the fallback index, in line with ts_rank's defaults for
+# A/B/C; a prefix match counts a bit less than the whole word
+NAME_WEIGHT, CATEGORY_WEIGHT, DESCRIPTION_WEIGHT = 1.0, 0.4, 0.2
+PREFIX_FACTOR = 0.8
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text.lower()) if text else []
+
+
+def uses_postgres(using=DEFAULT_DB_ALIAS):
+    return connections[using].vendor == 'postgresql'
+
+
+def search_vector():
+    """The expression a product's `search_vector` is computed from (PostgreSQL only)."""
+    # django.contrib.postgres needs psycopg; only import it on the PostgreSQL path
+    from django.contrib.postgres.search import SearchVector
+
+    category_name = Subquery(Category.objects.filter(pk=OuterRef('category_id')).values('Category_name')[:1])
+    return (
+        SearchVector('product_name', weight='A', config=CONFIG)
+        + SearchVector(category_name, weight='B', config=CONFIG)
+        + SearchVector('description', weight='C', config=CONFIG)
+    )
+
+
+def index_products(queryset):
+    """Recompute `search_vector` of the products in `queryset` (one UPDATE)."""
+    return queryset.update(search_vector=search_vector())
+
+
+def ensure_search_index(using=DEFAULT_DB_ALIAS, **kwargs):
+    """Create the GIN index on `search_vector` (PostgreSQL only; post_migrate hook).
+
+    Migrations aren't kept in this repository and the index can't be
+    declared portably in Product.Meta, so it is created here.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS {qn(INDEX_NAME)} '
+            f'ON {qn(Product._meta.db_table)} USING gin ({qn("search_vector")})'
+        )
+
+
+def _postgres_search(queryset, terms, name_only, ranked):
+    from django.contrib.postgres.search import SearchQuery, SearchRank
+
+    weights = 'A' if name_only else ''
+    query = SearchQuery(
+        ' & '.join(f'{term}:*{weights}' for term in terms), search_type='raw', config=CONFIG,
+    )
+    queryset = queryset.filter(search_vector__matches=query)
+    if ranked:
+        return queryset
+    return (
+        queryset.annotate(search_rank=SearchRank(F('search_vector'), query))
+        .order_by('-search_rank', '-created_at', '-pk')
+    )
+
+
+class InvertedIndex:
+    """Token -> {document: weight} postings over product search documents."""
+
+    def __init__(self, documents):
+        """`documents` yields `(pk, name, category name, description)`, best first for ties."""
+        self.ids = []
+        postings = defaultdict(dict)
+        for doc, (pk, *fields) in enumerate(documents):
+            self.ids.append(pk)
+            for weight, text in zip((NAME_WEIGHT, CATEGORY_WEIGHT, DESCRIPTION_WEIGHT), fields):
+                for token in tokenize(text):
+                    entry = postings[token]
+                    if entry.get(doc, 0) < weight:
+                        entry[doc] = weight
+        self.postings = dict(postings)
+        self.vocabulary = sorted(self.postings)
+
+    def _matches(self, term, name_only):
+        """Return {document: score} of the documents with a token starting with `term`."""
+        matched = {}
+        for position in range(bisect_left(self.vocabulary, term), len(self.vocabulary)):
+            token = self.vocabulary[position]
+            if not token.startswith(term):
+                break
+            factor = 1.0 if token == term else PREFIX_FACTOR
+            for doc, weight in self.postings[token].items():
+                if name_only and weight != NAME_WEIGHT:
+                    continue
+                score = weight * factor
+                if matched.get(doc, 0) < score:
+                    matched[doc] = score
+        return matched
+
+    def search(self, terms, limit, name_only=False):
+        """Return up to `limit` `(pk, score)` pairs matching every term, best first."""
+        scores = None
+        # rarest terms first keeps the intersections small
+        for matched in sorted((self._matches(term, name_only) for term in terms), key=len):
+            if scores is None:
+                scores = matched
+            else:
+                scores = {doc: score + matched[doc] for doc, score in scores.items() if doc in matched}
+            if not scores:
+                return []
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
+        return [(self.ids[doc], score) for doc, score in best]
+
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+def _version():
+    try:
+        return cache.get(VERSION_KEY, 0)
+    except Exception:
+        logger.exception('Search index version unavailable')
+        return _index_version
+
+
+def build_index():
+    documents = (
+        Product.objects.order_by('-created_at', '-pk')
+        .values_list('pk', 'product_name', 'category__Category_name', 'description')
+        .iterator(chunk_size=5000)
+    )
+    return InvertedIndex(documents)
+
+
+def get_index():
+    """Return this process's fallback index, rebuilt if the catalog changed since it was built."""
+    global _index, _index_version
+    version = _version()
+    if _index is not None and version == _index_version:
+        return _index
+    with _index_lock:
+        if _index is None or version != _index_version:
+            _index, _index_version = build_index(), version
+        return _index
+
+
+def bump_version():
+    """Mark the fallback indexes of every process stale."""
+    try:
+        cache.add(VERSION_KEY, 0, None)
+        cache.incr(VERSION_KEY)
+    except Exception:
+        logger.exception('Failed to bump the search index version')
+
+
+def _fallback_search(queryset, terms, name_only, ranked):
+    hits = get_index().search(terms, settings.SEARCH_FALLBACK_MAX_RESULTS, name_only=name_only)
+    if not hits:
+        return queryset.none()
+    queryset = queryset.filter(pk__in=[pk for pk, _ in hits])
+    if ranked:
+        return queryset
+    # scores take few distinct values: one IN list per score, not a CASE branch per product
+    by_score = defaultdict(list)
+    for pk, score in hits:
+        by_score[score].append(pk)
+    return (
+        queryset.annotate(search_rank=Case(
+            *(When(pk__in=pks, then=Value(score)) for score, pks in by_score.items()), output_field=FloatField(),
+        ))
+        .order_by('-search_rank', '-created_at', '-pk')
+    )
+
+
+def search_products(queryset, text, name_only=False):
+    """Filter `queryset` to the products matching `text`, annotated with `search_rank`.
+
+    With `name_only`, terms must be found in the product name. A `text`
+    without any word leaves the queryset as it is; on an already searched
+    queryset this only narrows it, keeping the first ranking.
+    """
+    terms = list(dict.fromkeys(tokenize(text)))[:MAX_TERMS]
+    if not terms:
+        return queryset
+    ranked = 'search_rank' in queryset.query.annotations
+    if uses_postgres(queryset.db):
+        return _postgres_search(queryset, terms, name_only, ranked)
+    return _fallback_search(queryset, terms, name_only, ranked)
+
+
+def product_saved(product, created, changed=None):
+    """Refresh the search document of `product` if the save touched it.
+
+    Called from the post_save handler: on PostgreSQL the vector is updated
+    in the same transaction, elsewhere the fallback indexes are marked stale
+    once it commits.
+    """
+    if not created and changed is not None and not (changed & SEARCH_FIELDS):
+        return
+    if uses_postgres():
+        index_products(Product.objects.filter(pk=product.pk))
+    else:
+        transaction.on_commit(bump_version)
+
+
+def product_deleted(product):
+    if not uses_postgres():
+        transaction.on_commit(bump_version)
+
+
+def category_saved(category, created):
+    """Refresh the search documents of the products of a renamed category."""
+    loaded = getattr(category, '_loaded_values', None)
+    if created or (loaded is not None and loaded.get('Category_name') == category.Category_name):
+        return
+    if uses_postgres():
+        index_products(Product.objects.filter(category_id=category.pk))
+    else:
+        transaction.on_commit(bump_version)
+
+
+def rebuild_index(batch_size=5000):
+    """(Re)index every product in pk batches; returns the number of products.
+
+    Without PostgreSQL this only marks the fallback indexes stale.
+    """
+    if not uses_postgres():
+        bump_version()
+        return Product.objects.count()
+    count, last_pk = 0, None
+    while True:
+        batch = Product.objects.order_by('pk')
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        pks = list(batch.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return count
+        count += index_products(Product.objects.filter(pk__in=pks))
+        last_pk = pks[-1]
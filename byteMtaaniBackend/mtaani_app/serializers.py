@@ -1,46 +1,101 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from .models import Category, Product, Order, OrderItem, Payment
+from .models import Category, Product, Order, OrderItem, Payment, OrderSummary
 
 User = get_user_model()
 
 
-class UserSerializer(serializers.ModelSerializer):
+class EagerLoadingMixin:
+    """Let a serializer declare the relations its output reads.
+
+    `select_related_fields` and `prefetch_related_fields` list the relations
+    a serializer needs for its own fields. Readable nested serializers that
+    also use this mixin contribute theirs, prefixed with the field's source
+    (single relations are joined, many relations prefetched), so a viewset
+    only calls `setup_eager_loading()` on its top-level serializer class.
+    """
+
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    _eager_relations_cache = {}
+
+    @classmethod
+    def eager_relations(cls):
+        """Return `(select_related, prefetch_related)` lookups for this serializer's output."""
+        if cls in EagerLoadingMixin._eager_relations_cache:
+            return EagerLoadingMixin._eager_relations_cache[cls]
+
+        select = list(cls.select_related_fields)
+        prefetch = list(cls.prefetch_related_fields)
+        for field in cls().fields.values():
+            if field.write_only:
+                continue
+            many = isinstance(field, serializers.ListSerializer)
+            nested = field.child if many else field
+            if not isinstance(nested, EagerLoadingMixin):
+                continue
+            nested_select, nested_prefetch = type(nested).eager_relations()
+            source = field.source
+            if many:
+                prefetch.append(source)
+                prefetch.extend(f'{source}__{rel}' for rel in nested_select + nested_prefetch)
+            else:
+                select.append(source)
+                select.extend(f'{source}__{rel}' for rel in nested_select)
+                prefetch.extend(f'{source}__{rel}' for rel in nested_prefetch)
+
+        relations = (list(dict.fromkeys(select)), list(dict.fromkeys(prefetch)))
+        EagerLoadingMixin._eager_relations_cache[cls] = relations
+        return relations
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """Apply this serializer's select_related/prefetch_related lookups to `queryset`."""
+        select, prefetch = cls.eager_relations()
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
+
+
+class UserSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('id', 'username', 'email', 'date_joined')
         read_only_fields = ('id', 'date_joined')
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(EagerLoadingMixin, serializers.ModelSerializer):
     # expose `Category_name` as `name` in the API for compatibility
     name = serializers.CharField(source='Category_name', read_only=True)
-    # expose DB field `slug` as `url_key` in API (source maps slug to url_key)
-    url_key = serializers.CharField(source='slug', read_only=True)
+    url_key = serializers.CharField(read_only=True)
 
     class Meta:
         model = Category
-        # expose `url_key` (from slug) and `name` (from Category_name) to clients
+        # expose `url_key` and `name` (from Category_name) to clients
         fields = ('id', 'name', 'url_key', 'created_at')
         read_only_fields = ('id', 'created_at')
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     # expose `product_name` as `name` for API clients
     name = serializers.CharField(source='product_name', read_only=True)
-    # expose DB field `slug` as `url_key` in API (source maps slug to url_key)
-    url_key = serializers.CharField(source='slug', read_only=True)
+    url_key = serializers.CharField(read_only=True)
 
     class Meta:
         model = Product
-        # expose `url_key` (from slug) and `name` (from product_name) to clients
+        # expose `url_key` and `name` (from product_name) to clients
         fields = (
             'id', 'name', 'url_key', 'description', 'price', 'stock', 'in_stock', 'category', 'image_url', 'created_at', 'updated_at'
         )
         read_only_fields = ('id', 'in_stock', 'created_at', 'updated_at')
 
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(EagerLoadingMixin, serializers.ModelSerializer):
+    select_related_fields = ('product',)
+
     product = ProductSerializer(read_only=True)
     product_id = serializers.UUIDField(write_only=True, required=True)
 
@@ -50,7 +105,9 @@ class OrderItemSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'order', 'price')
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(EagerLoadingMixin, serializers.ModelSerializer):
+    select_related_fields = ('user',)
+
     items = OrderItemSerializer(many=True, write_only=True)
     user = UserSerializer(read_only=True)
     # user_id is optional: when authenticated, request.user will be used
@@ -62,8 +119,18 @@ class OrderSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'status', 'total_amount', 'created_at')
 
 
-class PaymentSerializer(serializers.ModelSerializer):
+class PaymentSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     class Meta:
         model = Payment
-        fields = ('id', 'user', 'order', 'amount', 'method', 'status', 'transaction_id', 'paid_at')
-        read_only_fields = ('id',)
+        fields = (
+            'id', 'user', 'order', 'amount', 'method', 'status', 'transaction_id', 'checkout_request_id',
+            'mpesa_receipt_number', 'paid_at',
+        )
+        read_only_fields = ('id', 'checkout_request_id', 'mpesa_receipt_number')
+
+
+class OrderSummarySerializer(EagerLoadingMixin, serializers.ModelSerializer):
+    class Meta:
+        model = OrderSummary
+        fields = ('order', 'user', 'status', 'payment_status', 'total_amount', 'item_count', 'data', 'created_at')
+        read_only_fields = fields
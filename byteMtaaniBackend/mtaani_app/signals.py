@@ -1,14 +1,90 @@
+from celery.signals import task_postrun
+from django.core.signals import request_finished
+from django.db import transaction
 from django.db.models.signals import post_save, post_delete
-from django.dispatch import receiver
-from django.core.cache import cache
-from .models import Product
+from django.dispatch import Signal, receiver
+from . import catalog_cache, dispatch, facets, read_models, rollups, search
+from .models import Category, Product, Order, Payment
+
+# Sent (after commit) by code that changes payment statuses with bulk
+# UPDATEs, which don't fire post_save; `payments` is the list of updated
+# Payment instances carrying their new status.
+payment_status_changed = Signal()
+
+
+def _changed_fields(instance, update_fields):
+    """Return the set of attributes a save changed, or None when unknown."""
+    loaded = getattr(instance, '_loaded_values', None)
+    if loaded is None:
+        return set(update_fields) if update_fields else None
+    changed = {name for name, value in loaded.items() if getattr(instance, name) != value}
+    if update_fields:
+        changed &= {instance._meta.get_field(name).attname for name in update_fields}
+    return changed
 
 
 @receiver(post_save, sender=Product)
-def invalidate_product_cache_on_save(sender, instance, **kwargs):
-    cache.delete('all_properties')
+def invalidate_product_cache_on_save(sender, instance, created, update_fields=None, **kwargs):
+    changed = None if created else _changed_fields(instance, update_fields)
+    old_category = getattr(instance, '_loaded_values', {}).get('category_id')
+    # only touch the cache once the new values are visible to other readers
+    transaction.on_commit(lambda: catalog_cache.product_saved(instance, created, changed, old_category))
+    search.product_saved(instance, created, changed)
+    facets.product_saved(instance, created, getattr(instance, '_loaded_values', None), update_fields)
+    # the saved values are the baseline for the next save of this instance
+    instance._loaded_values = {f.attname: getattr(instance, f.attname) for f in instance._meta.concrete_fields}
 
 
 @receiver(post_delete, sender=Product)
 def invalidate_product_cache_on_delete(sender, instance, **kwargs):
-    cache.delete('all_properties')
+    # delete() clears instance.pk before the commit
+    pk = instance.pk
+    transaction.on_commit(lambda: catalog_cache.product_deleted(pk))
+    search.product_deleted(instance)
+    facets.product_deleted(instance)
+
+
+@receiver(post_save, sender=Category)
+def reindex_renamed_category(sender, instance, created, **kwargs):
+    search.category_saved(instance, created)
+    instance._loaded_values = {f.attname: getattr(instance, f.attname) for f in instance._meta.concrete_fields}
+
+
+@receiver(post_save, sender=Order)
+def sync_order_summary_status(sender, instance, created, **kwargs):
+    # new orders get their summary from OrderViewSet.create
+    if not created:
+        read_models.sync_order_status(instance)
+
+
+@receiver(post_save, sender=Payment)
+def sync_order_summary_payment(sender, instance, **kwargs):
+    read_models.sync_payment_status(instance)
+
+
+@receiver(post_save, sender=Payment)
+def roll_up_successful_payment(sender, instance, **kwargs):
+    if instance.status == 'successful' and instance.rolled_up_at is None:
+        transaction.on_commit(lambda: rollups.payments_succeeded([instance]))
+
+
+@receiver(payment_status_changed)
+def sync_order_summaries_payments(sender, payments, **kwargs):
+    read_models.sync_payment_statuses(payments)
+
+
+@receiver(payment_status_changed)
+def roll_up_payments(sender, payments, **kwargs):
+    # sent after commit
+    rollups.payments_succeeded(payments)
+
+
+# tasks dispatched during a request or a task are published once it is over
+@receiver(request_finished)
+def flush_dispatched_tasks(sender, **kwargs):
+    dispatch.flush()
+
+
+@task_postrun.connect
+def flush_tasks_dispatched_by_task(sender=None, **kwargs):
+    dispatch.flush()
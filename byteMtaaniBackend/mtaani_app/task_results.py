@@ -0,0 +1,47 @@
+"""Cleanup of Celery results stored in the database.
+
+Results used to go to django_celery_results ("django-db"), one row per task
+in the main database, never deleted. `purge_task_results()` (hourly
+`purge_task_results` beat task, and the management command of the same
+name) deletes task and group results older than CELERY_RESULT_PURGE_AGE in
+small batches, so the cleanup never holds long locks on a busy table.
+"""
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+def _delete_in_batches(queryset, batch_size):
+    deleted = 0
+    while True:
+        pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        deleted += queryset.model.objects.filter(pk__in=pks).delete()[0]
+
+
+def purge_task_results(older_than=None, batch_size=1000):
+    """Delete stored Celery results finished more than `older_than` seconds ago.
+
+    Returns the number of task and group results deleted, or None when
+    django_celery_results isn't installed.
+    """
+    try:
+        from django_celery_results.models import GroupResult, TaskResult
+    except (ImportError, RuntimeError):
+        # not installed, or not in INSTALLED_APPS
+        return None
+    older_than = settings.CELERY_RESULT_PURGE_AGE if older_than is None else older_than
+    cutoff = timezone.now() - timedelta(seconds=older_than)
+    counts = {
+        'tasks': _delete_in_batches(TaskResult.objects.filter(date_done__lt=cutoff), batch_size),
+        'groups': _delete_in_batches(GroupResult.objects.filter(date_done__lt=cutoff), batch_size),
+    }
+    if counts['tasks'] or counts['groups']:
+        logger.info('Purged %(tasks)s task results and %(groups)s group results', counts)
+    return counts
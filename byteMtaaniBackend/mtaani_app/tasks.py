@@ -1,60 +1,178 @@
+import logging
+
 from celery import shared_task
 
+logger = logging.getLogger(__name__)
 
-@shared_task
+
+@shared_task(ignore_result=False)
 def add(x, y):
-    """Simple test task to verify Celery is working."""
+    """Simple test task to verify Celery is working (its result is kept)."""
     return x + y
 
 
-@shared_task
+@shared_task(ignore_result=True)
 def send_payment_confirmation_email(user_email: str, subject: str, message: str):
-    """Send a payment confirmation email asynchronously.
+    """Queue an email on the outbox (see emails.py).
 
-    This task uses Django's email backend configured in settings. The project
-    should configure SMTP/email settings in production.
+    Kept for tasks queued before the outbox existed; new code calls the
+    `emails.queue_*` functions directly.
     """
-    from django.core.mail import send_mail
-    from django.conf import settings
+    from .emails import queue_email
 
-    send_mail(
-        subject,
-        message,
-        getattr(settings, "DEFAULT_FROM_EMAIL", "no-reply@example.com"),
-        [user_email],
-        fail_silently=False,
-    )
+    queue_email(user_email, subject, message)
 
 
-@shared_task
+@shared_task(ignore_result=True)
 def send_booking_confirmation_email(order_id: str):
-    """Send booking/order confirmation email asynchronously.
+    """Queue the booking confirmation of an order on the outbox (see emails.py).
 
-    The task loads the Order and sends a confirmation email to the user's email
-    using Django's configured email backend.
+    Kept for tasks queued before the outbox existed; new code calls
+    `emails.queue_booking_confirmation()`.
     """
-    from django.core.mail import send_mail
-    from django.conf import settings
+    from .emails import queue_booking_confirmation
     from .models import Order
 
+    order = Order.objects.filter(pk=order_id).first()
+    if order is None:
+        return False
+    queue_booking_confirmation(order)
+    return True
+
+
+@shared_task(ignore_result=True)
+def flush_email_outbox():
+    """Send the due outbox emails in batches over one SMTP connection.
+
+    Queued a few seconds after new messages and scheduled through
+    CELERY_BEAT_SCHEDULE for retries; see emails.py.
+    """
+    from .emails import flush_outbox
+
+    return flush_outbox()
+
+
+@shared_task(bind=True, max_retries=3)
+def initiate_mpesa_payment(self, payment_id: str, phone: str):
+    """Send the STK push of a payment created by an asynchronous `initiate`.
+
+    Stores the CheckoutRequestID on the payment, or marks it failed when
+    Safaricom can't be reached or rejects the request. A push that reached
+    Safaricom is not retried: a second push would prompt the customer twice.
+    Only a push refused by the open circuit breaker (never sent) is retried,
+    after the breaker's cool-down. A payment that is no longer pending, or
+    already has a CheckoutRequestID (a redelivered task), is left alone.
+    """
+    from .models import Payment
+    from .mpesa import initiate_stk_push, CircuitOpenError
+
     try:
-        order = Order.objects.select_related('user').get(pk=order_id)
-    except Order.DoesNotExist:
+        payment = Payment.objects.get(pk=payment_id)
+    except Payment.DoesNotExist:
+        return False
+    if payment.status != "pending" or payment.checkout_request_id:
         return False
 
-    user_email = order.user.email if order.user and getattr(order.user, 'email', None) else None
-    if not user_email:
+    try:
+        resp = initiate_stk_push(
+            amount=float(payment.amount),
+            phone_number=phone,
+            account_reference=str(payment.order_id),
+            transaction_desc=f"Order {payment.order_id}",
+        )
+    except CircuitOpenError as exc:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=exc, countdown=exc.retry_after)
+        logger.warning("STK push for payment %s abandoned: %s", payment_id, exc)
+        payment.status = "failed"
+        payment.save()
+        return False
+    except Exception:
+        logger.exception("STK push for payment %s failed", payment_id)
+        payment.status = "failed"
+        payment.save()
         return False
 
-    subject = f"Booking confirmation — Order {order.id}"
-    message = f"Hello {order.user},\n\nYour booking (order id {order.id}) for KES {order.total_amount} has been received.\n\nThanks." 
+    payment.checkout_request_id = resp.get("CheckoutRequestID") or None
+    payment.transaction_id = payment.checkout_request_id
+    payment.save()
+    return True
 
-    send_mail(
-        subject,
-        message,
-        getattr(settings, "DEFAULT_FROM_EMAIL", "no-reply@example.com"),
-        [user_email],
-        fail_silently=False,
-    )
 
-    return True
+@shared_task
+def reconcile_hot_stock():
+    """Write Redis hot-SKU reservations back to the database and correct drift.
+
+    Scheduled through CELERY_BEAT_SCHEDULE; a no-op unless
+    INVENTORY_HOT_SKUS_ENABLED is set.
+    """
+    from .hot_stock import reconcile
+
+    return reconcile()
+
+
+@shared_task
+def reconcile_pending_payments():
+    """Settle stale pending M-Pesa payments from STK status queries.
+
+    Scheduled through CELERY_BEAT_SCHEDULE; see payments.py.
+    """
+    from .payments import reconcile_pending_payments as reconcile
+
+    return reconcile()
+
+
+@shared_task
+def drain_mpesa_callbacks():
+    """Apply M-Pesa callbacks queued on the Redis stream.
+
+    Scheduled through CELERY_BEAT_SCHEDULE; see callback_stream.py. Each run
+    handles at most ten batches so runs stay short under load.
+    """
+    from .callback_stream import drain
+
+    return drain(max_batches=10)
+
+
+@shared_task
+def purge_task_results():
+    """Delete Celery results left in the database by the old "django-db" backend.
+
+    Scheduled through CELERY_BEAT_SCHEDULE; see task_results.py.
+    """
+    from .task_results import purge_task_results as purge
+
+    return purge()
+
+
+@shared_task
+def relay_task_outbox():
+    """Publish dispatched tasks that their process couldn't hand to the broker.
+
+    Scheduled through CELERY_BEAT_SCHEDULE; see dispatch.py.
+    """
+    from .dispatch import relay
+
+    return relay()
+
+
+@shared_task(ignore_result=True)
+def rebuild_product_facets():
+    """Recount the product facet cells, correcting drift from untracked bulk writes.
+
+    Scheduled through CELERY_BEAT_SCHEDULE; see facets.py.
+    """
+    from .facets import rebuild
+
+    rebuild()
+
+
+@shared_task(ignore_result=True)
+def rollup_sales():
+    """Count successful payments the signal handlers didn't add to the sales rollups.
+
+    Scheduled through CELERY_BEAT_SCHEDULE; see rollups.py.
+    """
+    from .rollups import record_pending
+
+    record_pending()
@@ -1,3 +1,1935 @@
-from django.test import TestCase
+import base64
+import csv
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.core import mail
+from django.core.management import CommandError, call_command
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.signals import request_finished
+from django.db import OperationalError, connection, transaction
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase
+
+from . import cache_helpers, callback_stream, catalog_cache, dispatch, emails, exports, facets, hot_stock, inventory, metrics, mpesa, payments, product_import, read_models, rollups, search, signals, task_results, tasks
+from .fast_serializers import row_mapper
+from .inventory import InsufficientStock
+from .models import (
+    User, Category, Product, Order, OrderItem, Payment, OrderSummary, OutboundEmail, TaskOutbox, ProductFacetCount,
+    SalesRollup, ProductSalesRollup,
+)
+from .renderers import FastJSONRenderer
+from .serializers import CategorySerializer, ProductSerializer
+
+
+class ListQueryCountTests(APITestCase):
+    """List endpoints must issue a fixed number of queries whatever the row count.
+
+    Each endpoint is measured with a few rows and again with more rows; an N+1
+    regression (a missing select_related/prefetch_related declaration on a
+    serializer) makes the second count grow and fails the test.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'pass1234')
+        self.client.force_authenticate(self.user)
+        self.category = Category.objects.create(Category_name='Phones', url_key='phones')
+
+    def _add_rows(self, count):
+        for _ in range(count):
+            n = User.objects.count()
+            user = User.objects.create(username=f'user-{n}', email=f'user-{n}@example.com')
+            product = Product.objects.create(
+                product_name='Phone', price=Decimal('100.00'), category=self.category, stock=10,
+            )
+            order = Order.objects.create(user=user, total_amount=Decimal('100.00'))
+            OrderItem.objects.create(order=order, product=product, quantity=1, price=product.price)
+            Payment.objects.create(
+                user=user, order=order, amount=order.total_amount, method='mpesa', status='pending',
+                transaction_id=f'ws_CO_{order.pk}',
+            )
+
+    def assertConstantQueries(self, url, expected):
+        for count in (2, 8):
+            self._add_rows(count)
+            with self.assertNumQueries(expected):
+                response = self.client.get(url, HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code, 200)
+
+    def test_products_list(self):
+        # COUNT + page
+        self.assertConstantQueries(reverse('product-list'), 2)
+
+    def test_categories_list(self):
+        self.assertConstantQueries(reverse('category-list'), 2)
+
+    def test_customers_list(self):
+        self.assertConstantQueries(reverse('customer-list'), 2)
+
+    def test_orders_list(self):
+        # the nested user is joined into the page query
+        self.assertConstantQueries(reverse('order-list'), 2)
+
+    def test_orders_keyset_list(self):
+        # keyset pages skip the COUNT
+        self.assertConstantQueries(reverse('order-list') + '?cursor=', 1)
+
+    def test_payments_list(self):
+        self.assertConstantQueries(reverse('payment-list'), 2)
+
+
+class KeysetPaginationTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'pass1234')
+        self.client.force_authenticate(self.user)
+        now = timezone.now()
+        # two orders share a created_at, so the id breaks the tie
+        for minutes in (1, 2, 2, 3, 4):
+            order = Order.objects.create(user=self.user, total_amount=Decimal('10.00'))
+            Order.objects.filter(pk=order.pk).update(created_at=now - timedelta(minutes=minutes))
+        self.expected = [
+            str(pk) for pk in Order.objects.order_by('-created_at', '-id').values_list('pk', flat=True)
+        ]
+
+    def get(self, url, **params):
+        response = self.client.get(url, params, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_pages_follow_next_links_to_the_end(self):
+        page = self.get(reverse('order-list'), cursor='', page_size=2)
+        self.assertEqual(set(page), {'next', 'results'})
+        seen = [order['id'] for order in page['results']]
+        self.assertEqual(seen, self.expected[:2])
+        while page['next']:
+            page = self.get(page['next'])
+            self.assertLessEqual(len(page['results']), 2)
+            seen += [order['id'] for order in page['results']]
+        self.assertEqual(seen, self.expected)
+        self.assertIsNone(page['next'])
+
+    def test_last_page_has_no_next_link(self):
+        page = self.get(reverse('order-list'), pagination='keyset', page_size=5)
+        self.assertEqual(len(page['results']), 5)
+        self.assertIsNone(page['next'])
+
+    def test_invalid_cursors_are_not_found(self):
+        def encode(value):
+            return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+        cursors = [
+            'not base64!', encode('text'), encode(['2024-01-01T00:00:00+00:00']),
+            encode(['not a date', str(uuid.uuid4())]), encode(['2024-01-01T00:00:00+00:00', 'junk']),
+            encode(['2024-01-01T00:00:00+00:00', 42]),
+        ]
+        for name in ('order-list', 'product-list'):
+            for cursor in cursors:
+                response = self.client.get(reverse(name), {'cursor': cursor}, HTTP_ACCEPT='application/json')
+                self.assertEqual(response.status_code, 404, (name, cursor))
+
+
+class FastListSerializationTests(APITestCase):
+    """The .values() fast path must produce exactly what the serializers produce."""
+
+    def setUp(self):
+        self.category = Category.objects.create(Category_name='Phones', url_key='phones')
+        Product.objects.create(
+            product_name='Phone \u2028 line', price=Decimal('100.5'), category=self.category, stock=3,
+        )
+        Product.objects.create(
+            product_name='Case', url_key='case', price=Decimal('9.99'), category=self.category, stock=0,
+            description='',
+        )
+
+    def test_row_mapper_matches_serializers(self):
+        for serializer_class in (ProductSerializer, CategorySerializer):
+            model = serializer_class.Meta.model
+            queryset = model.objects.order_by('created_at', 'pk')
+            mapper = row_mapper(serializer_class)
+            fast = FastJSONRenderer().render(mapper.map_rows(queryset.values(*mapper.columns)))
+            expected = JSONRenderer().render(serializer_class(queryset, many=True).data)
+            self.assertEqual(fast, expected)
+
+    def test_list_endpoints_use_fast_path(self):
+        for name, serializer_class in (('product-list', ProductSerializer), ('category-list', CategorySerializer)):
+            queryset = serializer_class.Meta.model.objects.all()
+            expected = JSONRenderer().render(serializer_class(queryset, many=True).data)
+            with self.settings(FAST_LIST_SERIALIZATION=True):
+                fast = self.client.get(reverse(name), HTTP_ACCEPT='application/json')
+            with self.settings(FAST_LIST_SERIALIZATION=False):
+                slow = self.client.get(reverse(name), HTTP_ACCEPT='application/json')
+            self.assertEqual(fast.content, slow.content)
+            self.assertEqual(json.loads(fast.content), json.loads(expected))
+
+    def test_renderer_matches_json_renderer(self):
+        data = {
+            'text': 'a\u2028b\u2029c \u00e9', 'amount': Decimal('1.50'), 'when': timezone.now(),
+            'nested': [{'n': 1, 'flag': True, 'none': None}], 'id': uuid.uuid4(),
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+
+class GetOrComputeTests(SimpleTestCase):
+    key = 'tests:get-or-compute'
+
+    def setUp(self):
+        cache.delete_many([self.key, self.key + cache_helpers.LOCK_SUFFIX])
+
+    def store(self, value, expires_in, delta=0.01):
+        cache.set(self.key, (value, time.time() + expires_in, delta), 60)
+
+    def test_concurrent_misses_compute_once(self):
+        calls, results = [], []
+        barrier = threading.Barrier(6)
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'fresh'
+
+        def read():
+            barrier.wait()
+            results.append(cache_helpers.get_or_compute(self.key, compute, timeout=60))
+
+        threads = [threading.Thread(target=read) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['fresh'] * 6)
+
+    def test_stale_value_is_served_while_another_worker_rebuilds(self):
+        self.store('old', expires_in=-1)
+        cache.add(self.key + cache_helpers.LOCK_SUFFIX, 'other worker', 30)
+        compute = mock.Mock(return_value='new')
+        self.assertEqual(cache_helpers.get_or_compute(self.key, compute, timeout=60), 'old')
+        compute.assert_not_called()
+
+        cache.delete(self.key + cache_helpers.LOCK_SUFFIX)
+        self.assertEqual(cache_helpers.get_or_compute(self.key, compute, timeout=60), 'new')
+        self.assertEqual(cache.get(self.key)[0], 'new')
+
+    def test_early_refresh(self):
+        # took 10s to compute, expires in 30s
+        self.store('current', expires_in=30, delta=10)
+        compute = mock.Mock(return_value='new')
+        self.assertEqual(cache_helpers.get_or_compute(self.key, compute, timeout=60, beta=0), 'current')
+        # an exponential sample far in the tail refreshes before the expiry
+        with mock.patch.object(cache_helpers.random, 'random', return_value=0.999999):
+            self.assertEqual(cache_helpers.get_or_compute(self.key, compute, timeout=60), 'new')
+        compute.assert_called_once()
+
+    def test_lock_is_released_when_compute_raises(self):
+        lock_key = self.key + cache_helpers.LOCK_SUFFIX
+        failing = mock.Mock(side_effect=RuntimeError('db down'))
+        with self.assertRaises(RuntimeError):
+            cache_helpers.get_or_compute(self.key, failing, timeout=60)
+        self.assertIsNone(cache.get(lock_key))
+
+        # a failed refresh serves the stale value
+        self.store('old', expires_in=-1)
+        with self.assertLogs('mtaani_app.cache_helpers', 'ERROR'):
+            self.assertEqual(cache_helpers.get_or_compute(self.key, failing, timeout=60), 'old')
+        self.assertIsNone(cache.get(lock_key))
+        self.assertEqual(cache_helpers.get_or_compute(self.key, lambda: 'new', timeout=60), 'new')
+
+
+class CatalogCacheTests(APITestCase):
+    url = '/productions/'
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(Category_name='Phones', url_key='phones')
+        now = timezone.now()
+        self.products = []
+        for n, name in enumerate(('Alpha', 'Bravo', 'Charlie')):
+            product = Product.objects.create(product_name=name, price=Decimal('10.00'), stock=3, category=self.category)
+            Product.objects.filter(pk=product.pk).update(created_at=now - timedelta(minutes=10 - n))
+            self.products.append(Product.objects.get(pk=product.pk))
+        catalog_cache.bump_version()
+
+    def names(self, payload):
+        return [product['name'] for product in json.loads(payload)]
+
+    def get(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.content
+
+    def test_warm_catalog_never_touches_the_database(self):
+        cold = self.get()
+        with self.assertNumQueries(0):
+            warm = self.get()
+        self.assertEqual(warm, cold)
+        self.assertEqual(warm, JSONRenderer().render(ProductSerializer(self.products, many=True).data))
+
+    def test_fragments_are_assembled_in_index_order(self):
+        alpha, bravo, charlie = (str(product.pk) for product in self.products)
+        self.assertEqual(catalog_cache.get_index(), [alpha, bravo, charlie])
+        self.assertEqual(self.names(catalog_cache.assemble([charlie, alpha, bravo])), ['Charlie', 'Alpha', 'Bravo'])
+        # ids without a product are skipped
+        self.assertEqual(self.names(catalog_cache.assemble([bravo, str(uuid.uuid4())])), ['Bravo'])
+        self.assertEqual(
+            catalog_cache.get_fragments([alpha])[alpha],
+            JSONRenderer().render(ProductSerializer(self.products[0]).data),
+        )
+
+    def test_cold_misses_are_rebuilt_from_the_database(self):
+        self.get()
+        bravo = str(self.products[1].pk)
+        cache.delete(catalog_cache.product_key(bravo))
+        catalog_cache.bump_version()
+        with self.assertNumQueries(2):
+            # index, then the one missing fragment
+            self.assertEqual(self.names(self.get()), ['Alpha', 'Bravo', 'Charlie'])
+        self.assertIsNotNone(cache.get(catalog_cache.product_key(bravo)))
+        with self.assertNumQueries(0):
+            self.get()
+
+
+class CatalogInvalidationTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.phones = Category.objects.create(Category_name='Phones', url_key='phones')
+        self.cables = Category.objects.create(Category_name='Cables', url_key='cables')
+        self.phone = Product.objects.create(product_name='Phone', price=Decimal('100.00'), stock=3, category=self.phones)
+        self.other = Product.objects.create(product_name='Other', price=Decimal('10.00'), stock=3, category=self.phones)
+        catalog_cache.get_catalog_json()
+        catalog_cache.get_catalog_json(self.phones.pk)
+        self.version = catalog_cache.get_version()
+        # a sentinel shows whether the other product's fragment is rewritten
+        self.sentinel = b'{"sentinel":true}'
+        cache.set(catalog_cache.product_key(self.other.pk), self.sentinel)
+
+    def save(self, **changes):
+        product = Product.objects.get(pk=self.phone.pk)
+        for name, value in changes.items():
+            setattr(product, name, value)
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        return product
+
+    def fragment(self, product=None):
+        return json.loads(cache.get(catalog_cache.product_key((product or self.phone).pk)))
+
+    def test_stock_only_save_drops_the_fragment(self):
+        with mock.patch.object(catalog_cache, 'render_product', wraps=catalog_cache.render_product) as render:
+            self.save(stock=0, in_stock=False)
+        render.assert_not_called()
+        # dropped, not patched, so a concurrent re-render is never overwritten
+        self.assertIsNone(cache.get(catalog_cache.product_key(self.phone.pk)))
+        self.assertEqual(cache.get(catalog_cache.product_key(self.other.pk)), self.sentinel)
+        self.assertEqual(catalog_cache.get_version(), self.version)
+
+        listed = json.loads(catalog_cache.get_catalog_json(self.phones.pk).replace(self.sentinel, b'{}'))
+        self.assertEqual((listed[0]['stock'], listed[0]['in_stock']), (0, False))
+        self.assertEqual((self.fragment()['stock'], self.fragment()['in_stock']), (0, False))
+
+    def test_refresh_stock_drops_the_fragments(self):
+        catalog_cache.refresh_stock([str(self.phone.pk)])
+        self.assertIsNone(cache.get(catalog_cache.product_key(self.phone.pk)))
+        self.assertEqual(cache.get(catalog_cache.product_key(self.other.pk)), self.sentinel)
+
+    def test_name_or_price_change_refreshes_only_that_product(self):
+        self.save(product_name='Phone 2', price=Decimal('90.00'))
+        self.assertEqual((self.fragment()['name'], self.fragment()['price']), ('Phone 2', '90.00'))
+        self.assertEqual(cache.get(catalog_cache.product_key(self.other.pk)), self.sentinel)
+        self.assertEqual(catalog_cache.get_version(), self.version)
+        self.assertIn(str(self.phone.pk), catalog_cache.get_index())
+
+    def test_category_change_moves_the_product_between_indexes(self):
+        self.save(category=self.cables)
+        self.assertEqual(catalog_cache.get_version(), self.version)
+        self.assertNotIn(str(self.phone.pk), catalog_cache.get_index(self.phones.pk))
+        self.assertIn(str(self.phone.pk), catalog_cache.get_index(self.cables.pk))
+        self.assertEqual(self.fragment()['category'], str(self.cables.pk))
+
+    def test_delete_drops_the_product(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.get(pk=self.phone.pk).delete()
+        self.assertNotEqual(catalog_cache.get_version(), self.version)
+        self.assertIsNone(cache.get(catalog_cache.product_key(self.phone.pk)))
+        self.assertEqual(catalog_cache.get_index(), [str(self.other.pk)])
+
+
+class PostgresSearchSqlTests(SimpleTestCase):
+    """The PostgreSQL search path, compiled (not run) against the postgresql backend."""
+
+    def setUp(self):
+        try:
+            from django.db.backends.postgresql.base import DatabaseWrapper
+        except ImportError:
+            self.skipTest('psycopg is not installed')
+        settings_dict = {**connection.settings_dict, 'ENGINE': 'django.db.backends.postgresql', 'NAME': 'mtaani'}
+        self.postgres = DatabaseWrapper(settings_dict, alias='postgres-sql')
+
+    def sql(self, queryset):
+        sql, params = queryset.query.get_compiler(connection=self.postgres).as_sql()
+        return sql % tuple(repr(param) for param in params)
+
+    def test_matches_with_the_tsquery_operator(self):
+        for name_only in (False, True):
+            sql = self.sql(search._postgres_search(Product.objects.all(), ['sam', 'gal'], name_only, False))
+            self.assertIn('"mtaani_app_product"."search_vector" @@ (to_tsquery(', sql)
+            self.assertNotIn('"search_vector" = ', sql)
+            self.assertIn('ts_rank(', sql)
+        self.assertIn("'sam:*A & gal:*A'", sql)
+
+
+class ProductSearchTests(APITestCase):
+    """Search through the in-process index (the tests run on SQLite)."""
+
+    def setUp(self):
+        search.bump_version()
+        phones = Category.objects.create(Category_name='Phones', url_key='phones')
+        audio = Category.objects.create(Category_name='Audio', url_key='audio')
+        self.galaxy = Product.objects.create(
+            product_name='Samsung Galaxy A15', price=Decimal('20000'), category=phones, stock=5,
+            description='Blue smartphone',
+        )
+        self.case = Product.objects.create(
+            product_name='Galaxy case', price=Decimal('500'), category=phones, stock=5,
+            description='Fits the Samsung Galaxy A15',
+        )
+        self.buds = Product.objects.create(
+            product_name='Wireless earbuds', price=Decimal('3000'), category=audio, stock=5,
+            description='Pairs with any Samsung phone',
+        )
+
+    def names(self, text, **kwargs):
+        return list(search.search_products(Product.objects.all(), text, **kwargs).values_list('product_name', flat=True))
+
+    def test_ranks_name_matches_first(self):
+        # equal ranks: newest first
+        self.assertEqual(self.names('samsung'), ['Samsung Galaxy A15', 'Wireless earbuds', 'Galaxy case'])
+
+    def test_prefixes_and_all_terms(self):
+        self.assertEqual(self.names('sam gal'), ['Samsung Galaxy A15', 'Galaxy case'])
+        self.assertEqual(self.names('audio sams'), ['Wireless earbuds'])
+        self.assertEqual(self.names('samsung nokia'), [])
+        self.assertEqual(self.names('  '), self.names(''))
+
+    def test_name_only(self):
+        self.assertEqual(self.names('samsung', name_only=True), ['Samsung Galaxy A15'])
+
+    def test_endpoint_filters(self):
+        url = reverse('product-list')
+        for fast in (True, False):
+            with self.settings(FAST_LIST_SERIALIZATION=fast):
+                response = self.client.get(url, {'search': 'galaxy', 'price__lte': 1000}, HTTP_ACCEPT='application/json')
+                self.assertEqual([p['name'] for p in response.json()], ['Galaxy case'])
+                response = self.client.get(url, {'name': 'wire'}, HTTP_ACCEPT='application/json')
+                self.assertEqual([p['name'] for p in response.json()], ['Wireless earbuds'])
+
+    def test_saves_refresh_the_index(self):
+        self.assertEqual(self.names('pixel'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.buds.product_name = 'Pixel buds'
+            self.buds.save()
+        self.assertEqual(self.names('pixel'), ['Pixel buds'])
+        with self.captureOnCommitCallbacks(execute=True):
+            category = Category.objects.get(Category_name='Audio')
+            category.Category_name = 'Headphones'
+            category.save()
+        self.assertEqual(self.names('headphones'), ['Pixel buds'])
+
+    def test_stock_updates_keep_the_index(self):
+        search.get_index()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.buds.stock = 0
+            self.buds.save(update_fields=['stock'])
+        self.assertNotIn(search.bump_version, callbacks)
+
+    def test_benchmark_command(self):
+        out = io.StringIO()
+        call_command('benchmark_search', rows=50, repeat=1, query=['sam pho'], stdout=out)
+        self.assertIn("'sam pho'", out.getvalue())
+        self.assertFalse(Product.objects.filter(description__contains='benchmark_search').exists())
+
+
+@override_settings(FACET_PRICE_BUCKETS=[Decimal(0), Decimal(1000), Decimal(10000)])
+class ProductFacetTests(APITestCase):
+    def setUp(self):
+        search.bump_version()
+        self.addCleanup(dispatch.flush)
+        self.phones = Category.objects.create(Category_name='Phones', url_key='phones')
+        self.audio = Category.objects.create(Category_name='Audio', url_key='audio')
+        self.galaxy = Product.objects.create(product_name='Galaxy', price=Decimal('20000'), category=self.phones, stock=2)
+        self.case = Product.objects.create(product_name='Galaxy case', price=Decimal('500'), category=self.phones, stock=0)
+        self.buds = Product.objects.create(product_name='Buds', price=Decimal('3000'), category=self.audio, stock=5)
+
+    def facets(self, **params):
+        response = self.client.get(reverse('product-list'), {'facets': 1, **params}, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['facets']
+
+    def cells(self):
+        return {
+            (row.category_id, row.price_bucket, row.in_stock): row.count
+            for row in ProductFacetCount.objects.filter(count__gt=0)
+        }
+
+    def test_cells_follow_saves(self):
+        self.assertEqual(self.cells(), {
+            (self.phones.pk, 2, True): 1, (self.phones.pk, 0, False): 1, (self.audio.pk, 1, True): 1,
+        })
+        before = self.cells()
+        facets.rebuild()
+        self.assertEqual(self.cells(), before)
+
+        case = Product.objects.get(pk=self.case.pk)
+        case.category, case.price, case.stock = self.audio, Decimal('1500'), 3
+        case.save()
+        buds = Product.objects.get(pk=self.buds.pk)
+        buds.stock = 0
+        buds.save(update_fields=['stock', 'in_stock'])
+        Product.objects.get(pk=self.galaxy.pk).delete()
+        self.assertEqual(self.cells(), {(self.audio.pk, 1, True): 1, (self.audio.pk, 1, False): 1})
+
+    def test_stock_reservations_move_products(self):
+        from .inventory import apply_stock_deltas
+
+        with transaction.atomic():
+            apply_stock_deltas({str(self.galaxy.pk): 2, str(self.case.pk): -4})
+        self.assertEqual(self.cells(), {
+            (self.phones.pk, 2, False): 1, (self.phones.pk, 0, True): 1, (self.audio.pk, 1, True): 1,
+        })
+
+    def test_facets_from_cells_match_a_recount(self):
+        with self.assertNumQueries(1):
+            from_cells = facets.product_facets(Product.objects.all(), {})
+        recount = facets.product_facets(Product.objects.all(), {'price__gte': '0'})
+        self.assertEqual(from_cells, recount)
+        self.assertEqual(from_cells, {
+            'total': 3,
+            'categories': [
+                {'id': str(self.phones.pk), 'name': 'Phones', 'count': 2},
+                {'id': str(self.audio.pk), 'name': 'Audio', 'count': 1},
+            ],
+            'stock': {'in_stock': 2, 'out_of_stock': 1},
+            'price': [
+                {'min': '0', 'max': '1000', 'count': 1},
+                {'min': '1000', 'max': '10000', 'count': 1},
+                {'min': '10000', 'max': None, 'count': 1},
+            ],
+        })
+
+    def test_endpoint(self):
+        phones = self.facets(category=str(self.phones.pk), in_stock='true')
+        self.assertEqual((phones['total'], phones['stock']), (1, {'in_stock': 1, 'out_of_stock': 0}))
+        searched = self.facets(search='galaxy')
+        self.assertEqual([c['count'] for c in searched['categories']], [2])
+        self.assertEqual([p['count'] for p in searched['price']], [1, 0, 1])
+
+        response = self.client.get(reverse('product-list'), {'facets': 1, 'cursor': ''}, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['facets']['total'], 3)
+        self.assertEqual(len(response.json()['results']), 3)
+        plain = self.client.get(reverse('product-list'), HTTP_ACCEPT='application/json')
+        self.assertIsInstance(plain.json(), list)
+
+
+class ProductImportTests(APITestCase):
+    CSV = (
+        'url_key,product_name,price,category,stock,description\n'
+        'galaxy,Galaxy A15,20000,phones,3,Blue\n'
+        'case,Galaxy case,500,phones,0,\n'
+        'bad-price,Broken,abc,phones,1,\n'
+        'no-category,Lost,10,nowhere,1,\n'
+        'hot,Flash sale phone,999,phones,50,\n'
+        'galaxy,Galaxy A15 (8GB),21000,phones,4,Blue\n'
+    )
+
+    def setUp(self):
+        search.bump_version()
+        self.phones = Category.objects.create(Category_name='Phones', url_key='phones')
+        self.audio = Category.objects.create(Category_name='Audio', url_key='audio')
+        self.existing = Product.objects.create(
+            product_name='Old case', url_key='case', price=Decimal('400'), category=self.audio, stock=7,
+        )
+        self.hot = Product.objects.create(
+            product_name='Flash', url_key='hot', price=Decimal('1000'), category=self.phones, stock=5, is_hot_sku=True,
+        )
+
+    def test_csv_upsert(self):
+        cache.set(catalog_cache.product_key(self.existing.pk), b'stale')
+        result = product_import.import_products(io.BytesIO(self.CSV.encode()), 'csv', chunk_size=2)
+
+        self.assertEqual(
+            {key: result[key] for key in ('rows', 'created', 'updated', 'skipped', 'hot_stock_kept')},
+            # "galaxy" is written twice (chunks of 2)
+            {'rows': 6, 'created': 1, 'updated': 3, 'skipped': 2, 'hot_stock_kept': 1},
+        )
+        self.assertEqual([error['row'] for error in result['errors']], [4, 5])
+        products = {p.url_key: p for p in Product.objects.all()}
+        self.assertEqual(len(products), 3)
+        galaxy, case, hot = products['galaxy'], products['case'], products['hot']
+        self.assertEqual((galaxy.product_name, galaxy.price, galaxy.stock), ('Galaxy A15 (8GB)', Decimal('21000'), 4))
+        self.assertEqual((case.pk, case.category_id, case.stock, case.in_stock), (self.existing.pk, self.phones.pk, 0, False))
+        self.assertEqual((hot.product_name, hot.price, hot.stock), ('Flash sale phone', Decimal('999'), 5))
+        self.assertIsNone(cache.get(catalog_cache.product_key(self.existing.pk)))
+        self.assertEqual(search.search_products(Product.objects.all(), '8gb').get(), galaxy)
+        self.assertEqual(facets.product_facets(Product.objects.all(), {})['categories'][0]['count'], 3)
+
+    def test_json_array_and_lines(self):
+        rows = [
+            {'url_key': f'item-{n}', 'name': f'Item {n} \u00e9', 'price': n + 0.5, 'category': 'audio', 'stock': n}
+            for n in range(5)
+        ]
+        with mock.patch.object(product_import, 'READ_SIZE', 7):
+            for text in (json.dumps(rows, indent=2), '\n'.join(json.dumps(row) for row in rows)):
+                result = product_import.import_products(io.BytesIO(text.encode()), 'json')
+                self.assertEqual((result['rows'], result['skipped']), (5, 0))
+        self.assertEqual(Product.objects.filter(category=self.audio).count(), 6)
+        self.assertEqual(Product.objects.get(url_key='item-3').product_name, 'Item 3 \u00e9')
+
+        with self.assertRaises(product_import.ImportFileError):
+            product_import.import_products(io.BytesIO(b'[{"url_key": "x"'), 'json')
+
+    def test_invalid_keys_and_stock_are_skipped(self):
+        rows = [
+            {'url_key': 'k' * 256, 'name': 'Long', 'price': 1, 'category': 'audio'},
+            {'url_key': 'has space', 'name': 'Spaced', 'price': 1, 'category': 'audio'},
+            {'url_key': 'huge', 'name': 'Huge', 'price': 1, 'category': 'audio', 'stock': 2 ** 31},
+            {'url_key': 'k' * 255, 'name': 'Longest', 'price': 1, 'category': 'audio', 'stock': 2 ** 31 - 1},
+        ]
+        result = product_import.import_products(io.BytesIO(json.dumps(rows).encode()), 'json')
+        self.assertEqual((result['created'], result['skipped']), (1, 3))
+        self.assertEqual(
+            [error['error'] for error in result['errors']],
+            ['url_key is too long', "invalid url_key 'has space'", 'stock out of range: 2147483648'],
+        )
+        self.assertEqual(Product.objects.get(url_key='k' * 255).stock, 2 ** 31 - 1)
+
+    def test_endpoint(self):
+        url = reverse('product-import')
+        upload = SimpleUploadedFile('catalog.csv', self.CSV.encode(), content_type='text/csv')
+        self.client.force_authenticate(User.objects.create_user('shopper', 'shopper@example.com', 'pass1234'))
+        self.assertEqual(self.client.post(url, {'file': upload}).status_code, 403)
+
+        self.client.force_authenticate(User.objects.create_superuser('admin', 'admin@example.com', 'pass1234'))
+        upload.seek(0)
+        response = self.client.post(url, {'file': upload})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['created'], 1)
+        self.assertEqual(self.client.post(url, {}).status_code, 400)
+
+    def test_command(self):
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'catalog.csv')
+        with open(path, 'w') as stream:
+            stream.write(self.CSV)
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_products', path, stdout=out, stderr=err)
+        self.assertIn('1 created, 2 updated, 2 skipped', out.getvalue())
+        self.assertIn("Row 5: unknown category 'nowhere'", err.getvalue())
+
+
+class SafaricomStub:
+    """Local HTTP stand-in for the Safaricom OAuth, STK push and STK query APIs.
+
+    Used as a context manager, it points `mpesa` at itself and records the
+    `(method, path, body)` of every request in `requests`. Set `push_status`
+    to make STK pushes fail with that HTTP status, or queue one-off statuses
+    for the next POSTs in `statuses`; tokens in `revoked` are answered with
+    401 and every answer is held back `delay` seconds. STK queries answer
+    with the ResultCode set for the CheckoutRequestID in `query_results`
+    (default 0); None means "still being processed".
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.push_status = 200
+        self.statuses = []
+        self.query_results = {}
+        self.delay = 0
+        self.tokens_issued = 0
+        self.revoked = set()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, code, body):
+                payload = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                stub.requests.append(('GET', self.path.split('?')[0], None))
+                stub.tokens_issued += 1
+                self._reply(200, {'access_token': f'stub-token-{stub.tokens_issued}', 'expires_in': '3599'})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                stub.requests.append(('POST', self.path, body))
+                time.sleep(stub.delay)
+                if self.headers['Authorization'].split()[-1] in stub.revoked:
+                    self._reply(401, {'errorMessage': 'Invalid Access Token'})
+                    return
+                code = stub.statuses.pop(0) if stub.statuses else stub.push_status
+                if code != 200:
+                    self._reply(code, {'errorMessage': 'stub failure'})
+                    return
+                if self.path == '/mpesa/stkpushquery/v1/query':
+                    checkout_id = body['CheckoutRequestID']
+                    result = stub.query_results.get(checkout_id, 0)
+                    if result is None:
+                        self._reply(500, {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'})
+                        return
+                    self._reply(200, {
+                        'ResponseCode': '0', 'CheckoutRequestID': checkout_id,
+                        'ResultCode': str(result), 'ResultDesc': 'stub result',
+                    })
+                    return
+                self._reply(200, {
+                    'MerchantRequestID': 'stub-merchant',
+                    'CheckoutRequestID': f'ws_CO_stub_{len(stub.requests)}',
+                    'ResponseCode': '0',
+                    'ResponseDescription': 'Success. Request accepted for processing',
+                })
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        # clients that gave up (timeouts) leave broken pipes behind
+        self.server.handle_error = lambda request, client_address: None
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self._patch = mock.patch.multiple(
+            mpesa, MPESA_BASE_URL=self.url, MPESA_CONSUMER_KEY='key', MPESA_CONSUMER_SECRET='secret',
+            MPESA_SHORTCODE='174379', MPESA_PASSKEY='passkey',
+        )
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self._patch.start()
+        mpesa.default_breaker.reset()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._patch.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def paths(self):
+        return [path for _, path, _ in self.requests]
+
+
+class MpesaInitiationTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('payer', 'payer@example.com', 'pass1234')
+        self.client.force_authenticate(self.user)
+        self.order = Order.objects.create(user=self.user, total_amount=Decimal('250.00'))
+        self.stub = self.enterContext(SafaricomStub())
+
+    def initiate(self, **extra):
+        # the test transaction never commits: run the view's on_commit
+        # callbacks, then publish as the end of a request would
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('payment-initiate'), {'order_id': str(self.order.pk), 'phone': '254700000000', **extra},
+                format='json', HTTP_ACCEPT='application/json',
+            )
+        request_finished.send(sender=None)
+        return response
+
+    def poll(self, payment_id):
+        response = self.client.get(reverse('payment-status', args=[payment_id]), HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_async_initiate_queues_the_push(self):
+        with mock.patch.object(tasks.initiate_mpesa_payment, 'apply_async') as publish:
+            response = self.initiate(**{'async': True})
+        self.assertEqual(publish.call_count, 1)
+        self.assertFalse(TaskOutbox.objects.exists())
+        task_args = publish.call_args.args[0]
+
+        self.assertEqual(response.status_code, 202)
+        payment_id = response.json()['payment_id']
+        self.assertTrue(response['Location'].endswith(reverse('payment-status', args=[payment_id])))
+        # nothing was sent to Safaricom inside the request
+        self.assertEqual(self.stub.requests, [])
+        self.assertEqual(self.poll(payment_id)['stk_push'], 'queued')
+
+        # the worker sends the push
+        self.assertTrue(tasks.initiate_mpesa_payment(*task_args))
+        self.assertEqual(self.stub.paths(), ['/oauth/v1/generate', '/mpesa/stkpush/v1/processrequest'])
+        push = self.stub.requests[1][2]
+        self.assertEqual((push['Amount'], push['PhoneNumber']), (250, '254700000000'))
+
+        status = self.poll(payment_id)
+        self.assertEqual((status['status'], status['stk_push']), ('pending', 'sent'))
+        self.assertTrue(status['checkout_request_id'].startswith('ws_CO_stub_'))
+
+        # a redelivered task doesn't push twice
+        self.assertFalse(tasks.initiate_mpesa_payment(*task_args))
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_async_push_failure_marks_payment_failed(self):
+        self.stub.push_status = 500
+        with self.settings(MPESA_ASYNC_INITIATION=True), \
+                mock.patch.object(tasks.initiate_mpesa_payment, 'apply_async') as publish:
+            response = self.initiate()
+        self.assertEqual(response.status_code, 202)
+
+        with self.assertLogs('mtaani_app.tasks', 'ERROR'):
+            self.assertFalse(tasks.initiate_mpesa_payment(*publish.call_args.args[0]))
+        status = self.poll(response.json()['payment_id'])
+        self.assertEqual((status['status'], status['stk_push']), ('failed', 'failed'))
+
+    def test_sync_initiate_still_calls_safaricom(self):
+        response = self.initiate(**{'async': False})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stub.paths(), ['/oauth/v1/generate', '/mpesa/stkpush/v1/processrequest'])
+        payment = Payment.objects.get(pk=response.json()['payment_id'])
+        self.assertEqual(payment.transaction_id, response.json()['checkout_request_id'])
+
+    def test_push_without_checkout_id_stores_no_reference(self):
+        accepted = {'ResponseCode': '0', 'ResponseDescription': 'Success. Request accepted for processing'}
+        other = Order.objects.create(user=self.user, total_amount=Decimal('90.00'))
+        with mock.patch('mtaani_app.views.initiate_stk_push', return_value=accepted):
+            response = self.initiate(**{'async': False})
+            self.order = other
+            # the description isn't a unique reference: a second order stores none either
+            self.assertEqual(self.initiate(**{'async': False}).status_code, 200)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.json()['checkout_request_id'])
+        self.assertEqual(
+            list(Payment.objects.values_list('checkout_request_id', 'transaction_id')), [(None, None), (None, None)],
+        )
+
+    def test_failed_payment_can_be_initiated_again(self):
+        self.enterContext(mock.patch.object(mpesa, 'MPESA_RETRY_BASE_DELAY', 0.01))
+        self.addCleanup(mpesa.default_breaker.reset)
+        self.stub.push_status = 503
+        first = self.initiate()
+        self.assertEqual(first.status_code, 502)
+        failed = Payment.objects.get()
+        self.assertEqual(failed.status, 'failed')
+
+        # Safaricom stays down until the breaker opens
+        with self.assertLogs('mtaani_app.circuit_breaker', 'WARNING'):
+            while mpesa.default_breaker.state() != 'open':
+                with self.assertRaises(requests.HTTPError):
+                    mpesa.initiate_stk_push(10, '254700000000', 'order')
+        self.assertEqual(self.initiate().status_code, 503)
+
+        mpesa.default_breaker.reset()
+        self.stub.push_status = 200
+        response = self.initiate()
+        self.assertEqual(response.status_code, 200)
+        payment = Payment.objects.get()
+        self.assertEqual(payment.pk, failed.pk)
+        self.assertEqual(payment.status, 'pending')
+        self.assertEqual(payment.checkout_request_id, response.json()['checkout_request_id'])
+
+        # a pushed payment isn't pushed again
+        pushes = self.stub.paths().count('/mpesa/stkpush/v1/processrequest')
+        response = self.initiate()
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['payment_id'], str(payment.pk))
+        self.assertEqual(self.stub.paths().count('/mpesa/stkpush/v1/processrequest'), pushes)
+
+    def test_stale_queued_payment_can_be_initiated_again(self):
+        with mock.patch.object(tasks.initiate_mpesa_payment, 'apply_async'):
+            payment_id = self.initiate(**{'async': True}).json()['payment_id']
+            # the push may still be on its way
+            self.assertEqual(self.initiate(**{'async': True}).status_code, 409)
+        Payment.objects.filter(pk=payment_id).update(created_at=timezone.now() - timedelta(hours=1))
+
+        response = self.initiate(**{'async': False})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['payment_id'], payment_id)
+
+    def test_status_is_private(self):
+        with mock.patch.object(tasks.initiate_mpesa_payment, 'apply_async'):
+            payment_id = self.initiate(**{'async': True}).json()['payment_id']
+        other = User.objects.create(username='other', email='other@example.com')
+        self.client.force_authenticate(other)
+        response = self.client.get(reverse('payment-status', args=[payment_id]), HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 404)
+
+
+class MpesaClientTests(SimpleTestCase):
+    def setUp(self):
+        self.stub = self.enterContext(SafaricomStub())
+        self.mpesa_client = mpesa.MpesaClient()
+
+    def push(self):
+        return self.mpesa_client.initiate_stk_push(10, '254700000000', 'order')
+
+    def test_token_is_reused(self):
+        self.push()
+        self.mpesa_client.query_stk_status('ws_CO_1')
+        # a second client (another worker) shares the cached token
+        mpesa.MpesaClient().initiate_stk_push(10, '254700000000', 'order')
+        self.assertEqual(self.stub.paths().count('/oauth/v1/generate'), 1)
+
+    def test_revoked_token_is_refreshed_once(self):
+        self.push()
+        self.stub.revoked.add('stub-token-1')
+        before = mpesa.get_mpesa_metrics()['retries']
+        with self.assertLogs('mtaani_app.mpesa', 'WARNING'):
+            self.push()
+        self.assertEqual(self.stub.tokens_issued, 2)
+        self.assertEqual(mpesa.get_mpesa_metrics()['retries'], before + 1)
+
+    def test_metrics(self):
+        before = mpesa.get_mpesa_metrics()
+        self.push()
+        self.stub.push_status = 400
+        with self.assertRaises(requests.HTTPError):
+            self.push()
+        after = mpesa.get_mpesa_metrics()
+        self.assertEqual(after['stk_push']['calls'], before['stk_push']['calls'] + 2)
+        self.assertEqual(after['stk_push']['errors'], before['stk_push']['errors'] + 1)
+        self.assertIsNotNone(after['stk_push']['avg_latency_ms'])
+
+
+class MpesaResilienceTests(APITestCase):
+    def setUp(self):
+        self.stub = self.enterContext(SafaricomStub())
+        self.enterContext(mock.patch.object(mpesa, 'MPESA_RETRY_BASE_DELAY', 0.01))
+        self.breaker = mpesa.default_breaker
+        self.addCleanup(self.breaker.reset)
+
+    def trip_breaker(self):
+        self.stub.push_status = 503
+        with self.assertLogs('mtaani_app.circuit_breaker', 'WARNING'):
+            for _ in range(self.breaker.min_calls):
+                with self.assertRaises(requests.HTTPError):
+                    mpesa.initiate_stk_push(10, '254700000000', 'order')
+                if self.breaker.state() == 'open':
+                    break
+        self.assertEqual(self.breaker.state(), 'open')
+
+    def test_open_breaker_fails_fast(self):
+        self.trip_breaker()
+        sent = len(self.stub.requests)
+        with self.assertRaises(mpesa.CircuitOpenError):
+            mpesa.query_stk_status('ws_CO_1')
+        self.assertEqual(len(self.stub.requests), sent)
+
+    def test_half_open_probe_closes_breaker(self):
+        self.trip_breaker()
+        self.stub.push_status = 200
+        with mock.patch('mtaani_app.circuit_breaker.time.time', return_value=time.time() + self.breaker.reset_timeout + 1):
+            self.assertEqual(self.breaker.state(), 'half-open')
+            mpesa.query_stk_status('ws_CO_1')
+        self.assertEqual(self.breaker.state(), 'closed')
+
+    def test_only_status_queries_are_retried(self):
+        self.stub.statuses = [503, 503]
+        self.assertEqual(mpesa.query_stk_status('ws_CO_1')['ResponseCode'], '0')
+        self.assertEqual(self.stub.paths().count('/mpesa/stkpushquery/v1/query'), 3)
+
+        self.stub.statuses = [503]
+        with self.assertRaises(requests.HTTPError):
+            mpesa.initiate_stk_push(10, '254700000000', 'order')
+        self.assertEqual(self.stub.paths().count('/mpesa/stkpush/v1/processrequest'), 1)
+
+    def test_deadline_bounds_the_whole_call(self):
+        mpesa.get_oauth_token()
+        self.stub.delay = 1
+        started = time.monotonic()
+        with self.assertRaises(requests.Timeout):
+            mpesa.query_stk_status('ws_CO_1', deadline=0.3)
+        self.assertLess(time.monotonic() - started, 0.9)
+
+    def test_initiate_returns_503_while_open(self):
+        user = User.objects.create_user('payer', 'payer@example.com', 'pass1234')
+        order = Order.objects.create(user=user, total_amount=Decimal('10.00'))
+        self.client.force_authenticate(user)
+        self.trip_breaker()
+        response = self.client.post(
+            reverse('payment-initiate'), {'order_id': str(order.pk), 'phone': '254700000000'},
+            format='json', HTTP_ACCEPT='application/json',
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+        self.assertFalse(Payment.objects.exists())
+
+
+class PaymentTestCase(APITestCase):
+    def setUp(self):
+        self.stub = self.enterContext(SafaricomStub())
+        self.user = User.objects.create_user('payer', 'payer@example.com', 'pass1234')
+        self.client.force_authenticate(self.user)
+        self.enterContext(mock.patch.object(tasks.flush_email_outbox, 'apply_async'))
+        # publish what the test dispatched while the task is still mocked
+        self.addCleanup(dispatch.flush)
+        cache.delete(payments.RECONCILE_LOCK_KEY)
+
+    def queued_confirmations(self):
+        return OutboundEmail.objects.filter(kind='payment_confirmation').count()
+
+    def make_payment(self, checkout_id, age=120, legacy=False):
+        order = Order.objects.create(user=self.user, total_amount=Decimal('10.00'))
+        read_models.build_summary(order, [], self.user, payment_status='pending').save()
+        return Payment.objects.create(
+            user=self.user, order=order, amount=order.total_amount, method='mpesa', status='pending',
+            checkout_request_id=None if legacy else checkout_id, transaction_id=checkout_id,
+            created_at=timezone.now() - timedelta(seconds=age),
+        )
+
+
+class PaymentReconciliationTests(PaymentTestCase):
+    def test_reconcile_settles_stale_pending_payments(self):
+        paid = self.make_payment('ws_CO_paid')
+        cancelled = self.make_payment('ws_CO_cancelled')
+        processing = self.make_payment('ws_CO_processing')
+        fresh = self.make_payment('ws_CO_fresh', age=5)
+        queued = self.make_payment(None)
+        self.stub.query_results = {'ws_CO_cancelled': 1032, 'ws_CO_processing': None}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            result = payments.reconcile_pending_payments(min_age=60, concurrency=2)
+
+        self.assertEqual(result, {
+            'skipped': False, 'checked': 3, 'successful': 1, 'failed': 1, 'undecided': 1, 'errors': 0,
+        })
+        statuses = dict(Payment.objects.values_list('pk', 'status'))
+        self.assertEqual(
+            [statuses[p.pk] for p in (paid, cancelled, processing, fresh, queued)],
+            ['successful', 'failed', 'pending', 'pending', 'pending'],
+        )
+        self.assertIsNotNone(Payment.objects.get(pk=paid.pk).paid_at)
+        # bulk updates still reach the order summaries
+        self.assertEqual(OrderSummary.objects.get(order_id=cancelled.order_id).payment_status, 'failed')
+        self.assertEqual(self.queued_confirmations(), 1)
+
+    def test_reconcile_runs_are_exclusive(self):
+        cache.add(payments.RECONCILE_LOCK_KEY, 'other', 60)
+        self.assertEqual(payments.reconcile_pending_payments(), {'skipped': True})
+
+    def test_verify_answers_from_stored_state(self):
+        payment = self.make_payment('ws_CO_verify')
+        self.stub.query_results = {'ws_CO_verify': None}
+        url = reverse('payment-verify', args=[payment.pk])
+
+        response = self.client.post(url, HTTP_ACCEPT='application/json')
+        self.assertEqual((response.status_code, response.json()['status']), (200, 'pending'))
+        self.assertEqual(self.stub.paths().count('/mpesa/stkpushquery/v1/query'), 1)
+
+        # polling again within PAYMENT_VERIFY_MIN_INTERVAL doesn't reach Safaricom
+        for _ in range(3):
+            response = self.client.post(url, HTTP_ACCEPT='application/json')
+            self.assertEqual(response.json()['status'], 'pending')
+        self.assertEqual(self.stub.paths().count('/mpesa/stkpushquery/v1/query'), 1)
+
+        # once settled (here by the beat task) verify reports it
+        self.stub.query_results = {}
+        with self.captureOnCommitCallbacks(execute=True):
+            payments.reconcile_pending_payments(min_age=60)
+        response = self.client.post(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['detail'], 'Payment marked successful')
+        self.assertEqual(self.stub.paths().count('/mpesa/stkpushquery/v1/query'), 2)
+
+
+    def test_verify_ignores_another_payments_checkout_id(self):
+        other = self.make_payment('ws_CO_other')
+        mine = self.make_payment('ws_CO_mine')
+        self.stub.query_results = {'ws_CO_mine': None}
+
+        response = self.client.post(
+            reverse('payment-verify', args=[mine.pk]), {'checkout_request_id': 'ws_CO_other'},
+            format='json', HTTP_ACCEPT='application/json',
+        )
+        self.assertEqual(response.json()['status'], 'pending')
+        queried = [body['CheckoutRequestID'] for _, path, body in self.stub.requests if path.endswith('/query')]
+        self.assertEqual(queried, ['ws_CO_mine'])
+
+        # a payment without a stored id can't borrow one either
+        queued = self.make_payment(None)
+        response = self.client.post(
+            reverse('payment-verify', args=[queued.pk]), {'checkout_request_id': 'ws_CO_other'},
+            format='json', HTTP_ACCEPT='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        statuses = dict(Payment.objects.values_list('pk', 'status'))
+        self.assertEqual([statuses[p.pk] for p in (other, mine, queued)], ['pending'] * 3)
+
+        response = self.client.post(
+            reverse('payment-verify', args=[queued.pk]), {'checkout_request_id': 'ws_CO_unused'},
+            format='json', HTTP_ACCEPT='application/json',
+        )
+        self.assertEqual(response.json()['status'], 'successful')
+
+def stk_callback(checkout_id, result_code=0, receipt='QKX1234ABC'):
+    stk = {'MerchantRequestID': 'm-1', 'CheckoutRequestID': checkout_id, 'ResultCode': result_code, 'ResultDesc': 'done'}
+    if result_code == 0:
+        stk['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': 10}, {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+        ]}
+    return {'Body': {'stkCallback': stk}}
+
+
+class MpesaCallbackTests(PaymentTestCase):
+    url = '/mpesa/callback/'
+
+    def callback(self, checkout_id, result_code=0):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                self.url, stk_callback(checkout_id, result_code), format='json', HTTP_ACCEPT='application/json',
+            )
+
+    def test_duplicate_callback_is_idempotent(self):
+        payment = self.make_payment('ws_CO_dup')
+        first = self.callback('ws_CO_dup')
+        second = self.callback('ws_CO_dup')
+
+        self.assertEqual(first.json()['detail'], 'Payment updated to successful')
+        self.assertEqual((second.status_code, second.json()['detail']), (200, 'Callback already processed'))
+        payment.refresh_from_db()
+        self.assertEqual(
+            (payment.status, payment.mpesa_receipt_number, payment.transaction_id),
+            ('successful', 'QKX1234ABC', 'ws_CO_dup'),
+        )
+        self.assertEqual(self.queued_confirmations(), 1)
+
+    def test_legacy_payment_found_by_transaction_id(self):
+        payment = self.make_payment('ws_CO_legacy', legacy=True)
+        response = self.callback('ws_CO_legacy', result_code=1032)
+        self.assertEqual(response.json()['detail'], 'Payment marked failed')
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, 'failed')
+        self.assertEqual(self.queued_confirmations(), 0)
+
+    def test_unknown_or_malformed_callback(self):
+        self.assertEqual(self.callback('ws_CO_unknown').status_code, 404)
+        for body in ({'Body': {}}, {'Body': {'stkCallback': {'CheckoutRequestID': 'ws_CO_x', 'ResultCode': 'x'}}}):
+            response = self.client.post(self.url, body, format='json', HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    @override_settings(MPESA_CALLBACK_QUEUE=True)
+    def test_queue_without_redis_applies_inline(self):
+        payment = self.make_payment('ws_CO_inline')
+        self.assertEqual(self.callback('ws_CO_inline').json()['detail'], 'Payment updated to successful')
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, 'successful')
+
+    def test_lookup_query_count_is_constant(self):
+        for n in range(20):
+            self.make_payment(f'ws_CO_filler{n}')
+        self.make_payment('ws_CO_target')
+        with self.assertNumQueries(1):
+            self.assertIsNotNone(payments.find_by_checkout_request_id('ws_CO_target'))
+
+
+def redis_caches():
+    """CACHES for a throwaway Redis database from REDIS_TEST_URL, or None when unreachable."""
+    url = os.getenv('REDIS_TEST_URL')
+    if not url:
+        return None
+    try:
+        import redis
+        redis.Redis.from_url(url, socket_connect_timeout=1).ping()
+    except Exception:
+        return None
+    return {'default': {
+        'BACKEND': 'django_redis.cache.RedisCache', 'LOCATION': url,
+        'OPTIONS': {'CLIENT_CLASS': 'django_redis.client.DefaultClient'},
+    }}
+
+
+REDIS_CACHES = redis_caches()
+
+
+@unittest.skipUnless(REDIS_CACHES, 'set REDIS_TEST_URL to a disposable Redis database')
+@override_settings(CACHES=REDIS_CACHES or {}, MPESA_CALLBACK_QUEUE=True, MPESA_CALLBACK_MAX_BACKLOG=3)
+class MpesaCallbackQueueTests(PaymentTestCase):
+    url = '/mpesa/callback/'
+
+    def setUp(self):
+        callback_stream.get_connection().flushdb()
+        super().setUp()
+
+    def post(self, body):
+        return self.client.post(self.url, body, format='json', HTTP_ACCEPT='application/json')
+
+    def test_callbacks_are_queued_and_drained_in_batches(self):
+        paid = self.make_payment('ws_CO_q1')
+        cancelled = self.make_payment('ws_CO_q2', legacy=True)
+        for body in (stk_callback('ws_CO_q1'), stk_callback('ws_CO_q1'), stk_callback('ws_CO_q2', 1032)):
+            with self.assertNumQueries(0):
+                response = self.post(body)
+            self.assertEqual(response.json()['detail'], 'Callback accepted')
+        self.assertEqual(Payment.objects.get(pk=paid.pk).status, 'pending')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            totals = callback_stream.drain('test', batch_size=10)
+
+        self.assertEqual(totals, {'skipped': False, 'read': 3, 'applied': 2, 'unknown': 0, 'invalid': 0})
+        statuses = dict(Payment.objects.values_list('pk', 'status'))
+        self.assertEqual((statuses[paid.pk], statuses[cancelled.pk]), ('successful', 'failed'))
+        self.assertEqual(self.queued_confirmations(), 1)
+        self.assertEqual(callback_stream.get_metrics()['backlog'], 0)
+
+    def test_command_publishes_dispatched_tasks_per_batch(self):
+        self.make_payment('ws_CO_c1')
+        self.post(stk_callback('ws_CO_c1'))
+        out = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True), mock.patch.object(dispatch, 'flush') as flush:
+            call_command('drain_mpesa_callbacks', '--once', stdout=out)
+        self.assertIn('1 callbacks: 1 applied', out.getvalue())
+        flush.assert_called_once_with()
+
+    def test_full_backlog_answers_503(self):
+        for n in range(3):
+            self.post(stk_callback(f'ws_CO_b{n}'))
+        response = self.post(stk_callback('ws_CO_b3'))
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+
+    def test_entries_of_a_dead_consumer_are_claimed(self):
+        payment = self.make_payment('ws_CO_lost')
+        self.post(stk_callback('ws_CO_lost'))
+        with mock.patch.object(payments, 'apply_query_results', side_effect=RuntimeError('db down')):
+            with self.assertRaises(RuntimeError):
+                callback_stream.drain('dead', batch_size=10)
+
+        with override_settings(MPESA_CALLBACK_CLAIM_IDLE=0), self.captureOnCommitCallbacks(execute=True):
+            totals = callback_stream.drain('alive', batch_size=10)
+        self.assertEqual((totals['read'], totals['applied']), (1, 1))
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, 'successful')
+
+
+@unittest.skipUnless(REDIS_CACHES, 'set REDIS_TEST_URL to a disposable Redis database')
+@override_settings(CACHES=REDIS_CACHES or {}, INVENTORY_HOT_SKUS_ENABLED=True)
+class HotStockTests(APITestCase):
+    def setUp(self):
+        self.redis = hot_stock.get_connection()
+        self.redis.flushdb()
+        category = Category.objects.create(Category_name='Phones', url_key='phones')
+        self.hot = Product.objects.create(
+            product_name='Flash Phone', price=Decimal('100.00'), stock=5, category=category, is_hot_sku=True,
+        )
+        self.cold = Product.objects.create(product_name='Case', price=Decimal('5.00'), stock=5, category=category)
+        hot_stock.rebuild_counters()
+
+    def counter(self, product=None):
+        value = self.redis.get(hot_stock.STOCK_KEY.format((product or self.hot).pk))
+        return None if value is None else int(value)
+
+    def pending(self):
+        return int(self.redis.hget(hot_stock.PENDING_KEY, str(self.hot.pk)) or 0)
+
+    def stock(self, product=None):
+        return Product.objects.get(pk=(product or self.hot).pk).stock
+
+    def test_reservation_beyond_the_counter_is_rejected(self):
+        with self.assertRaises(InsufficientStock) as caught:
+            with hot_stock.hot_reservation([{'product_id': self.hot.pk, 'quantity': 6}]):
+                self.fail('reserved more than the counter holds')
+        self.assertEqual(caught.exception.product_id, self.hot.pk)
+        self.assertEqual((self.counter(), self.pending()), (5, 0))
+
+    def test_units_are_released_when_the_transaction_rolls_back(self):
+        items = [{'product_id': self.hot.pk, 'quantity': 2}, {'product_id': self.cold.pk, 'quantity': 9}]
+        with self.assertRaises(InsufficientStock):
+            with hot_stock.hot_reservation(items) as reserved, transaction.atomic():
+                self.assertEqual(reserved, {self.hot.pk})
+                self.assertEqual(self.counter(), 3)
+                inventory.reserve_stock(items, skip=reserved)
+        self.assertEqual((self.counter(), self.pending()), (5, 0))
+        self.assertEqual((self.stock(), self.stock(self.cold)), (5, 5))
+
+    def test_reconcile_writes_reservations_back_once(self):
+        with hot_stock.hot_reservation([{'product_id': self.hot.pk, 'quantity': 2}]):
+            pass
+        self.assertEqual((self.counter(), self.pending(), self.stock()), (3, 2, 5))
+
+        result = hot_stock.reconcile()
+        self.assertEqual((result['flushed_units'], result['drift_corrections']), (2, 0))
+        self.assertEqual((self.counter(), self.pending(), self.stock()), (3, 0, 3))
+
+        result = hot_stock.reconcile()
+        self.assertEqual(result['flushed_units'], 0)
+        self.assertEqual(self.stock(), 3)
+
+    def test_reconcile_corrects_drift(self):
+        # restocked behind the counter's back
+        Product.objects.filter(pk=self.hot.pk).update(stock=20)
+        with hot_stock.hot_reservation([{'product_id': self.hot.pk, 'quantity': 1}]):
+            pass
+        with self.assertLogs('mtaani_app.hot_stock', 'WARNING') as logs:
+            result = hot_stock.reconcile()
+        self.assertIn('drifted by 15 units', logs.output[0])
+        self.assertEqual((result['flushed_units'], result['drift_corrections']), (1, 1))
+        self.assertEqual((self.counter(), self.stock()), (19, 19))
+
+    def test_rebuild_command(self):
+        self.redis.set(hot_stock.STOCK_KEY.format(self.hot.pk), 1)
+        # unflagged products lose their counter
+        self.redis.set(hot_stock.STOCK_KEY.format(self.cold.pk), 5)
+        self.redis.sadd(hot_stock.REGISTRY_KEY, str(self.cold.pk))
+
+        out = io.StringIO()
+        with self.assertLogs('mtaani_app.hot_stock', 'WARNING'):
+            call_command('rebuild_hot_stock', stdout=out)
+        self.assertIn('Rebuilt 1 hot-SKU counters, removed 1 stale counters.', out.getvalue())
+        self.assertEqual((self.counter(), self.counter(self.cold)), (5, None))
+        with override_settings(INVENTORY_HOT_SKUS_ENABLED=False), self.assertRaises(CommandError):
+            call_command('rebuild_hot_stock')
+
+
+class OrderReservationTests(APITestCase):
+    def setUp(self):
+        cache.delete(metrics._key(inventory.REJECTED_METRIC))
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'pass1234')
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(Category_name='Phones', url_key='phones')
+        self.phone = Product.objects.create(product_name='Phone', price=Decimal('100.00'), stock=5, category=category)
+        self.case = Product.objects.create(product_name='Case', price=Decimal('5.00'), stock=5, category=category)
+
+    def order(self, *lines):
+        return self.client.post(reverse('order-list'), {
+            'items': [{'product_id': str(product.pk), 'quantity': qty} for product, qty in lines],
+        }, format='json', HTTP_ACCEPT='application/json')
+
+    def stocks(self):
+        return [Product.objects.get(pk=product.pk).stock for product in (self.phone, self.case)]
+
+    def test_lines_of_a_product_are_summed(self):
+        response = self.order((self.phone, 2), (self.case, 1), (self.phone, 3))
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(Order.objects.get().total_amount, Decimal('505.00'))
+        self.assertEqual(self.stocks(), [0, 4])
+
+        # each line fits, their sum doesn't
+        response = self.order((self.case, 3), (self.case, 3))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stocks(), [0, 4])
+
+    def test_insufficient_stock_reserves_nothing(self):
+        response = self.order((self.case, 1), (self.phone, 6))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(str(self.phone.pk), response.json()['detail'])
+        self.assertEqual(self.stocks(), [5, 5])
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(inventory.get_inventory_metrics()['rejected'], 1)
+
+    def test_unknown_product(self):
+        response = self.order((self.case, 1), (Product(pk=uuid.uuid4()), 1))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.stocks(), [5, 5])
+
+    def test_stock_changed_behind_the_lock_names_the_short_product(self):
+        stale = list(Product.objects.filter(pk__in=[self.phone.pk, self.case.pk]).order_by('pk'))
+        Product.objects.filter(pk=self.case.pk).update(stock=0)
+        with mock.patch.object(Product.objects, 'select_for_update') as select_for_update:
+            select_for_update.return_value.filter.return_value.order_by.return_value = stale
+            with self.assertRaises(InsufficientStock) as caught, transaction.atomic():
+                inventory.reserve_stock([
+                    {'product_id': self.phone.pk, 'quantity': 2}, {'product_id': self.case.pk, 'quantity': 1},
+                ])
+        self.assertEqual(caught.exception.product_id, self.case.pk)
+        self.assertEqual(self.stocks(), [5, 0])
+        self.assertEqual(inventory.get_inventory_metrics()['rejected'], 1)
+
+
+class OrderSummaryTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'pass1234')
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(Category_name='Phones', url_key='phones')
+        self.phone = Product.objects.create(product_name='Phone', price=Decimal('100.00'), stock=5, category=category)
+        self.case = Product.objects.create(product_name='Case', price=Decimal('5.00'), stock=5, category=category)
+        response = self.client.post(reverse('order-list'), {'items': [
+            {'product_id': str(self.phone.pk), 'quantity': 1}, {'product_id': str(self.case.pk), 'quantity': 2},
+        ]}, format='json', HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.order = Order.objects.get()
+
+    def summary(self):
+        return OrderSummary.objects.get(order_id=self.order.pk)
+
+    def place_order(self, user):
+        self.client.force_authenticate(user)
+        response = self.client.post(reverse('order-list'), {'items': [
+            {'product_id': str(self.case.pk), 'quantity': 1},
+        ]}, format='json', HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()['id']
+
+    def list_summaries(self, user, query=''):
+        self.client.force_authenticate(user)
+        response = self.client.get(reverse('order-summaries') + query, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_summary_is_written_with_the_order(self):
+        summary = self.summary()
+        self.assertEqual(
+            (summary.user_id, summary.status, summary.payment_status, summary.total_amount, summary.item_count),
+            (self.user.pk, 'pending', '', Decimal('110.00'), 3),
+        )
+        self.assertEqual(summary.data['user']['email'], 'buyer@example.com')
+        self.assertEqual(
+            [(item['product_name'], item['quantity'], item['price']) for item in summary.data['items']],
+            [('Phone', 1, '100.00'), ('Case', 2, '5.00')],
+        )
+
+    def test_summary_follows_order_and_payment_status(self):
+        self.order.status = 'shipped'
+        self.order.save()
+        self.assertEqual(self.summary().status, 'shipped')
+
+        payment = Payment.objects.create(
+            user=self.user, order=self.order, amount=self.order.total_amount, method='mpesa', status='pending',
+        )
+        self.assertEqual(self.summary().payment_status, 'pending')
+        payment.status = 'failed'
+        payment.save()
+        self.assertEqual(self.summary().payment_status, 'failed')
+
+        # bulk updates announce themselves with payment_status_changed
+        Payment.objects.filter(pk=payment.pk).update(status='successful')
+        payment.status = 'successful'
+        signals.payment_status_changed.send(sender=Payment, payments=[payment])
+        self.assertEqual(self.summary().payment_status, 'successful')
+
+    def test_summaries_endpoint_lists_own_orders_unless_staff(self):
+        other = User.objects.create_user('other', 'other@example.com', 'pass1234')
+        other_order = self.place_order(other)
+        staff = User.objects.create_user('staff', 'staff@example.com', 'pass1234', is_staff=True)
+
+        self.assertEqual([row['order'] for row in self.list_summaries(self.user)], [str(self.order.pk)])
+        self.assertEqual([row['order'] for row in self.list_summaries(other)], [other_order])
+        # newest first
+        self.assertEqual(
+            [row['order'] for row in self.list_summaries(staff)], [other_order, str(self.order.pk)],
+        )
+        row = self.list_summaries(self.user)[0]
+        self.assertEqual((row['status'], row['total_amount'], row['item_count']), ('pending', '110.00', 3))
+
+    def test_summaries_endpoint_filters_by_status(self):
+        shipped = self.place_order(self.user)
+        order = Order.objects.get(pk=shipped)
+        order.status = 'shipped'
+        order.save()
+
+        self.assertEqual([row['order'] for row in self.list_summaries(self.user, '?status=shipped')], [shipped])
+        self.assertEqual(
+            [row['order'] for row in self.list_summaries(self.user, '?status=pending')], [str(self.order.pk)],
+        )
+        self.assertEqual(self.list_summaries(self.user, '?status=cancelled'), [])
+
+    def test_summaries_endpoint_keyset_pagination(self):
+        orders = [self.place_order(self.user) for _ in range(3)]
+        # two orders with the same timestamp are told apart by id
+        OrderSummary.objects.filter(order_id__in=orders[:2]).update(created_at=self.summary().created_at)
+
+        page = self.list_summaries(self.user, '?pagination=keyset&page_size=2')
+        seen = [row['order'] for row in page['results']]
+        while page['next']:
+            self.assertLessEqual(len(page['results']), 2)
+            response = self.client.get(page['next'], HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            seen += [row['order'] for row in page['results']]
+        self.assertEqual(sorted(seen), sorted([*orders, str(self.order.pk)]))
+        self.assertEqual(
+            seen,
+            [str(pk) for pk in OrderSummary.objects.order_by('-created_at', '-order').values_list('order', flat=True)],
+        )
+
+    def test_rebuild_restores_summaries(self):
+        Payment.objects.create(
+            user=self.user, order=self.order, amount=self.order.total_amount, method='mpesa', status='successful',
+        )
+        expected = OrderSummary.objects.values().get(order_id=self.order.pk)
+        OrderSummary.objects.filter(order_id=self.order.pk).update(status='cancelled', item_count=0, data={})
+        other = Order.objects.create(user=self.user, total_amount=Decimal('0.00'))
+
+        out = io.StringIO()
+        call_command('rebuild_order_summaries', stdout=out)
+        self.assertIn('Rebuilt 2 order summaries.', out.getvalue())
+        restored = OrderSummary.objects.values().get(order_id=self.order.pk)
+        del restored['updated_at'], expected['updated_at']
+        self.assertEqual(restored, expected)
+        self.assertEqual(OrderSummary.objects.get(order_id=other.pk).item_count, 0)
+
+
+@override_settings(INVENTORY_RESERVATION_MODE='optimistic', INVENTORY_OPTIMISTIC_MAX_RETRIES=2)
+class OptimisticReservationTests(APITestCase):
+    def setUp(self):
+        cache.delete_many([metrics._key(inventory.RETRIES_METRIC), metrics._key(inventory.REJECTED_METRIC)])
+        self.enterContext(mock.patch.object(inventory.time, 'sleep'))
+        category = Category.objects.create(Category_name='Phones', url_key='phones')
+        self.phone = Product.objects.create(product_name='Phone', price=Decimal('100.00'), stock=5, category=category)
+        self.case = Product.objects.create(product_name='Case', price=Decimal('5.00'), stock=5, category=category)
+
+    def reserve(self, *lines):
+        with transaction.atomic():
+            return inventory.reserve_stock([{'product_id': product.pk, 'quantity': qty} for product, qty in lines])
+
+    def stocks(self):
+        return [Product.objects.get(pk=product.pk).stock for product in (self.phone, self.case)]
+
+    def counters(self):
+        data = inventory.get_inventory_metrics()
+        return data['retries'], data['rejected']
+
+    def test_whole_cart_in_one_update(self):
+        with mock.patch.object(inventory, '_decrement_one') as fallback:
+            lines = self.reserve((self.phone, 2), (self.case, 1), (self.phone, 1))
+        fallback.assert_not_called()
+        self.assertEqual([(product.pk, product.stock, qty) for product, qty in lines], [
+            (self.phone.pk, 2, 2), (self.case.pk, 4, 1), (self.phone.pk, 2, 1),
+        ])
+        self.assertEqual(self.stocks(), [2, 4])
+        self.assertEqual(self.counters(), (0, 0))
+
+    def test_short_line_falls_back_per_product_and_rolls_back(self):
+        with mock.patch.object(inventory, '_decrement_one', wraps=inventory._decrement_one) as fallback:
+            with self.assertRaises(InsufficientStock) as caught:
+                self.reserve((self.phone, 2), (self.case, 6))
+        self.assertEqual(caught.exception.product_id, self.case.pk)
+        self.assertIn(mock.call(self.case.pk, 6), fallback.call_args_list)
+        self.assertEqual(self.stocks(), [5, 5])
+        self.assertEqual(self.counters(), (0, 1))
+
+    def test_conflicting_cart_update_is_retried_per_product(self):
+        update = QuerySet.update
+        calls = []
+
+        def deadlock_once(queryset, **kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                raise OperationalError('deadlock detected')
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', deadlock_once):
+            self.reserve((self.phone, 2), (self.case, 1))
+        # the failed cart UPDATE, then one per product
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.stocks(), [3, 4])
+
+    def test_retry_limit(self):
+        with mock.patch.object(QuerySet, 'update', side_effect=OperationalError('lock wait timeout')):
+            with self.assertLogs('mtaani_app.inventory', 'WARNING') as logs, self.assertRaises(InsufficientStock):
+                self.reserve((self.phone, 1))
+        # first attempt plus INVENTORY_OPTIMISTIC_MAX_RETRIES
+        self.assertEqual(len(logs.output), 3)
+        self.assertEqual(self.counters(), (2, 1))
+        self.assertEqual(self.stocks(), [5, 5])
+
+    @unittest.skipUnless(REDIS_CACHES, 'set REDIS_TEST_URL to a disposable Redis database')
+    def test_rejections_rank_contended_products(self):
+        with override_settings(CACHES=REDIS_CACHES or {}):
+            metrics.get_redis_connection('default').flushdb()
+            for _ in range(2):
+                with self.assertRaises(InsufficientStock):
+                    self.reserve((self.case, 9))
+            with self.assertRaises(InsufficientStock):
+                self.reserve((self.phone, 9))
+            ranking = inventory.get_inventory_metrics()['hot_products']
+        self.assertEqual(ranking, [
+            {'member': str(self.case.pk), 'score': 2}, {'member': str(self.phone.pk), 'score': 1},
+        ])
+
+
+class EmailOutboxTests(APITestCase):
+    def setUp(self):
+        self.enterContext(mock.patch.object(tasks.flush_email_outbox, 'apply_async'))
+        self.addCleanup(dispatch.flush)
+        cache.delete_many([emails.FLUSH_LOCK_KEY, emails.FLUSH_SCHEDULED_KEY])
+        self.users = [User.objects.create_user(f'buyer{n}', f'buyer{n}@example.com', 'pass1234') for n in range(3)]
+
+    def make_orders(self, count):
+        orders = []
+        for n in range(count):
+            user = self.users[n % len(self.users)]
+            order = Order.objects.create(user=user, total_amount=Decimal('10.00'))
+            Payment.objects.create(user=user, order=order, amount=order.total_amount, method='mpesa', status='successful')
+            orders.append(order)
+        return orders
+
+    def test_messages_are_sent_in_one_batch(self):
+        orders = self.make_orders(6)
+        for order in orders:
+            emails.queue_booking_confirmation(order)
+        emails.queue_payment_confirmations(Payment.objects.all())
+        emails.queue_email('someone@example.com', 'Hi', 'Body')
+        # one flush for all of them
+        self.assertEqual(TaskOutbox.objects.filter(task=tasks.flush_email_outbox.name).count(), 1)
+
+        with mock.patch.object(emails, 'get_connection', wraps=emails.get_connection) as get_connection, \
+                self.assertNumQueries(2):  # the batch with its payments, orders and users; one UPDATE
+            result = emails.flush_outbox()
+
+        self.assertEqual(result, {'skipped': False, 'sent': 13, 'failed': 0, 'retrying': 0, 'rate_limited': False})
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 13)
+        self.assertIn(f'Order {orders[0].id}', mail.outbox[0].subject)
+        self.assertFalse(OutboundEmail.objects.exclude(status='sent').exists())
+
+    def test_failures_are_retried_then_given_up(self):
+        emails.queue_email('ok@example.com', 'Hi', 'Body')
+        emails.queue_email('bad@example.com', 'Hi', 'Body')
+        original_send = mail.EmailMessage.send
+
+        def send(message, *args, **kwargs):
+            if message.to == ['bad@example.com']:
+                raise OSError('mailbox unavailable')
+            return original_send(message, *args, **kwargs)
+
+        with mock.patch.object(mail.EmailMessage, 'send', send), override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2), \
+                self.assertLogs('mtaani_app.emails', 'WARNING'):
+            self.assertEqual(emails.flush_outbox()['retrying'], 1)
+            bad = OutboundEmail.objects.get(recipient='bad@example.com')
+            self.assertEqual((bad.status, bad.attempts, bad.last_error), ('pending', 1, 'mailbox unavailable'))
+            self.assertGreater(bad.next_attempt_at, timezone.now())
+
+            OutboundEmail.objects.filter(pk=bad.pk).update(next_attempt_at=timezone.now())
+            self.assertEqual(emails.flush_outbox()['failed'], 1)
+        self.assertEqual(OutboundEmail.objects.get(pk=bad.pk).status, 'failed')
+        self.assertEqual(OutboundEmail.objects.get(recipient='ok@example.com').status, 'sent')
+
+    def test_lock_is_extended_and_a_lost_lock_stops_the_flush(self):
+        for n in range(3):
+            emails.queue_email(f'l{n}@example.com', 'Hi', 'Body')
+        original_send = mail.EmailMessage.send
+
+        def send(message, *args, **kwargs):
+            # a long send: the lock expires and another flush takes it
+            if message.to == ['l1@example.com']:
+                cache.set(emails.FLUSH_LOCK_KEY, 'other flush')
+            return original_send(message, *args, **kwargs)
+
+        with mock.patch.object(mail.EmailMessage, 'send', send), \
+                mock.patch.object(cache, 'touch', wraps=cache.touch) as touch, \
+                self.assertLogs('mtaani_app.emails', 'WARNING'):
+            result = emails.flush_outbox()
+        self.assertEqual(touch.call_count, 2)
+        self.assertEqual(result['sent'], 2)
+        self.assertEqual(
+            dict(OutboundEmail.objects.values_list('recipient', 'attempts')),
+            {'l0@example.com': 1, 'l1@example.com': 1, 'l2@example.com': 0},
+        )
+        self.assertEqual(OutboundEmail.objects.get(recipient='l2@example.com').status, 'pending')
+        # the other flush's lock is left alone
+        self.assertEqual(cache.get(emails.FLUSH_LOCK_KEY), 'other flush')
+        cache.delete(emails.FLUSH_LOCK_KEY)
+
+    @override_settings(EMAIL_RATE_LIMIT=2)
+    def test_rate_limit(self):
+        for n in range(3):
+            emails.queue_email(f'r{n}@example.com', 'Hi', 'Body')
+        with mock.patch.object(emails, 'SENT_KEY', f'emails:test:{uuid.uuid4().hex}:{{minute}}'):
+            result = emails.flush_outbox()
+        self.assertEqual((result['sent'], result['rate_limited']), (2, True))
+        self.assertEqual(OutboundEmail.objects.filter(status='pending').count(), 1)
+
+
+class TaskResultTests(APITestCase):
+    def test_fire_and_forget_tasks_store_no_result(self):
+        for task in (tasks.send_payment_confirmation_email, tasks.send_booking_confirmation_email,
+                     tasks.flush_email_outbox):
+            self.assertTrue(task.ignore_result, task.name)
+        self.assertFalse(tasks.add.ignore_result)
+
+    def test_purge_old_results(self):
+        from django_celery_results.models import TaskResult
+
+        TaskResult.objects.create(task_id='old', status='SUCCESS')
+        TaskResult.objects.create(task_id='new', status='SUCCESS')
+        TaskResult.objects.filter(task_id='old').update(date_done=timezone.now() - timedelta(days=2))
+
+        self.assertEqual(task_results.purge_task_results(older_than=3600, batch_size=1), {'tasks': 1, 'groups': 0})
+        self.assertEqual(list(TaskResult.objects.values_list('task_id', flat=True)), ['new'])
+
+
+class DispatchTests(APITestCase):
+    def setUp(self):
+        self.publish = self.enterContext(mock.patch.object(tasks.add, 'apply_async'))
+        self.addCleanup(dispatch.flush)
+
+    def test_tasks_are_published_after_commit_in_one_batch(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                dispatch.dispatch(tasks.add, (1, 2))
+                dispatch.dispatch(tasks.add, (3, 4), countdown=30)
+            self.assertEqual(TaskOutbox.objects.count(), 2)
+        # buffered until the request (or task) is over
+        self.assertEqual(self.publish.call_count, 0)
+
+        request_finished.send(sender=None)
+        calls = self.publish.call_args_list
+        self.assertEqual([c.args[0] for c in calls], [[1, 2], [3, 4]])
+        self.assertIsNone(calls[0].kwargs['eta'])
+        self.assertIsNotNone(calls[1].kwargs['eta'])
+        self.assertEqual(len({id(c.kwargs['producer']) for c in calls}), 1)
+        self.assertFalse(TaskOutbox.objects.exists())
+
+    def test_rolled_back_dispatch_is_dropped(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                dispatch.dispatch(tasks.add, (1, 2))
+                raise RuntimeError
+        self.assertEqual(dispatch.flush(), 0)
+        self.assertFalse(TaskOutbox.objects.exists())
+
+    def test_relay_publishes_what_the_broker_refused(self):
+        self.publish.side_effect = OSError('broker down')
+        with self.captureOnCommitCallbacks(execute=True):
+            dispatch.dispatch(tasks.add, (1, 2))
+        with self.assertLogs('mtaani_app.dispatch', 'WARNING'):
+            self.assertEqual(dispatch.flush(), 0)
+        entry = TaskOutbox.objects.get()
+        self.assertEqual((entry.attempts, entry.last_error), (1, 'broker down'))
+
+        # too recent for the relay
+        self.assertEqual(dispatch.relay(), {'sent': 0, 'failed': 0})
+        self.publish.side_effect = None
+        self.assertEqual(dispatch.relay(min_age=0), {'sent': 1, 'failed': 0})
+        self.assertFalse(TaskOutbox.objects.exists())
+
+
+class ExportTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'pass1234')
+        self.staff = User.objects.create_superuser('finance', 'finance@example.com', 'pass1234')
+        self.client.force_authenticate(self.staff)
+        self.orders = []
+        for days in (40, 20, 10):
+            order = Order.objects.create(user=self.user, total_amount=Decimal(days))
+            Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timedelta(days=days))
+            Payment.objects.create(
+                user=self.user, order=order, amount=order.total_amount, method='mpesa',
+                status='successful' if days < 30 else 'failed', mpesa_receipt_number=f'R{days}',
+                created_at=timezone.now() - timedelta(days=days),
+            )
+            self.orders.append(order)
+
+    def get(self, name, **params):
+        return self.client.get(reverse(name), params)
+
+    def content(self, response):
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_orders_in_date_range(self):
+        since = (timezone.now() - timedelta(days=30)).isoformat()
+        response = self.get('order-export', format='csv', order_date__gte=since)
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment; filename="orders-', response['Content-Disposition'])
+        rows = list(csv.reader(io.StringIO(self.content(response))))
+        self.assertEqual(rows[0][:5], ['id', 'created_at', 'updated_at', 'status', 'total_amount'])
+        self.assertEqual([row[0] for row in rows[1:]], [str(self.orders[1].pk), str(self.orders[2].pk)])
+        self.assertEqual(rows[1][-2:], ['successful', 'R20'])
+
+    def test_ndjson_payments(self):
+        response = self.get('payment-export', format='ndjson', status='successful')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        records = [json.loads(line) for line in self.content(response).splitlines()]
+        self.assertEqual([record['amount'] for record in records], ['20.00', '10.00'])
+        self.assertEqual(records[0]['user_email'], 'buyer@example.com')
+
+    def test_streams_in_chunks_with_one_query(self):
+        queryset = exports.filtered('payments', {})
+        with self.assertNumQueries(1):
+            chunks = list(exports.stream('payments', queryset, 'csv', chunk_size=1))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(sum(chunk.count(b'\n') for chunk in chunks), 4)
+
+    def test_rejects_bad_filters_and_non_staff(self):
+        response = self.get('payment-export', format='ndjson', status='bogus')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('status', json.loads(response.content.decode().splitlines()[0]))
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.get('order-export', format='csv').status_code, 403)
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('export_records', 'payments', '--filter', 'status=failed', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('R40', lines[1])
+
+
+class SalesRollupTests(PaymentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.phones = Category.objects.create(Category_name='Phones', url_key='phones')
+        self.cables = Category.objects.create(Category_name='Cables', url_key='cables')
+        self.phone = Product.objects.create(product_name='Phone', price=Decimal('100.00'), stock=50, category=self.phones)
+        self.cable = Product.objects.create(product_name='Cable', price=Decimal('5.00'), stock=50, category=self.cables)
+        self.paid_at = timezone.now().replace(minute=30, second=0, microsecond=0) - timedelta(days=1)
+
+    def order(self, lines, status='successful', paid_at=None):
+        total = sum(product.price * quantity for product, quantity in lines)
+        order = Order.objects.create(user=self.user, total_amount=total)
+        for product, quantity in lines:
+            OrderItem.objects.create(order=order, product=product, quantity=quantity, price=product.price)
+        with self.captureOnCommitCallbacks(execute=True):
+            return Payment.objects.create(
+                user=self.user, order=order, amount=total, method='mpesa', status=status,
+                paid_at=paid_at or self.paid_at if status == 'successful' else None,
+            )
+
+    def totals(self, period='day'):
+        return list(SalesRollup.objects.filter(period=period).values_list('orders', 'revenue'))
+
+    def products(self):
+        return {
+            row[0]: row[1:]
+            for row in ProductSalesRollup.objects.filter(period='day')
+            .values_list('product_id', 'category_id', 'orders', 'units', 'revenue')
+        }
+
+    def test_successful_payments_are_counted_once(self):
+        payment = self.order([(self.phone, 1), (self.cable, 2), (self.cable, 1)])
+        self.order([(self.phone, 2)])
+        self.order([(self.phone, 1)], status='failed')
+
+        self.assertEqual(self.totals(), [(2, Decimal('315.00'))])
+        self.assertEqual(self.totals('hour'), [(2, Decimal('315.00'))])
+        self.assertEqual(self.products(), {
+            self.phone.pk: (self.phones.pk, 2, 3, Decimal('300.00')),
+            self.cable.pk: (self.cables.pk, 1, 3, Decimal('15.00')),
+        })
+        self.assertIsNotNone(Payment.objects.get(pk=payment.pk).rolled_up_at)
+
+        # saving again, or a catch-up run, doesn't count it twice
+        with self.captureOnCommitCallbacks(execute=True):
+            Payment.objects.get(pk=payment.pk).save()
+        self.assertEqual(rollups.record_pending(), 0)
+        self.assertEqual(self.totals(), [(2, Decimal('315.00'))])
+
+    def test_bulk_settled_payments_are_counted(self):
+        pending = self.make_payment('ws_CO_rollup')
+        OrderItem.objects.create(order=pending.order, product=self.cable, quantity=2, price=self.cable.price)
+        with self.captureOnCommitCallbacks(execute=True):
+            payments.apply_query_results({pending.pk: stk_callback('ws_CO_rollup')['Body']['stkCallback']})
+        self.assertEqual(SalesRollup.objects.get(period='day').revenue, Decimal('10.00'))
+        self.assertEqual(self.products()[self.cable.pk][2], 2)
+
+    def test_catch_up_and_rebuild(self):
+        payment = self.order([(self.phone, 1)])
+        # missed by the signal handlers
+        Payment.objects.filter(pk=payment.pk).update(rolled_up_at=None)
+        SalesRollup.objects.all().delete()
+        ProductSalesRollup.objects.all().delete()
+        Payment.objects.bulk_create([Payment(
+            user=self.user, order=Order.objects.create(user=self.user, total_amount=Decimal('5.00')),
+            amount=Decimal('5.00'), method='mpesa', status='successful', paid_at=self.paid_at,
+        )])
+        self.assertEqual(rollups.record_pending(batch_size=1), 2)
+        self.assertEqual(self.totals(), [(2, Decimal('105.00'))])
+
+        SalesRollup.objects.update(revenue=Decimal('1.00'))
+        out = io.StringIO()
+        call_command('backfill_sales_rollups', '--rebuild', '--since', f'{self.paid_at:%Y-%m-%d}', stdout=out)
+        self.assertIn('Rolled up 2 payments', out.getvalue())
+        self.assertEqual(self.totals(), [(2, Decimal('105.00'))])
+
+    def test_analytics_endpoints(self):
+        self.order([(self.phone, 1), (self.cable, 4)])
+        self.order([(self.cable, 1)], paid_at=self.paid_at - timedelta(days=60))
+        self.client.force_authenticate(User.objects.create_superuser('boss', 'boss@example.com', 'pass1234'))
+
+        response = self.client.get(reverse('sales-analytics'), HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(row['orders'], row['revenue']) for row in response.json()], [(1, '120.00')])
+
+        response = self.client.get(
+            reverse('category-analytics'), {'start': f'{self.paid_at - timedelta(days=90):%Y-%m-%d}'},
+            HTTP_ACCEPT='application/json',
+        )
+        self.assertEqual(
+            [(row['name'], row['units'], row['revenue']) for row in response.json()],
+            [('Phones', 1, '100.00'), ('Cables', 5, '25.00')],
+        )
+        response = self.client.get(reverse('product-analytics'), {'limit': 1}, HTTP_ACCEPT='application/json')
+        self.assertEqual([row['name'] for row in response.json()], ['Phone'])
+
+        response = self.client.get(reverse('sales-analytics'), {'period': 'week'}, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.client.force_authenticate(self.user)
+        response = self.client.get(reverse('sales-analytics'), HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 403)
+
+
+class AdminChangelistTests(APITestCase):
+    def setUp(self):
+        self.staff = User.objects.create_superuser('admin', 'admin@example.com', 'pass1234')
+        self.client.force_login(self.staff)
+        category = Category.objects.create(Category_name='Phones', url_key='phones')
+        self.product = Product.objects.create(
+            product_name='Samsung Galaxy', url_key='galaxy', price=Decimal('100.00'), stock=5, category=category,
+        )
+        Product.objects.create(product_name='Nokia Brick', url_key='brick', price=Decimal('20.00'), stock=5, category=category)
+
+    def make_orders(self, count):
+        for n in range(Order.objects.count(), Order.objects.count() + count):
+            user = User.objects.create_user(f'buyer{n}', f'buyer{n}@example.com', 'pass1234')
+            order = Order.objects.create(user=user, total_amount=Decimal('100.00'))
+            OrderItem.objects.create(order=order, product=self.product, quantity=1, price=self.product.price)
+            Payment.objects.create(
+                user=user, order=order, amount=order.total_amount, method='mpesa', status='pending',
+                transaction_id=f'ws_CO_{n}', mpesa_receipt_number=f'RCPT{n}',
+            )
+
+    def queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        self.make_orders(2)
+        urls = [reverse(f'admin:mtaani_app_{name}_changelist') for name in ('order', 'orderitem', 'payment')]
+        before = [self.queries(url) for url in urls]
+        self.make_orders(5)
+        self.assertEqual([self.queries(url) for url in urls], before)
+
+    def test_uses_estimated_count_for_large_results(self):
+        self.make_orders(3)
+        with mock.patch('mtaani_app.pagination.estimate_count', return_value=5_000_000):
+            response = self.client.get(reverse('admin:mtaani_app_payment_changelist'))
+        self.assertContains(response, '5000000 payments')
+        # small estimates are counted exactly
+        with mock.patch('mtaani_app.pagination.estimate_count', return_value=3):
+            response = self.client.get(reverse('admin:mtaani_app_payment_changelist'))
+        self.assertContains(response, '3 payments')
+
+    def test_exact_search(self):
+        self.make_orders(3)
+        response = self.client.get(reverse('admin:mtaani_app_payment_changelist'), {'q': 'RCPT1'})
+        self.assertEqual([payment.mpesa_receipt_number for payment in response.context['cl'].result_list], ['RCPT1'])
+        response = self.client.get(reverse('admin:mtaani_app_payment_changelist'), {'q': 'RCPT'})
+        self.assertEqual(len(response.context['cl'].result_list), 0)
+        order = Order.objects.first()
+        response = self.client.get(reverse('admin:mtaani_app_order_changelist'), {'q': str(order.pk)})
+        self.assertEqual(list(response.context['cl'].result_list), [order])
+        response = self.client.get(reverse('admin:mtaani_app_order_changelist'), {'q': 'not-an-id'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_product_widgets_and_search(self):
+        self.make_orders(1)
+        response = self.client.get(reverse('admin:mtaani_app_order_change', args=[Order.objects.get().pk]))
+        self.assertContains(response, 'admin-autocomplete')
+        self.assertNotContains(response, '>Nokia Brick<')
+        response = self.client.get(reverse('admin:mtaani_app_product_changelist'), {'q': 'galax'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.product])
+        response = self.client.get(reverse('admin:mtaani_app_product_changelist'), {'q': 'brick'})
+        self.assertEqual([product.url_key for product in response.context['cl'].result_list], ['brick'])
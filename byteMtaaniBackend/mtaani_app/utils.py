@@ -1,47 +1,22 @@
 import logging
-from django.core.cache import cache
 from django_redis import get_redis_connection
-from redis.exceptions import ConnectionError as RedisConnectionError
-from .models import Product
+from . import catalog_cache
 
 logger = logging.getLogger(__name__)
 
 
-def get_all_properties():
-    """Return a queryset for all Product instances, using Redis low-level cache.
+def get_all_properties(category=None):
+    """Return the serialized product catalog as ready-to-send JSON bytes.
 
-    Implementation stores list of primary keys in Redis under 'all_properties'
-    for 1 hour (3600s) and reconstructs a queryset from those IDs. This
-    avoids pickling whole model instances while keeping the "queryset"
-    semantics expected by callers.
-    """
-    key = 'all_properties'
-    try:
-        ids = cache.get(key)
-    except RedisConnectionError:
-        # Redis is unavailable — log and fall back to DB
-        logger.exception('Redis unavailable when attempting cache.get(%s); falling back to DB', key)
-        ids = None
-    except Exception:
-        # Any other cache backend error — don't let this break the view
-        logger.exception('Unexpected cache error when reading %s; falling back to DB', key)
-        ids = None
-
-    if ids is not None:
-        # return a queryset reconstructed from cached ids
-        qs = Product.objects.filter(pk__in=ids)
-        return qs
+    When `category` (a category id) is given only that category's products
+    are returned.
 
-    # cache miss or cache unavailable: fetch ids and attempt to cache them
-    ids = list(Product.objects.values_list('pk', flat=True))
-    try:
-        cache.set(key, ids, 3600)
-    except RedisConnectionError:
-        logger.exception('Redis unavailable when attempting cache.set(%s); continuing without cache', key)
-    except Exception:
-        logger.exception('Unexpected cache error when setting %s; continuing without cache', key)
-
-    return Product.objects.filter(pk__in=ids)
+    The payload is assembled from per-product JSON fragments cached in Redis
+    (see `catalog_cache`), so a warm call doesn't query the database or run
+    `ProductSerializer`. Cache failures are handled inside `catalog_cache`,
+    which falls back to the database.
+    """
+    return catalog_cache.get_catalog_json(category)
 
 
 def get_redis_cache_metrics():
@@ -1,57 +1,157 @@
+import json
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework import permissions
-from django.db import transaction
-from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import HttpResponse
+from django.urls import reverse
 from django.contrib.auth import get_user_model
 from rest_framework.decorators import api_view
-from django.views.decorators.cache import cache_page
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from django.utils.decorators import method_decorator
 from rest_framework.decorators import api_view, permission_classes, renderer_classes
 from rest_framework import permissions
 from rest_framework.renderers import TemplateHTMLRenderer
 from rest_framework.renderers import JSONRenderer
+from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
 
 from .serializers import (
-	ProductSerializer, CategorySerializer, OrderSerializer, UserSerializer, PaymentSerializer
+	ProductSerializer, CategorySerializer, OrderSerializer, UserSerializer, PaymentSerializer,
+	OrderSummarySerializer,
 )
 from .utils import get_all_properties, get_redis_cache_metrics
-from .mpesa import initiate_stk_push, query_stk_status
-from .tasks import send_payment_confirmation_email, send_booking_confirmation_email
-
-from .models import Category, Product, Order, OrderItem, Payment
+from .mpesa import initiate_stk_push, get_mpesa_metrics, CircuitOpenError, default_breaker
+from .tasks import initiate_mpesa_payment
+
+from .models import Category, Product, Order, OrderItem, Payment, OrderSummary
+from . import read_models, payments, callback_stream, emails, exports, facets, rollups
+from .dispatch import dispatch
+from .pagination import KeysetPagination
+from .filters import ProductFilter
+from .product_import import ImportFileError, guess_format, import_products
+from .renderers import CSVRenderer, FastJSONRenderer, NDJSONRenderer
+from .fast_serializers import row_mapper
+from .inventory import InsufficientStock, reserve_stock, get_inventory_metrics
+from .hot_stock import hot_reservation
 
 User = get_user_model()
 
 
-class ProductViewSet(viewsets.ModelViewSet):
+class EagerLoadingViewSetMixin:
+	"""Apply the serializer's declared select/prefetch relations to the queryset."""
+
+	def get_queryset(self):
+		queryset = super().get_queryset()
+		serializer_class = self.get_serializer_class()
+		if hasattr(serializer_class, 'setup_eager_loading'):
+			queryset = serializer_class.setup_eager_loading(queryset)
+		return queryset
+
+
+class FastListMixin:
+	"""Build JSON list responses from `.values()` rows.
+
+	The serializer is compiled once into a row mapper (see
+	`fast_serializers`), so a list skips model instantiation and DRF's
+	per-field machinery while producing the same output. HTML responses, and
+	every response when `FAST_LIST_SERIALIZATION` is off, use the serializer.
+	"""
+
+	def use_fast_list(self, request):
+		renderer = getattr(request, 'accepted_renderer', None)
+		return settings.FAST_LIST_SERIALIZATION and getattr(renderer, 'format', None) == 'json'
+
+	def fast_list(self, queryset):
+		mapper = row_mapper(self.get_serializer_class())
+		rows = queryset.values(*mapper.columns)
+		page = self.paginate_queryset(rows)
+		return mapper.map_rows(page if page is not None else rows)
+
+
+class ProductViewSet(FastListMixin, EagerLoadingViewSetMixin, viewsets.ModelViewSet):
 	queryset = Product.objects.all()
 	serializer_class = ProductSerializer
 	permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+	# ?search= / ?name= rank by relevance, except under keyset pagination (newest first)
+	filterset_class = ProductFilter
+	# opt-in keyset pagination: ?cursor= / ?pagination=keyset
+	pagination_class = KeysetPagination
 
 	# Support rendering HTML list via the shared API template when Accept: text/html
-	renderer_classes = [TemplateHTMLRenderer, JSONRenderer]
+	renderer_classes = [TemplateHTMLRenderer, FastJSONRenderer]
 
 	def list(self, request, *args, **kwargs):
 		qs = self.filter_queryset(self.get_queryset())
-		page = self.paginate_queryset(qs)
-		serializer = self.get_serializer(page or qs, many=True)
-		if getattr(request, 'accepted_renderer', None) and getattr(request.accepted_renderer, 'format', None) == 'html':
-			return Response({'items': serializer.data, 'title': 'Products'}, template_name='api_root.html')
-		return Response(serializer.data)
+		if self.use_fast_list(request):
+			data = self.fast_list(qs)
+		else:
+			page = self.paginate_queryset(qs)
+			serializer = self.get_serializer(page if page is not None else qs, many=True)
+			if getattr(request, 'accepted_renderer', None) and getattr(request.accepted_renderer, 'format', None) == 'html':
+				return Response({'items': serializer.data, 'title': 'Products'}, template_name='api_root.html')
+			data = serializer.data
+		# ?facets=1 adds category / stock / price range counts of the filtered list
+		facet_counts = None
+		if request.query_params.get('facets', '').lower() in ('1', 'true', 'yes'):
+			facet_counts = facets.product_facets(qs, request.query_params)
+		if self.paginator.keyset:
+			response = self.get_paginated_response(data)
+			if facet_counts is not None:
+				response.data['facets'] = facet_counts
+			return response
+		if facet_counts is not None:
+			return Response({'results': data, 'facets': facet_counts})
+		return Response(data)
+
+	@action(
+		detail=False, methods=["post"], url_path="import", url_name="import", permission_classes=[permissions.IsAdminUser],
+		parser_classes=[MultiPartParser], renderer_classes=[JSONRenderer],
+	)
+	def bulk_import(self, request):
+		"""Insert or update products from an uploaded CSV/JSON file, keyed on url_key.
+
+		POST /api/products/import/ (multipart): `file`, optional `format`
+		("csv" or "json", guessed from the file name) and `chunk_size`.
+		Returns the import counts, skipped rows and throughput; see
+		product_import.py. Very large files are better loaded with
+		`manage.py import_products`.
+		"""
+		upload = request.FILES.get('file')
+		if upload is None:
+			return Response({'detail': 'file is required'}, status=status.HTTP_400_BAD_REQUEST)
+		try:
+			chunk_size = int(request.data.get('chunk_size') or 1000)
+		except ValueError:
+			chunk_size = 0
+		if chunk_size < 1:
+			return Response({'detail': 'chunk_size must be a positive integer'}, status=status.HTTP_400_BAD_REQUEST)
+		try:
+			result = import_products(upload, request.data.get('format') or guess_format(upload.name), chunk_size)
+		except ImportFileError as exc:
+			return Response({'detail': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+		return Response(result)
 
 
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(FastListMixin, EagerLoadingViewSetMixin, viewsets.ModelViewSet):
 	queryset = Category.objects.all()
 	serializer_class = CategorySerializer
 	permission_classes = [permissions.IsAuthenticatedOrReadOnly]
 
-	renderer_classes = [TemplateHTMLRenderer, JSONRenderer]
+	renderer_classes = [TemplateHTMLRenderer, FastJSONRenderer]
 
 	def list(self, request, *args, **kwargs):
 		qs = self.filter_queryset(self.get_queryset())
+		if self.use_fast_list(request):
+			return Response(self.fast_list(qs))
 		page = self.paginate_queryset(qs)
 		serializer = self.get_serializer(page or qs, many=True)
 		if getattr(request, 'accepted_renderer', None) and getattr(request.accepted_renderer, 'format', None) == 'html':
@@ -59,7 +159,7 @@ class CategoryViewSet(viewsets.ModelViewSet):
 		return Response(serializer.data)
 
 
-class CustomerViewSet(viewsets.ModelViewSet):
+class CustomerViewSet(EagerLoadingViewSetMixin, viewsets.ModelViewSet):
 	queryset = User.objects.all()
 	serializer_class = UserSerializer
 	permission_classes = [permissions.IsAuthenticated]
@@ -77,21 +177,29 @@ class CustomerViewSet(viewsets.ModelViewSet):
 
 @api_view(['GET'])
 @renderer_classes([TemplateHTMLRenderer, JSONRenderer])
-@cache_page(60 * 15)
 def production_list(request):
-	"""Return all productions (products), cached at view level for 15 minutes.
+	"""Return all productions (products).
 
-	Uses `get_all_properties()` for low-level caching of the queryset in Redis.
+	Uses `get_all_properties()`, which assembles the response from per-product
+	JSON fragments cached in Redis, so the JSON body is sent as-is. The index
+	behind it is rebuilt by a single worker while others serve the stale copy,
+	so there is no view-level cache_page (and no 15-minute stale stock).
+	Pass `?category=<uuid>` to list a single category.
 	"""
-	qs = get_all_properties()
-	serializer = ProductSerializer(qs, many=True)
+	category = request.query_params.get('category')
+	if category:
+		try:
+			category = uuid.UUID(category)
+		except ValueError:
+			return Response({'detail': 'category must be a UUID'}, status=status.HTTP_400_BAD_REQUEST)
+	payload = get_all_properties(category=category or None)
 	# If the client requested HTML, render a template with the serialized data
 	if getattr(request, 'accepted_renderer', None) and getattr(request.accepted_renderer, 'format', None) == 'html':
 		# Template name should exist under your templates/ directory
-		return Response({ 'products': serializer.data }, template_name='productions/list.html')
+		return Response({ 'products': json.loads(payload) }, template_name='productions/list.html')
 
-	# Default to JSON response
-	return Response(serializer.data)
+	# Default to JSON response, already rendered
+	return HttpResponse(payload, content_type='application/json')
 
 
 @api_view(['GET'])
@@ -101,19 +209,108 @@ def cache_metrics(request):
 	return Response(metrics)
 
 
-class OrderViewSet(viewsets.ModelViewSet):
-	queryset = Order.objects.prefetch_related('items').all()
+@api_view(['GET'])
+def inventory_metrics(request):
+	"""Return stock reservation counters (retries/rejections) and the most contended products."""
+	return Response(get_inventory_metrics())
+
+
+@api_view(['GET'])
+def mpesa_metrics(request):
+	"""Return Mpesa API call counts, errors, average latency, retries and the callback queue."""
+	data = get_mpesa_metrics()
+	data["callbacks"] = callback_stream.get_metrics()
+	return Response(data)
+
+
+def _analytics_range(request):
+	"""Parse `period`, `start` and `end` (ISO dates or datetimes) of an analytics request.
+
+	Returns (params, None), or (None, errors) when a parameter is invalid.
+	"""
+	params, errors = {'period': request.query_params.get('period', 'day')}, {}
+	if params['period'] not in rollups.PERIODS:
+		errors['period'] = f"Use one of {', '.join(rollups.PERIODS)}."
+	for name in ('start', 'end'):
+		value = request.query_params.get(name)
+		if not value:
+			params[name] = None
+			continue
+		try:
+			parsed = parse_datetime(value) or parse_date(value)
+		except ValueError:
+			parsed = None
+		if parsed is None:
+			errors[name] = 'Use an ISO 8601 date or datetime.'
+			continue
+		params[name] = rollups.moment(parsed)
+	return (None, errors) if errors else (params, None)
+
+
+def _analytics_limit(request):
+	try:
+		return max(1, min(int(request.query_params.get('limit', 20)), 100))
+	except ValueError:
+		return 20
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def sales_analytics(request):
+	"""Orders and revenue per hour/day (`?period=hour|day&start=&end=`), from the sales rollups."""
+	params, errors = _analytics_range(request)
+	if errors:
+		return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+	return Response(rollups.sales(**params))
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def category_analytics(request):
+	"""Best selling categories over a period (`?start=&end=&limit=`), from the sales rollups."""
+	params, errors = _analytics_range(request)
+	if errors:
+		return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+	return Response(rollups.top('category', limit=_analytics_limit(request), **params))
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def product_analytics(request):
+	"""Best selling products over a period (`?start=&end=&limit=`), from the sales rollups."""
+	params, errors = _analytics_range(request)
+	if errors:
+		return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+	return Response(rollups.top('product', limit=_analytics_limit(request), **params))
+
+
+def _export(request, kind):
+	"""Stream export `kind` (see exports.py) filtered by the query parameters."""
+	try:
+		queryset = exports.filtered(kind, request.query_params, request)
+	except exports.ExportFilterError as exc:
+		return Response(exc.errors, status=status.HTTP_400_BAD_REQUEST)
+	return exports.export_response(kind, queryset, request.accepted_renderer.format)
+
+
+class OrderViewSet(EagerLoadingViewSetMixin, viewsets.ModelViewSet):
+	# relations come from OrderSerializer.eager_relations(); `items` is write-only
+	queryset = Order.objects.all()
 	serializer_class = OrderSerializer
 	permission_classes = [permissions.IsAuthenticated]
+	# opt-in keyset pagination: ?cursor= / ?pagination=keyset
+	pagination_class = KeysetPagination
 
 	renderer_classes = [TemplateHTMLRenderer, JSONRenderer]
 
 	def list(self, request, *args, **kwargs):
 		qs = self.filter_queryset(self.get_queryset())
 		page = self.paginate_queryset(qs)
-		serializer = self.get_serializer(page or qs, many=True)
+		serializer = self.get_serializer(page if page is not None else qs, many=True)
 		if getattr(request, 'accepted_renderer', None) and getattr(request.accepted_renderer, 'format', None) == 'html':
 			return Response({'items': serializer.data, 'title': 'Orders'}, template_name='api_root.html')
+		if self.paginator.keyset:
+			return self.get_paginated_response(serializer.data)
 		return Response(serializer.data)
 
 	def create(self, request, *args, **kwargs):
@@ -131,58 +328,111 @@ class OrderViewSet(viewsets.ModelViewSet):
 			except Exception:
 				return Response({'detail': 'Invalid user id'}, status=status.HTTP_400_BAD_REQUEST)
 
-		total = 0
-		created_items = []
-		with transaction.atomic():
-			# lock and check stock
-			for item in items_data:
-				pid = item.get('product_id')
-				qty = item.get('quantity', 1)
-				product = get_object_or_404(Product.objects.select_for_update(), pk=pid)
-				if product.stock < qty:
-					return Response({'detail': f'Product {product.id} out of stock or insufficient quantity'}, status=status.HTTP_400_BAD_REQUEST)
-				product.stock = max(0, product.stock - qty)
-				product.in_stock = product.stock > 0
-				product.save()
-				total += float(product.price) * qty
-				created_items.append((product, qty))
-
-			order = Order.objects.create(user=user, total_amount=total)
-			for product, qty in created_items:
-				OrderItem.objects.create(order=order, product=product, quantity=qty, price=product.price)
-
-
-		# schedule booking confirmation email asynchronously
 		try:
-			send_booking_confirmation_email.delay(str(order.id))
+			# flash-sale SKUs are reserved on Redis counters; everything else is
+			# locked in one query and decremented together
+			with hot_reservation(items_data) as reserved_in_redis, transaction.atomic():
+				lines = reserve_stock(items_data, skip=reserved_in_redis)
+				total = sum((product.price * qty for product, qty in lines), Decimal('0'))
+
+				order = Order.objects.create(user=user, total_amount=total)
+				OrderItem.objects.bulk_create([
+					OrderItem(order=order, product=product, quantity=qty, price=product.price)
+					for product, qty in lines
+				])
+				read_models.record_order(order, lines, user)
+		except InsufficientStock as exc:
+			return Response({'detail': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+		# queue the booking confirmation on the email outbox
+		try:
+			emails.queue_booking_confirmation(order)
 		except Exception:
-			# don't fail the response if task scheduling fails
+			# don't fail the response if the email can't be queued
 			pass
 
 		out_serializer = self.get_serializer(order)
 		return Response(out_serializer.data, status=status.HTTP_201_CREATED)
 
+	@action(
+		detail=False, methods=["get"], url_path="export", url_name="export", permission_classes=[permissions.IsAdminUser],
+		renderer_classes=[CSVRenderer, NDJSONRenderer],
+	)
+	def export(self, request):
+		"""Stream the orders matching the OrderFilter parameters as CSV or NDJSON.
+
+		GET /api/orders/export/?format=csv|ndjson&order_date__gte=<iso>&order_date__lte=<iso>
+		One query read in chunks, no COUNT or OFFSET; see exports.py.
+		"""
+		return _export(request, 'orders')
+
+	@action(detail=False, methods=["get"], url_path="summaries")
+	def summaries(self, request):
+		"""List denormalized order summaries (one indexed query, no joins).
 
-class PaymentViewSet(viewsets.ModelViewSet):
+		GET /api/orders/summaries/?status=<status>
+		Staff see every order; other users see their own.
+		"""
+		qs = OrderSummary.objects.all()
+		if not request.user.is_staff:
+			qs = qs.filter(user=request.user)
+		if request.query_params.get('status'):
+			qs = qs.filter(status=request.query_params['status'])
+		qs = qs.order_by('-created_at', '-order')
+
+		page = self.paginate_queryset(qs)
+		serializer = OrderSummarySerializer(page if page is not None else qs, many=True)
+		if getattr(request, 'accepted_renderer', None) and getattr(request.accepted_renderer, 'format', None) == 'html':
+			return Response({'items': serializer.data, 'title': 'Order summaries'}, template_name='api_root.html')
+		if self.paginator.keyset:
+			return self.get_paginated_response(serializer.data)
+		return Response(serializer.data)
+
+
+class PaymentViewSet(EagerLoadingViewSetMixin, viewsets.ModelViewSet):
 	queryset = Payment.objects.all()
 	serializer_class = PaymentSerializer
 	permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+	# opt-in keyset pagination: ?cursor= / ?pagination=keyset
+	pagination_class = KeysetPagination
 
 	renderer_classes = [TemplateHTMLRenderer, JSONRenderer]
 
 	def list(self, request, *args, **kwargs):
 		qs = self.filter_queryset(self.get_queryset())
 		page = self.paginate_queryset(qs)
-		serializer = self.get_serializer(page or qs, many=True)
+		serializer = self.get_serializer(page if page is not None else qs, many=True)
 		if getattr(request, 'accepted_renderer', None) and getattr(request.accepted_renderer, 'format', None) == 'html':
 			return Response({'items': serializer.data, 'title': 'Payments'}, template_name='api_root.html')
+		if self.paginator.keyset:
+			return self.get_paginated_response(serializer.data)
 		return Response(serializer.data)
 
+	@action(
+		detail=False, methods=["get"], url_path="export", url_name="export", permission_classes=[permissions.IsAdminUser],
+		renderer_classes=[CSVRenderer, NDJSONRenderer],
+	)
+	def export(self, request):
+		"""Stream the payments matching the PaymentFilter parameters as CSV or NDJSON.
+
+		GET /api/payments/export/?format=csv|ndjson&created_at__gte=<iso>&status=successful
+		"""
+		return _export(request, 'payments')
+
 	@action(detail=False, methods=["post"], url_path="initiate", permission_classes=[permissions.IsAuthenticated])
 	def initiate(self, request):
 		"""Create a Payment record and initiate STK push via Mpesa.
 
 		Expected JSON: {"order_id": "<uuid>", "phone": "2547XXXXXXXX"}
+
+		In asynchronous mode (`MPESA_ASYNC_INITIATION`, or "async": true in the
+		body) the pending payment is created, the push is dispatched to Celery
+		(published once the response is out) and the response is 202 with the URL of the payment's status resource
+		(GET /api/payments/{id}/status/) instead of waiting for Safaricom.
+
+		An order has one payment: a failed one (or a pending one whose push
+		never got a CheckoutRequestID within PAYMENT_RECONCILE_MIN_AGE
+		seconds) is reset and pushed again; any other is a 409.
 		"""
 		order_id = request.data.get("order_id")
 		phone = request.data.get("phone")
@@ -190,109 +440,208 @@ class PaymentViewSet(viewsets.ModelViewSet):
 		if not order_id or not phone:
 			return Response({"detail": "order_id and phone are required"}, status=status.HTTP_400_BAD_REQUEST)
 
+		# don't create payments that can't be pushed while Safaricom is down
+		if default_breaker.state() == "open":
+			return _mpesa_unavailable(CircuitOpenError(default_breaker.name, default_breaker.reset_timeout))
+
 		try:
 			order = Order.objects.get(pk=order_id)
 		except Order.DoesNotExist:
 			return Response({"detail": "Order not found"}, status=status.HTTP_404_NOT_FOUND)
 
-		# create payment record with pending status
-		payment = Payment.objects.create(
-			user=request.user,
-			order=order,
-			amount=order.total_amount,
-			method="mpesa",
-			status="pending",
-			transaction_id="",
-		)
+		wants_async = self._wants_async(request)
+		# create (or reset) the payment record with pending status; the
+		# CheckoutRequestID is filled in once Safaricom accepts the push
+		with transaction.atomic():
+			payment = Payment.objects.select_for_update().filter(order=order).first()
+			if payment is None:
+				try:
+					with transaction.atomic():
+						payment = Payment.objects.create(
+							user=request.user,
+							order=order,
+							amount=order.total_amount,
+							method="mpesa",
+							status="pending",
+							transaction_id=None,
+						)
+				except IntegrityError:
+					# initiated concurrently
+					return _payment_exists(Payment.objects.filter(order=order).first())
+			elif self._can_retry(payment):
+				payment.user = request.user
+				payment.amount = order.total_amount
+				payment.method = "mpesa"
+				payment.status = "pending"
+				payment.checkout_request_id = None
+				payment.transaction_id = None
+				payment.mpesa_receipt_number = None
+				payment.paid_at = None
+				payment.created_at = timezone.now()
+				payment.save()
+			else:
+				return _payment_exists(payment)
+			if wants_async:
+				# committed with the payment, sent to the broker after the
+				# response (see dispatch.py)
+				dispatch(initiate_mpesa_payment, (str(payment.id), phone))
+
+		if wants_async:
+			status_url = request.build_absolute_uri(reverse("payment-status", args=[payment.pk]))
+			return Response(
+				{"payment_id": str(payment.id), "status": payment.status, "status_url": status_url},
+				status=status.HTTP_202_ACCEPTED,
+				headers={"Location": status_url},
+			)
 
 		try:
 			resp = initiate_stk_push(amount=float(payment.amount), phone_number=phone, account_reference=str(order.id), transaction_desc=f"Order {order.id}")
+		except CircuitOpenError as exc:
+			# nothing was sent; the payment can be initiated again later
+			payment.status = "failed"
+			payment.save()
+			return _mpesa_unavailable(exc)
 		except Exception as exc:
 			payment.status = "failed"
 			payment.save()
 			return Response({"detail": "Failed to initiate Mpesa payment", "error": str(exc)}, status=status.HTTP_502_BAD_GATEWAY)
 
 		# Safaricom returns CheckoutRequestID on success
-		checkout_id = resp.get("CheckoutRequestID") or resp.get("ResponseDescription")
-		payment.transaction_id = checkout_id or ""
+		checkout_id = resp.get("CheckoutRequestID") or None
+		payment.checkout_request_id = checkout_id
+		payment.transaction_id = checkout_id
 		payment.save()
 
 		return Response({"payment_id": str(payment.id), "checkout_request_id": checkout_id, "raw": resp})
 
+	def _can_retry(self, payment):
+		if payment.status == "failed":
+			return True
+		# a push that never reached Safaricom (e.g. the process died)
+		stale = timezone.now() - timedelta(seconds=settings.PAYMENT_RECONCILE_MIN_AGE)
+		return (
+			payment.status == "pending" and not payment.checkout_request_id
+			and not payment.transaction_id and payment.created_at < stale
+		)
+
+	def _wants_async(self, request):
+		flag = request.data.get("async")
+		if flag is None:
+			return settings.MPESA_ASYNC_INITIATION
+		if isinstance(flag, str):
+			return flag.lower() in ("1", "true", "yes")
+		return bool(flag)
+
+	@action(detail=True, methods=["get"], url_path="status", url_name="status", permission_classes=[permissions.IsAuthenticated])
+	def payment_status(self, request, pk=None):
+		"""Poll a payment, e.g. after an asynchronous `initiate`.
+
+		GET /api/payments/{pk}/status/
+		`stk_push` is "queued" until the push reaches Safaricom, then "sent";
+		"failed" means the push itself could not be made.
+		"""
+		payment = self.get_object()
+		if payment.user_id != request.user.id and not request.user.is_staff:
+			return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+		checkout_id = payment.checkout_request_id or payment.transaction_id
+		if checkout_id:
+			stk_push = "sent"
+		elif payment.status == "pending":
+			stk_push = "queued"
+		else:
+			stk_push = "failed"
+		return Response({
+			"payment_id": str(payment.id),
+			"order_id": str(payment.order_id),
+			"status": payment.status,
+			"stk_push": stk_push,
+			"checkout_request_id": checkout_id,
+			"mpesa_receipt_number": payment.mpesa_receipt_number,
+			"paid_at": payment.paid_at,
+		})
+
 	@action(detail=True, methods=["post"], url_path="verify", permission_classes=[permissions.IsAuthenticated])
 	def verify(self, request, pk=None):
-		"""Verify payment status by querying Mpesa and update the Payment record.
+		"""Return the payment's status, querying Mpesa for pending payments.
 
 		POST /api/payments/{pk}/verify/
-		Uses the Payment.transaction_id as the `CheckoutRequestID` when present.
-		If not present, you can pass `checkout_request_id` in the POST body.
+		Settled payments are answered from the database. A pending payment is
+		queried live (using its stored `CheckoutRequestID`; `checkout_request_id`
+		from the POST body only for payments that have none and when no other
+		payment uses it, since the result settles this payment) at most once every
+		PAYMENT_VERIFY_MIN_INTERVAL seconds; calls in between, and payments
+		the reconcile_pending_payments beat task settles, get the stored
+		status. `raw` is the Mpesa response when a live query was made.
 		"""
 		payment = self.get_object()
-		checkout_id = request.data.get("checkout_request_id") or payment.transaction_id
-
-		if not checkout_id:
-			return Response({"detail": "No checkout_request_id available for verification"}, status=status.HTTP_400_BAD_REQUEST)
-
-		try:
-			resp = query_stk_status(checkout_id)
-		except Exception as exc:
-			return Response({"detail": "Failed to query Mpesa", "error": str(exc)}, status=status.HTTP_502_BAD_GATEWAY)
-
-		# Attempt to find a numeric result code in the response
-		result_code = None
-		# common shapes
-		if isinstance(resp, dict):
-			result_code = resp.get("ResultCode") or resp.get("ResponseCode")
-			# nested patterns
-			if not result_code:
-				for k in ("result", "Result", "Response", "response"):
-					sub = resp.get(k)
-					if isinstance(sub, dict):
-						result_code = sub.get("ResultCode") or sub.get("ResponseCode")
-						if result_code is not None:
-							break
-
-		# Normalize result_code to int when possible
-		try:
-			result_code_int = int(result_code) if result_code is not None else None
-		except Exception:
-			result_code_int = None
-
-		if result_code_int == 0:
-			# success
-			payment.status = "successful"
-			from django.utils import timezone
-			payment.paid_at = timezone.now()
-
-			# try to extract Mpesa receipt number if present
-			mpesa_receipt = None
-			if isinstance(resp, dict):
-				# look for common keys in callback metadata if present
-				meta = resp.get("CallbackMetadata") or resp.get("callbackMetadata") or resp.get("Result") or {}
-				items = []
-				if isinstance(meta, dict):
-					items = meta.get("Item") or meta.get("Items") or []
-				if isinstance(items, list):
-					for it in items:
-						if it.get("Name") in ("MpesaReceiptNumber", "ReceiptNumber"):
-							mpesa_receipt = it.get("Value")
-
-			if mpesa_receipt:
-				payment.transaction_id = mpesa_receipt
-
-			payment.save()
-
-			# schedule confirmation email
-			try:
-				send_payment_confirmation_email.delay(payment.user.email, f"Payment received for order {payment.order.id}", f"Your payment for order {payment.order.id} was successful.")
-			except Exception:
-				pass
-
-			return Response({"detail": "Payment marked successful", "raw": resp})
-		else:
-			payment.status = "failed"
-			payment.save()
-			return Response({"detail": "Payment marked failed", "raw": resp})
+		resp = None
+
+		if payment.status == "pending":
+			checkout_id = payment.checkout_request_id or payment.transaction_id
+			if not checkout_id:
+				checkout_id = request.data.get("checkout_request_id")
+				if checkout_id and Payment.objects.filter(
+					Q(checkout_request_id=checkout_id) | Q(transaction_id=checkout_id)
+				).exclude(pk=payment.pk).exists():
+					return Response(
+						{"detail": "checkout_request_id belongs to another payment"}, status=status.HTTP_400_BAD_REQUEST,
+					)
+			if not checkout_id:
+				return Response({"detail": "No checkout_request_id available for verification"}, status=status.HTTP_400_BAD_REQUEST)
+
+			if payments.claim_verify_slot(payment.pk):
+				try:
+					resp = payments.query_payment_status(checkout_id)
+				except CircuitOpenError as exc:
+					return _mpesa_unavailable(exc)
+				except Exception as exc:
+					return Response({"detail": "Failed to query Mpesa", "error": str(exc)}, status=status.HTTP_502_BAD_GATEWAY)
+				payments.apply_query_results({payment.pk: resp})
+				payment.refresh_from_db()
+
+		detail = {
+			"successful": "Payment marked successful",
+			"failed": "Payment marked failed",
+		}.get(payment.status, "Payment is pending")
+		return Response({
+			"detail": detail,
+			"status": payment.status,
+			"checkout_request_id": payment.checkout_request_id or payment.transaction_id,
+			"mpesa_receipt_number": payment.mpesa_receipt_number,
+			"raw": resp,
+		})
+
+
+def _payment_exists(payment):
+	return Response(
+		{"detail": "The order already has a payment", "payment_id": str(payment.pk) if payment else None},
+		status=status.HTTP_409_CONFLICT,
+	)
+
+
+def _mpesa_unavailable(exc):
+	"""503 for calls refused by the open Mpesa circuit breaker."""
+	return Response(
+		{"detail": "Mpesa is temporarily unavailable, try again later", "error": str(exc)},
+		status=status.HTTP_503_SERVICE_UNAVAILABLE,
+		headers={"Retry-After": str(exc.retry_after)},
+	)
+
+
+def _stk_callback(data):
+	"""Return the validated `stkCallback` of a Safaricom callback body; raises ValueError."""
+	body = (data.get("Body") or data.get("body") or data) if isinstance(data, dict) else None
+	stk = body.get("stkCallback") if isinstance(body, dict) else None
+	if not isinstance(stk, dict):
+		raise ValueError("missing Body.stkCallback")
+	if not stk.get("CheckoutRequestID"):
+		raise ValueError("missing CheckoutRequestID")
+	try:
+		int(stk.get("ResultCode"))
+	except (TypeError, ValueError):
+		raise ValueError("invalid ResultCode")
+	return stk
 
 
 @api_view(["POST"])
@@ -301,60 +650,41 @@ def mpesa_callback(request):
 	"""Endpoint to receive Mpesa STK push callback notifications.
 
 	Safaricom posts a JSON body that includes `Body` -> `stkCallback`.
-	We parse the common fields and update the matching Payment by CheckoutRequestID.
+	With MPESA_CALLBACK_QUEUE the validated callback is appended to a Redis
+	stream and acknowledged at once; workers apply it in batches (see
+	callback_stream.py). While too many callbacks are waiting the endpoint
+	answers 503 with Retry-After, and Safaricom retries later.
+
+	Otherwise (or when Redis is unavailable) it is applied inline. The
+	payment is found by an exact lookup on its unique `checkout_request_id`
+	(falling back to the legacy `transaction_id`), so the cost doesn't grow
+	with the payments table. The receipt goes to `mpesa_receipt_number`.
+	Safaricom may deliver a callback more than once: only a pending payment
+	is updated, repeats are acknowledged without side effects (no second
+	email).
 	"""
-	data = request.data
-	# defensive parsing for common Safaricom payload shape
 	try:
-		body = data.get("Body") or data.get("body") or data
-		stk = body.get("stkCallback") if isinstance(body, dict) else None
-		if stk:
-			checkout_id = stk.get("CheckoutRequestID")
-			result_code = stk.get("ResultCode")
-			callback_metadata = stk.get("CallbackMetadata") or {}
-
-			# find Payment by transaction_id matching CheckoutRequestID
-			payment = None
-			if checkout_id:
-				try:
-					payment = Payment.objects.filter(transaction_id__iexact=checkout_id).first()
-				except Exception:
-					payment = None
-
-			if not payment:
-				return Response({"detail": "Payment not found for callback"}, status=status.HTTP_404_NOT_FOUND)
-
-			if int(result_code) == 0:
-				# success - attempt to extract MpesaReceiptNumber and set paid_at
-				mpesa_receipt = None
-				if callback_metadata and isinstance(callback_metadata, dict):
-					items = callback_metadata.get("Item", []) or callback_metadata.get("Items", [])
-				else:
-					items = []
-
-				for it in items:
-					if it.get("Name") in ("MpesaReceiptNumber", "ReceiptNumber"):
-						mpesa_receipt = it.get("Value")
-
-				payment.status = "successful"
-				if mpesa_receipt:
-					payment.transaction_id = mpesa_receipt
-				from django.utils import timezone
-
-				payment.paid_at = timezone.now()
-				payment.save()
-
-				# send confirmation email in background
-				try:
-					send_payment_confirmation_email.delay(payment.user.email, f"Payment received for order {payment.order.id}", f"Your payment for order {payment.order.id} was successful.")
-				except Exception:
-					# don't fail callback if email scheduling fails
-					pass
-
-				return Response({"detail": "Payment updated to successful"})
-			else:
-				payment.status = "failed"
-				payment.save()
-				return Response({"detail": "Payment marked failed"})
-	except Exception as exc:
+		stk = _stk_callback(request.data)
+	except ValueError as exc:
 		return Response({"detail": "Invalid callback payload", "error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+	if settings.MPESA_CALLBACK_QUEUE:
+		try:
+			if callback_stream.enqueue(stk):
+				return Response({"detail": "Callback accepted"})
+		except callback_stream.CallbackBacklogFull as exc:
+			return Response(
+				{"detail": "Too many callbacks waiting, try again later", "error": str(exc)},
+				status=status.HTTP_503_SERVICE_UNAVAILABLE,
+				headers={"Retry-After": str(exc.retry_after)},
+			)
+
+	payment_id = payments.find_by_checkout_request_id(stk["CheckoutRequestID"])
+	if payment_id is None:
+		return Response({"detail": "Payment not found for callback"}, status=status.HTTP_404_NOT_FOUND)
+
+	if not payments.apply_query_results({payment_id: stk}):
+		return Response({"detail": "Callback already processed"})
+	if int(stk["ResultCode"]) == 0:
+		return Response({"detail": "Payment updated to successful"})
+	return Response({"detail": "Payment marked failed"})